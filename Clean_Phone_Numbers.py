@@ -1,8 +1,15 @@
-import xml.etree.cElementTree as ET
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from osm_io import get_element
+from rules_config import RULES
+from normalize_cache import cached
 
 OSMFILE = "sample_rj_map.osm"
 
-key_tags = ["phone"]
+key_tags = RULES["phone_keys"]
 
 def clean_phone(spell):
     #Removes special characters between phone numbers for uniformization
@@ -14,10 +21,13 @@ def clean_phone(spell):
         spell = spell.replace(disjunctions[j],';')
     return spell
 
+@cached("phone")
 def update_phone(spell):
     #Updates phones to the format 
     #phone=+<country code> <area code> <local number>
     #following the ITU-T E.123 and the DIN 5008 pattern
+    #Cached, so it has no side effects: the audit reports the numbers it
+    #cannot format (see unformatted_phone)
     #Args: spell: the attrib "v" from <phone>
     #Returns: better_number: numbers in the right format
     better_number = str()
@@ -47,22 +57,128 @@ def update_phone(spell):
     elif ";" in spell: #Takes 'v' with more than one number
         if len(spell) == 25: #Complete two numbers
             better_number = '+' + spell[0:2] + ' ' + spell[2:4] + ' ' + spell[4:8] + '-' + spell[8:12] + ' ; ' + spell[13:15] + ' ' + spell[15:17] + ' ' + spell[17:21] + '-' + spell[21:25]
-    else:
-        print(spell, len(spell))
     return better_number
 
+def unformatted_phone(spell):
+    #Returns the cleaned number if update_phone has no format for it (it
+    #returns ''), None otherwise
+    #Args: spell: the attrib "v" from <phone>
+    spell = clean_phone(spell)
+    return spell if _phone_kind(spell) == 0 else None
+
+# Below this many distinct values update_phone_batch goes through the cached
+# update_phone: building the numpy arrays costs more than it saves
+# (benchmark.py batch measures both against the batch size)
+BATCH_MIN = 512
+
+# clean_phone as one translate table: the fillers are deleted and the
+# one character disjunctions become ';' ('ou' is replaced afterwards)
+PHONE_TABLE = str.maketrans({' ': None, '+': None, '-': None, '(': None,
+                             ')': None, '/': ';', ',': ';'})
+
+# The formats of update_phone, in the order its conditions are tested;
+# 0 is for the numbers it cannot format
+PHONE_FORMATS = [
+    None,
+    lambda s: '+' + s[0:2] + ' ' + s[2:4] + ' ' + s[4:8] + '-' + s[8:12],
+    lambda s: '+' + s[0:2] + ' ' + s[2:4] + ' ' + s[4:9] + '-' + s[9:12],
+    lambda s: '',
+    lambda s: '+55' + ' ' + s[0:2] + ' ' + s[2:6] + '-' + s[6:10],
+    lambda s: '+55' + ' ' + s[0:2] + ' ' + s[2:7] + '-' + s[7:11],
+    lambda s: '+55 21 ' + s[0:4] + '-' + s[4:8],
+    lambda s: '+55 21 ' + s[0:5] + '-' + s[5:9],
+    lambda s: s[0:4] + '-' + s[4:7] + '-' + s[7:11],
+    lambda s: ('+' + s[0:2] + ' ' + s[2:4] + ' ' + s[4:8] + '-' + s[8:12] +
+               ' ; ' + s[13:15] + ' ' + s[15:17] + ' ' + s[17:21] + '-' +
+               s[21:25]),
+    lambda s: '',
+]
+
+
+def classify_phones(spells):
+    #Returns the PHONE_FORMATS index of each cleaned number, testing the
+    #conditions of update_phone on whole arrays of lengths and prefixes
+    if np is None:
+        return [_phone_kind(spell) for spell in spells]
+    if not spells:
+        return []
+    lengths = np.fromiter(map(len, spells), dtype=np.int64, count=len(spells))
+    #Casting to short unicode dtypes keeps just the prefixes
+    first = np.array(spells, dtype='U1')
+    prefix2 = np.array(spells, dtype='U2')
+    prefix4 = np.array(spells, dtype='U4')
+    several = np.fromiter((';' in spell for spell in spells), dtype=bool,
+                          count=len(spells))
+    conditions = [
+        lengths == 12,
+        lengths == 13,
+        (lengths == 11) & (first == '0'),
+        (lengths == 10) & (prefix2 == '21'),
+        (lengths == 11) & (prefix2 == '21'),
+        lengths == 8,
+        (lengths == 9) & (first == '9'),
+        prefix4 == '0800',
+        several & (lengths == 25),
+        several,
+    ]
+    return np.select(conditions, range(1, len(conditions) + 1)).tolist()
+
+
+def _phone_kind(spell):
+    size = len(spell)
+    if size == 12:
+        return 1
+    if size == 13:
+        return 2
+    if size == 11 and spell[0] == '0':
+        return 3
+    if size == 10 and spell[0:2] == '21':
+        return 4
+    if size == 11 and spell[0:2] == '21':
+        return 5
+    if size == 8:
+        return 6
+    if size == 9 and spell[0] == '9':
+        return 7
+    if spell[0:4] == '0800':
+        return 8
+    if ';' in spell:
+        return 9 if size == 25 else 10
+    return 0
+
+
+def update_phone_batch(spells):
+    #Batch version of update_phone, with the same results: every distinct
+    #value is cleaned with PHONE_TABLE, classified with the others and
+    #formatted once. Numbers it cannot format are '' (unformatted_phone
+    #tells them apart); fewer than BATCH_MIN distinct values go through the
+    #cached update_phone
+    #Args: spells: sequence of "v" attribs of phone tags
+    #Returns: list of the formatted numbers, in the same order
+    unique = list(dict.fromkeys(spells))
+    if len(unique) < BATCH_MIN:
+        return [update_phone(spell) for spell in spells]
+    cleaned = [spell.translate(PHONE_TABLE).replace('ou', ';')
+               for spell in unique]
+    numbers = dict((raw, PHONE_FORMATS[kind](spell) if kind else '')
+                   for raw, spell, kind in
+                   zip(unique, cleaned, classify_phones(cleaned)))
+    return [numbers[spell] for spell in spells]
+
+
 def audit(osmfile, key_tags):
     #Parses file and calls update_postal
     #Args: 
         #osmfile: OpenStreetMap file
         #key_tags: the tags 'k' corresponding to the postal codes
-    osm_file = open(OSMFILE, "r")
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if tag.attrib['k'] in key_tags:
-                    update_phone(tag.attrib['v'])                    
-    osm_file.close()     
-
-audit(OSMFILE, key_tags)
+    for elem in get_element(osmfile, tags=("node", "way")):
+        for tag in elem.iter("tag"):
+            if tag.attrib['k'] in key_tags:
+                update_phone(tag.attrib['v'])
+                #Printed on every occurrence, cached or not
+                spell = unformatted_phone(tag.attrib['v'])
+                if spell is not None:
+                    print(spell, len(spell))
 
+if __name__ == '__main__':
+    audit(OSMFILE, key_tags)
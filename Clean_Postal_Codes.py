@@ -1,9 +1,17 @@
-import xml.etree.cElementTree as ET
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from osm_io import get_element
+from rules_config import RULES
+from normalize_cache import cached
     
 OSMFILE = "rj_map.osm"
 
-key_tags = ["zip:right", "zip:left", "addr:postcode" ]
+key_tags = RULES["postal_keys"]
 
+@cached("postcode")
 def update_postal(spell):
     #Updates postal codes from the format XXXXXXXX to XXXXX-XXX
     #Args: spell: the attrib "v" from address:postcode
@@ -13,19 +21,28 @@ def update_postal(spell):
         better_zip = spell[0:5] + "-" + spell[5:8]                        
     return better_zip
 
+def update_postal_batch(spells):
+    #Batch version of update_postal, with the same results
+    #Args: spells: sequence of "v" attribs from address:postcode
+    #Returns: list of the zip codes, in the same order
+    if np is None or not spells:
+        eight = [len(spell) == 8 for spell in spells]
+    else:
+        eight = (np.fromiter(map(len, spells), dtype=np.int64,
+                             count=len(spells)) == 8).tolist()
+    return [spell[0:5] + "-" + spell[5:8] if is_eight else spell
+            for spell, is_eight in zip(spells, eight)]
+
 def audit_postal(osmfile, key_tags):
     #Parses file and calls update_postal
     #Args: 
         #osmfile: OpenStreetMap file
         #key_tags: the tags 'k' corresponding to the postal codes
-    osm_file = open(OSMFILE, "r")
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if tag.attrib['k'] in key_tags:
-                    better_zip = update_postal(tag.attrib['v'])    
-                    tag.attrib['v'] = better_zip
-    osm_file.close()                
-
-audit_postal(OSMFILE, key_tags)
+    for elem in get_element(osmfile, tags=("node", "way")):
+        for tag in elem.iter("tag"):
+            if tag.attrib['k'] in key_tags:
+                better_zip = update_postal(tag.attrib['v'])
+                tag.attrib['v'] = better_zip
 
+if __name__ == '__main__':
+    audit_postal(OSMFILE, key_tags)
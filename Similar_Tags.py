@@ -1,4 +1,5 @@
-import xml.etree.cElementTree as ET
+from osm_io import get_element
+from rules_config import RULES
 
 #Parses file and corrects the not expected zip keys
 #Args: 
@@ -8,24 +9,15 @@ import xml.etree.cElementTree as ET
     
 OSMFILE = "rj_map.osm"
 
-mapping = { 
-           "CEP_LD": "zip:right",
-           "CEP_LE": "zip:left",
-           "cep:par": "zip:right",
-           "cep:impar": "zip:left",
-           "addr:zipcode": "addr:postcode"
-            }
+mapping = RULES["key_aliases"]
 
 def audit(osmfile):
     #Parses file and calls audit_street_type function
     #Args: osmfile: OpenStreetMap data
     #Returns: street_types: A dict with the problem street types
-    osm_file = open(osmfile, "r")
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                update_tags(tag, mapping)
-    osm_file.close()
+    for elem in get_element(osmfile, tags=("node", "way")):
+        for tag in elem.iter("tag"):
+            update_tags(tag, mapping)
 
 
 def update_tags(tag, mapping):
@@ -34,4 +26,5 @@ def update_tags(tag, mapping):
         postal_tag = mapping[tag.attrib['k']]     
     return postal_tag                 
 
-audit(OSMFILE)
+if __name__ == '__main__':
+    audit(OSMFILE)
@@ -1,36 +1,16 @@
-import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
+from osm_io import get_element
+from rules_config import RULES
 
 OSMFILE = "rj_map.osm"
 #OSMFILE = "sample_rj_map.osm"
 street_type_re = re.compile(r'^\b\S+\.?', re.IGNORECASE) #Street type is in the begining of the 
 #street name in portuguese language
 
-expected = ["Rua", "Avenida", "Acesso", "Calçadão", "Ladeira", "Praça", 
-            "Travessa", "Via", "Vila", "Estrada", "Auto", "Alameda", "Aterro",
-            "Beco", "Boulevard", "Caminho", "Largo", "Parque", "Praia", 
-            "Rodovia", "Quadra", "Condominio", "Terminal"]
+expected = RULES["street_types"]["expected"]
 
-mapping = { "Av.": "Avenida",
-           "Av": "Avenida",
-           "av.": "Avenida",
-           "Est.": "Estrada",
-           "Estr.": "Estrada",
-           "estrada": "Estrada",
-           "PLAZA": "Praça",
-           "Pca": "Praça",
-           "Praca": "Praça",
-           "Pça": "Praça",
-           "Pça.": "Praça",
-           "R.": "Rua",
-           "Rod.": "Rodovia",
-           "Ruas": "Rua",
-           "Rue": "Rua",
-           "Ruo": "Rua" ,
-           "rua": "Rua",
-           "vila": "Vila"
-            }
+mapping = RULES["street_types"]["mapping"]
 
 def audit_street_type(street_types, street_name):
     #Creates a dict with all the street types that are not expected
@@ -55,14 +35,11 @@ def audit(osmfile):
     #Parses file and calls audit_street_type function
     #Args: osmfile: OpenStreetMap data
     #Returns: street_types: A dict with the problem street types
-    osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-        if elem.tag == "node" or elem.tag == "way":
-            for tag in elem.iter("tag"):
-                if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
+    for elem in get_element(osmfile, tags=("node", "way")):
+        for tag in elem.iter("tag"):
+            if is_street_name(tag):
+                audit_street_type(street_types, tag.attrib['v'])
     return street_types
 
 def update_name(name, mapping):
@@ -78,12 +55,13 @@ def update_name(name, mapping):
         better_name = street_type_re.sub(better_street_type, name)
     return better_name
 
-st_types = audit(OSMFILE)
-for st_type, ways in st_types.items():
-    for name in ways:
-        try: #try except was used because of the street names that had no type
-            better_name = update_name(name, mapping)
-            print(name, ":", better_name)
-        except KeyError:
-            pass
+if __name__ == '__main__':
+    st_types = audit(OSMFILE)
+    for st_type, ways in st_types.items():
+        for name in ways:
+            try: #try except was used because of the street names that had no type
+                better_name = update_name(name, mapping)
+                print(name, ":", better_name)
+            except KeyError:
+                pass
             
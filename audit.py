@@ -0,0 +1,139 @@
+"""
+Single-pass audit of an OpenStreetMap file.
+
+The file is parsed once and every <tag> of every node and way is handed to
+each registered rule whose keys match, so adding a rule does not add a pass.
+"""
+import pprint
+import re
+import sys
+
+from osm_io import get_element
+from rules_config import RULES
+from Update_Street_Types import street_type_re, expected
+from Similar_Tags import mapping as mapping_tags
+from Clean_Postal_Codes import key_tags as key_postal
+from Clean_Phone_Numbers import key_tags as key_phone
+
+OSMFILE = "rj_map.osm"
+
+POSTCODE_RE = re.compile(r'^\d{5}-\d{3}$')
+PHONE_RE = re.compile(r'^(\+\d{2} \d{2} \d{4,5}-\d{4}|0800-\d{3}-\d{4})$')
+
+
+class AuditRule(object):
+    """
+        A check applied to the <tag> elements of nodes and ways.
+        Args:
+            name: name of the rule in the report
+            check: function(key, value) returning None when the tag is fine
+                or the offending text otherwise
+            keys: the tags 'k' the rule looks at (None means every key)
+            max_samples: how many distinct offending values to keep
+    """
+
+    def __init__(self, name, check, keys=None, max_samples=10):
+        self.name = name
+        self.check = check
+        self.keys = frozenset(keys) if keys is not None else None
+        self.max_samples = max_samples
+
+
+def check_street_type(key, value):
+    #Street types come first in portuguese, e.g. "Av. Brasil"
+    m = street_type_re.search(value)
+    if m and m.group() not in expected:
+        return value
+
+
+def check_postal_key(key, value):
+    return key
+
+
+def check_postcode(key, value):
+    if not POSTCODE_RE.match(value):
+        return value
+
+
+def check_phone(key, value):
+    if not PHONE_RE.match(value):
+        return value
+
+
+def default_rules():
+    """Return the rules of the four audit scripts"""
+    return [
+        AuditRule('street_type', check_street_type,
+                  keys=RULES["street_types"]["keys"]),
+        AuditRule('postal_key_alias', check_postal_key, keys=mapping_tags),
+        AuditRule('postcode_format', check_postcode,
+                  keys=list(key_postal) + list(mapping_tags)),
+        AuditRule('phone_format', check_phone, keys=key_phone),
+    ]
+
+
+class AuditEngine(object):
+    """Run several audit rules over one parse of an OpenStreetMap file"""
+
+    def __init__(self, rules=None):
+        self.rules = list(rules) if rules is not None else default_rules()
+
+    def register(self, rule):
+        """Add a user supplied AuditRule"""
+        self.rules.append(rule)
+        return rule
+
+    def run(self, osmfile, tags=('node', 'way'), parser='etree'):
+        """
+            Parses the file once and sends each <tag> to the matching rules.
+            Args:
+                osmfile: OpenStreetMap file (path or file object)
+                tags: the elements whose <tag> children are audited
+                parser: osm_io parser backend
+            Returns:
+                report: dict rule name -> {'checked', 'problems', 'samples'}
+        """
+        by_key = {}
+        any_key = []
+        for rule in self.rules:
+            if rule.keys is None:
+                any_key.append(rule)
+            else:
+                for key in rule.keys:
+                    by_key.setdefault(key, []).append(rule)
+
+        report = dict((rule.name, {'checked': 0, 'problems': 0, 'samples': []})
+                      for rule in self.rules)
+        seen = dict((rule.name, set()) for rule in self.rules)
+
+        for elem in get_element(osmfile, tags=tags, parser=parser):
+            for tag in elem.iter("tag"):
+                key = tag.get('k')
+                value = tag.get('v')
+                rules = by_key.get(key, [])
+                if any_key:
+                    rules = rules + any_key
+                for rule in rules:
+                    entry = report[rule.name]
+                    entry['checked'] += 1
+                    problem = rule.check(key, value)
+                    if problem is None:
+                        continue
+                    entry['problems'] += 1
+                    if len(entry['samples']) < rule.max_samples and \
+                            problem not in seen[rule.name]:
+                        seen[rule.name].add(problem)
+                        entry['samples'].append(problem)
+        return report
+
+
+def audit(osmfile, rules=None, parser='etree'):
+    """Audit osmfile with the default rules plus any extra rules"""
+    engine = AuditEngine()
+    for rule in rules or ():
+        engine.register(rule)
+    return engine.run(osmfile, parser=parser)
+
+
+if __name__ == '__main__':
+    pprint.pprint(audit(sys.argv[1] if len(sys.argv) > 1 else OSMFILE))
@@ -0,0 +1,1060 @@
+"""
+Benchmarks for the OpenStreetMap data wrangling scripts.
+
+Usage:
+    python benchmark.py memory [--copies 10] [--max-ratio 1.5]
+    python benchmark.py ways [--sizes 10,1000,50000]
+    python benchmark.py shape [--module preparing_database]
+    python benchmark.py csv [--copies 10]
+    python benchmark.py columnar [--copies 10] [--row-group-size 1000]
+    python benchmark.py cache [--copies 10]
+    python benchmark.py relations [--copies 10]
+    python benchmark.py parse [--copies 10] [--parsers etree,expat,lxml]
+    python benchmark.py records [--copies 10] [--module preparing_database]
+    python benchmark.py sample [--copies 10] [--workers 1]
+    python benchmark.py spatial [--copies 10]
+    python benchmark.py clip [--copies 10] [--vertices 2000]
+    python benchmark.py batch [--copies 100]
+    python benchmark.py compressed [--copies 10] [--threads N]
+    python benchmark.py pbf [--copies 10] [--workers 2]
+    python benchmark.py streets [--names 20000] [--lookups 2000]
+    python benchmark.py suite [--osm-file F | --size 2.8MB --seed 0
+        --tag-density 0.1 --way-length 8 --mix phone=1,street=3]
+        [--stages parse:etree,shape,...] [--json results.json]
+    python benchmark.py compare old.json new.json [--threshold 0.1]
+"""
+import argparse
+import codecs
+import contextlib
+import csv
+import importlib
+import importlib.util
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+import xml.etree.cElementTree as ET
+
+SAMPLE_FILE = "sample_rj_map.osm"
+HERE = os.path.dirname(os.path.abspath(__file__))
+ID_ATTRIBUTE = re.compile(br'\b(id|ref)="(-?\d+)"')
+ID_SHIFT = 10 ** 11
+
+# Child processes print their own peak RSS (in kB on Linux) once done
+AUDITS = {
+    'Update_Street_Types': "import Update_Street_Types as m; m.audit({path!r})",
+    'Clean_Postal_Codes': "import Clean_Postal_Codes as m; "
+                          "m.audit_postal({path!r}, m.key_tags)",
+    'Similar_Tags': "import Similar_Tags as m; m.audit({path!r})",
+    'Clean_Phone_Numbers': "import Clean_Phone_Numbers as m, contextlib, io\n"
+                           "with contextlib.redirect_stdout(io.StringIO()):\n"
+                           "    m.audit({path!r}, m.key_tags)",
+    'audit': "import audit as m; m.audit({path!r})",
+}
+
+PEAK_RSS = ("\nimport resource\n"
+            "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+
+
+def replicate_osm(osm_file, copies, out_file, shift=False):
+    """
+        Write out_file with the elements of osm_file repeated `copies` times.
+        With shift, the ids and refs of each copy are moved by ID_SHIFT so
+        they stay unique (e.g. for the SQLite output).
+    """
+    with open(osm_file, 'rb') as f:
+        data = f.read()
+    start = data.index(b'>', data.index(b'<osm')) + 1
+    end = data.rindex(b'</osm>')
+    with open(out_file, 'wb') as out:
+        out.write(data[:start])
+        for copy in range(copies):
+            body = data[start:end]
+            if shift and copy:
+                body = ID_ATTRIBUTE.sub(
+                    lambda m: b'%s="%d"' % (m.group(1),
+                                            int(m.group(2)) + copy * ID_SHIFT),
+                    body)
+            out.write(body)
+        out.write(data[end:])
+
+
+def peak_rss(code):
+    """Run code in a fresh interpreter and return its peak RSS in kB"""
+    output = subprocess.check_output([sys.executable, '-c', code + PEAK_RSS],
+                                     cwd=HERE)
+    return int(output.split()[-1])
+
+
+def bench_memory(copies=10, max_ratio=1.5, osm_file=SAMPLE_FILE):
+    """
+        Checks that the audits run in bounded memory: peak RSS on `copies`
+        copies of the sample must stay within max_ratio of the 1x run.
+        Returns: True if every audit passed
+    """
+    ok = True
+    tmp = tempfile.mkdtemp()
+    big_file = os.path.join(tmp, 'x%d.osm' % copies)
+    replicate_osm(os.path.join(HERE, osm_file), copies, big_file)
+    small_file = os.path.join(HERE, osm_file)
+    print("%-20s %10s %10s %7s" % ('audit', '1x kB', '%dx kB' % copies,
+                                   'ratio'))
+    for name, code in sorted(AUDITS.items()):
+        small = peak_rss(code.format(path=small_file))
+        big = peak_rss(code.format(path=big_file))
+        ratio = float(big) / small
+        flag = '' if ratio <= max_ratio else '  FAIL'
+        ok = ok and not flag
+        print("%-20s %10d %10d %7.2f%s" % (name, small, big, ratio, flag))
+    os.remove(big_file)
+    os.rmdir(tmp)
+    return ok
+
+
+def synthetic_way(n_nodes, n_tags=5, way_id=1):
+    """Build a <way> element with n_nodes <nd> refs followed by n_tags tags"""
+    way = ET.Element('way', {'id': str(way_id), 'user': 'bench', 'uid': '1',
+                             'version': '1', 'changeset': '1',
+                             'timestamp': '2017-01-01T00:00:00Z'})
+    for ref in range(n_nodes):
+        ET.SubElement(way, 'nd', {'ref': str(1000000000 + ref)})
+    for i in range(n_tags):
+        ET.SubElement(way, 'tag', {'k': 'note:%d' % i, 'v': 'value'})
+    return way
+
+
+def bench_ways(sizes=(10, 1000, 50000)):
+    """
+        Times shape_element on synthetic ways of each size. With linear way
+        node collection the time per node stays roughly constant.
+    """
+    from preparing_database import shape_element
+    print("%10s %12s %12s" % ('nodes', 'ms/way', 'us/node'))
+    for size in sizes:
+        way = synthetic_way(size)
+        timer = timeit.Timer(lambda: shape_element(way))
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=3, number=number)) / number
+        print("%10d %12.3f %12.3f" % (size, best * 1e3, best * 1e6 / size))
+
+
+def bench_shape(module='preparing_database', osm_file=SAMPLE_FILE):
+    """
+        Times shape_element per node and way of osm_file. Pass the name of a
+        saved copy of an older preparing_database to compare before/after.
+    """
+    from osm_io import get_element
+    shape_element = importlib.import_module(module).shape_element
+    elements = list(get_element(os.path.join(HERE, osm_file),
+                                tags=('node', 'way')))
+    timer = timeit.Timer(lambda: [shape_element(e) for e in elements])
+    best = min(timer.repeat(repeat=5, number=1))
+    print("%s: %d elements, %.2f us/element" %
+          (module, len(elements), best * 1e6 / len(elements)))
+
+
+class LegacyDictWriter(csv.DictWriter, object):
+    """The writer csvs were written with before: one bytes dict per row"""
+
+    def writerow(self, row):
+        super(LegacyDictWriter, self).writerow({
+            k: (v.encode('utf-8') if isinstance(v, str) else v) for k, v
+            in row.items()
+        })
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+def legacy_write(documents, out_dir):
+    import preparing_database as p
+    fields = [p.NODE_FIELDS, p.NODE_TAGS_FIELDS, p.WAY_FIELDS,
+              p.WAY_NODES_FIELDS, p.WAY_TAGS_FIELDS]
+    #The legacy script had no relation files: only the first five paths
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(
+                     codecs.open(os.path.join(out_dir, path), 'w'))
+                 for path in p.CSV_PATHS[:len(fields)]]
+        nodes, node_tags, ways, way_nodes, way_tags = [
+            LegacyDictWriter(f, row_fields)
+            for f, row_fields in zip(files, fields)]
+        for el in documents:
+            if 'node' in el:
+                nodes.writerow(el['node'])
+                node_tags.writerows(el['node_tags'])
+            else:
+                ways.writerow(el['way'])
+                way_nodes.writerows(el['way_nodes'])
+                way_tags.writerows(el['way_tags'])
+
+
+def csv_write(shaped, out_dir):
+    from preparing_database import CsvOutput
+    with CsvOutput(out_dir) as out:
+        for el in shaped:
+            out.write(el)
+
+
+def bench_csv(copies=10, osm_file=SAMPLE_FILE):
+    """Rows/sec of the csv writers on copies of the shaped sample"""
+    from osm_io import get_element
+    from preparing_database import shape_elements, element_document
+    from sqlite_loader import element_rows
+    shaped = list(shape_elements(
+        get_element(os.path.join(HERE, osm_file), tags=('node', 'way')),
+        validate=False)) * copies
+    #The legacy writer takes the dict rows the elements used to be shaped to
+    documents = [element_document(el) for el in shaped]
+    rows = sum(len(table_rows) for el in shaped
+               for _, table_rows in element_rows(el))
+    tmp = tempfile.mkdtemp()
+    try:
+        for name, write, data in (('legacy', legacy_write, documents),
+                                  ('csv', csv_write, shaped)):
+            start = time.time()
+            write(data, tmp)
+            elapsed = time.time() - start
+            print("%-8s %10d rows %8.3f s %12.0f rows/s" %
+                  (name, rows, elapsed, rows / elapsed))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_columnar(copies=10, row_group_size=1000, osm_file=SAMPLE_FILE):
+    """
+        process_map time, size and batches of the Parquet and Arrow outputs
+        with row groups of `row_group_size` rows, so the big tables span
+        many batches; both are read back and must hold the same rows.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from preparing_database import process_map
+    tmp = tempfile.mkdtemp()
+    try:
+        big_file = os.path.join(tmp, 'x%d.osm' % copies)
+        replicate_osm(os.path.join(HERE, osm_file), copies, big_file)
+        tables = {}
+        for file_format in ('parquet', 'arrow'):
+            out_dir = os.path.join(tmp, file_format)
+            start = time.time()
+            process_map(big_file, validate=True, output=file_format,
+                        out_dir=out_dir, row_group_size=row_group_size)
+            elapsed = time.time() - start
+            size = batches = 0
+            for name in sorted(os.listdir(out_dir)):
+                path = os.path.join(out_dir, name)
+                size += os.path.getsize(path)
+                if file_format == 'parquet':
+                    batches += pq.ParquetFile(path).num_row_groups
+                    table = pq.read_table(path)
+                else:
+                    reader = pa.ipc.open_file(path)
+                    batches += reader.num_record_batches
+                    table = reader.read_all()
+                tables.setdefault(name.rsplit('.', 1)[0], []).append(table)
+            print("%-8s %8.3f s %10d bytes %6d batches" %
+                  (file_format, elapsed, size, batches))
+        for name, (parquet, arrow) in sorted(tables.items()):
+            #Decoded values: the two formats encode their dictionaries apart
+            if parquet.to_pylist() != arrow.to_pylist():
+                raise AssertionError("%s: Arrow rows differ from Parquet"
+                                     % name)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_cache(copies=10, osm_file=SAMPLE_FILE):
+    """
+        Per-tag cost of the cleaning rules with and without the normalizer
+        caches, on the cleanable tags of the sample repeated `copies` times
+        (values repeat across a full extract much like they do here).
+    """
+    from osm_io import get_element
+    from cleaning_rules import CLEANING_RULES
+    from normalize_cache import set_cache_size, cache_stats, CACHE_SIZE
+    tags = [(tag.get('k'), tag.get('v'))
+            for element in get_element(os.path.join(HERE, osm_file))
+            for tag in element.iter('tag')
+            if CLEANING_RULES.table.get(tag.get('k'), (None, None))[1]]
+    tags = tags * copies
+    clean = CLEANING_RULES.clean
+    for size in (0, CACHE_SIZE):
+        set_cache_size(size)
+        start = time.time()
+        for key, value in tags:
+            clean(key, value)
+        elapsed = time.time() - start
+        hits = sum(stats['hits'] for stats in cache_stats().values())
+        print("cache size %6d: %d tags, %.3f us/tag, %d hits" %
+              (size, len(tags), elapsed * 1e6 / len(tags), hits))
+
+
+def bench_relations(copies=10, osm_file=SAMPLE_FILE):
+    """
+        Wall time and peak RSS of process_map on `copies` copies of the
+        sample, converting nodes and ways only vs relations as well.
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        big_file = os.path.join(tmp, 'x%d.osm' % copies)
+        replicate_osm(os.path.join(HERE, osm_file), copies, big_file)
+        code = ("import preparing_database as p\n"
+                "p.process_map({path!r}, validate=True, out_dir={out!r}, "
+                "relations={relations})")
+        for relations in (False, True):
+            start = time.time()
+            rss = peak_rss(code.format(path=big_file, out=tmp,
+                                       relations=relations))
+            elapsed = time.time() - start
+            print("relations=%-5s %8.3f s %10d kB peak RSS" %
+                  (relations, elapsed, rss))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_parse(copies=10, parsers=('etree', 'expat', 'lxml'),
+                osm_file=SAMPLE_FILE):
+    """MB/s and elements/s of each osm_io parser backend"""
+    from osm_io import get_element
+    tmp = tempfile.mkdtemp()
+    try:
+        big_file = os.path.join(tmp, 'x%d.osm' % copies)
+        replicate_osm(os.path.join(HERE, osm_file), copies, big_file)
+        megabytes = os.path.getsize(big_file) / 1e6
+        for parser in parsers:
+            start = time.time()
+            count = 0
+            for _ in get_element(big_file, parser=parser):
+                count += 1
+            elapsed = time.time() - start
+            print("%-6s %8.3f s %8.1f MB/s %10.0f elements/s" %
+                  (parser, elapsed, megabytes / elapsed, count / elapsed))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_records(copies=10, module='preparing_database',
+                  osm_file=SAMPLE_FILE):
+    """
+        Peak traced memory of holding every shaped element of `copies`
+        copies of the sample, and shape_element time per element. Pass the
+        name of a saved copy of an older preparing_database (e.g. the dict
+        based one) to compare.
+    """
+    from osm_io import get_element
+    shape_element = importlib.import_module(module).shape_element
+    elements = list(get_element(os.path.join(HERE, osm_file))) * copies
+    start = time.time()
+    for element in elements:
+        shape_element(element)
+    elapsed = time.time() - start
+    tracemalloc.start()
+    try:
+        shaped = [shape_element(element) for element in elements]
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    print("%s: %d elements, %.2f us/element, %.1f MB held, %.0f B/element" %
+          (module, len(shaped), elapsed * 1e6 / len(shaped), size / 1e6,
+           size / float(len(shaped))))
+
+
+def bench_sample(copies=10, workers=1, osm_file=SAMPLE_FILE):
+    """MB/s of each sampling mode on `copies` copies of the sample"""
+    import sampling
+    tmp = tempfile.mkdtemp()
+    try:
+        big_file = os.path.join(tmp, 'x%d.osm' % copies)
+        replicate_osm(os.path.join(HERE, osm_file), copies, big_file)
+        megabytes = os.path.getsize(big_file) / 1e6
+        modes = [('every', {}), ('reservoir', {'size': 1000}),
+                 ('grid', {'size': 10,
+                           'bbox': (-23.1157, -43.7997, -22.7129, -43.0959)})]
+        for mode, options in modes:
+            start = time.time()
+            counts = sampling.sample(big_file, os.path.join(tmp, 'out.osm'),
+                                     mode, workers=workers,
+                                     chunk_size=1024 * 1024, **options)
+            elapsed = time.time() - start
+            print("%-9s %8.3f s %8.1f MB/s %8d elements" %
+                  (mode, elapsed, megabytes / elapsed, sum(counts.values())))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_spatial(copies=10, osm_file=SAMPLE_FILE):
+    """
+        Bbox and radius query time with the rtree index vs a full scan of
+        the nodes table, on a database of `copies` copies of the sample.
+    """
+    import sqlite3
+    from preparing_database import process_map
+    from spatial_index import SpatialIndex
+    from geometry import haversine
+    tmp = tempfile.mkdtemp()
+    try:
+        big_file = os.path.join(tmp, 'x%d.osm' % copies)
+        replicate_osm(os.path.join(HERE, osm_file), copies, big_file,
+                      shift=True)
+        db_path = os.path.join(tmp, 'x.db')
+        process_map(big_file, validate=False, output='sqlite',
+                    db_path=db_path, spatial_index=True)
+        bbox = (-22.925, -43.205, -22.915, -43.195)
+        point = (-22.92, -43.20, 1000)
+        connection = sqlite3.connect(db_path)
+        with SpatialIndex(db_path) as index:
+            queries = [
+                ('bbox rtree', lambda: index.bbox(*bbox)),
+                ('bbox scan', lambda: connection.execute(
+                    "SELECT id FROM nodes WHERE lat BETWEEN ? AND ? AND "
+                    "lon BETWEEN ? AND ?",
+                    (bbox[0], bbox[2], bbox[1], bbox[3])).fetchall()),
+                ('radius rtree', lambda: index.radius(*point)),
+                ('radius scan', lambda: [
+                    row for row in connection.execute(
+                        "SELECT id, lat, lon FROM nodes")
+                    if haversine(point[0], point[1], row[1], row[2])
+                    <= point[2]]),
+            ]
+            for name, query in queries:
+                timer = timeit.Timer(query)
+                number, _ = timer.autorange()
+                best = min(timer.repeat(repeat=3, number=number)) / number
+                print("%-13s %10.3f ms %8d results" %
+                      (name, best * 1e3, len(query())))
+        connection.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_clip(copies=10, vertices=2000, osm_file=SAMPLE_FILE):
+    """
+        Point-in-polygon cost per node (numpy batches vs plain Python) and
+        process_map time with and without clipping, for a polygon of
+        `vertices` vertices around the centre of Rio.
+    """
+    import math
+    import clipping
+    from osm_io import get_element
+    from preparing_database import process_map
+    center_lat, center_lon = -22.92, -43.25
+    ring = [(center_lat + 0.08 * math.sin(2 * math.pi * i / vertices) *
+             (1 + 0.2 * math.sin(7 * 2 * math.pi * i / vertices)),
+             center_lon + 0.15 * math.cos(2 * math.pi * i / vertices))
+            for i in range(vertices)]
+    area = clipping.ClipArea([ring])
+    nodes = list(get_element(os.path.join(HERE, osm_file),
+                             tags=('node',))) * copies
+    lats = [float(node.get('lat')) for node in nodes]
+    lons = [float(node.get('lon')) for node in nodes]
+    numpy = clipping.np
+    for name in ('numpy', 'python'):
+        if name == 'numpy' and numpy is None:
+            continue
+        clipping.np = numpy if name == 'numpy' else None
+        try:
+            start = time.time()
+            inside = sum(area.contains(lats, lons))
+            elapsed = time.time() - start
+        finally:
+            clipping.np = numpy
+        print("%-7s %8.2f us/node %8d of %d inside" %
+              (name, elapsed * 1e6 / len(lats), inside, len(lats)))
+    tmp = tempfile.mkdtemp()
+    try:
+        big_file = os.path.join(tmp, 'x%d.osm' % copies)
+        replicate_osm(os.path.join(HERE, osm_file), copies, big_file)
+        for clip in (None, area):
+            start = time.time()
+            process_map(big_file, validate=True, out_dir=tmp, clip=clip)
+            elapsed = time.time() - start
+            size = sum(os.path.getsize(os.path.join(tmp, name))
+                       for name in os.listdir(tmp) if name.endswith('.csv'))
+            print("clip=%-5s %8.3f s %10d bytes of csv" %
+                  (clip is not None, elapsed, size))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_batch(copies=100, osm_file=SAMPLE_FILE):
+    """
+        Per-value cost of the phone and postcode normalizers: one at a time
+        (without and with the cache) vs the batch versions, on the values of
+        the sample repeated `copies` times. Checks the results are equal.
+        Then the phone normalizers on blocks of distinct made up numbers,
+        by block size: the batch version only wins on large blocks, so
+        smaller ones go through the cached scalar (BATCH_MIN).
+    """
+    import random
+    from osm_io import get_element
+    from rules_config import RULES
+    from normalize_cache import set_cache_size, CACHE_SIZE
+    from Clean_Phone_Numbers import (update_phone, update_phone_batch,
+                                     classify_phones, PHONE_TABLE,
+                                     PHONE_FORMATS, BATCH_MIN)
+    from Clean_Postal_Codes import update_postal, update_postal_batch
+    values = {'phone': [], 'postcode': []}
+    for element in get_element(os.path.join(HERE, osm_file)):
+        for tag in element.iter('tag'):
+            if tag.get('k') in RULES['phone_keys']:
+                values['phone'].append(tag.get('v'))
+            elif tag.get('k') in RULES['postal_keys']:
+                values['postcode'].append(tag.get('v'))
+    normalizers = {'phone': (update_phone, update_phone_batch),
+                   'postcode': (update_postal, update_postal_batch)}
+
+    def timed(func):
+        start = time.time()
+        result = func()
+        return time.time() - start, result
+
+    for name, (scalar, batch) in sorted(normalizers.items()):
+        block = values[name] * copies
+        set_cache_size(0)
+        scalar_time, expected = timed(lambda: [scalar(value) for value in block])
+        set_cache_size(CACHE_SIZE)
+        cached_time, _ = timed(lambda: [scalar(value) for value in block])
+        batch_time, result = timed(lambda: batch(block))
+        print("%-8s %7d values  scalar %.3f  cached %.3f  batch %.3f "
+              "us/value  same=%s" % (
+                  name, len(block), scalar_time * 1e6 / len(block),
+                  cached_time * 1e6 / len(block),
+                  batch_time * 1e6 / len(block), result == expected))
+
+    def vectorised(spells):
+        #update_phone_batch without the BATCH_MIN shortcut
+        cleaned = [spell.translate(PHONE_TABLE).replace('ou', ';')
+                   for spell in spells]
+        return [PHONE_FORMATS[kind](spell) if kind else ''
+                for spell, kind in zip(cleaned, classify_phones(cleaned))]
+
+    rng = random.Random(0)
+    formats = ['(21) %04d-%04d', '+55 21 9%04d-%04d', '%04d-%04d',
+               '021 %04d %04d']
+    for size in (16, 128, BATCH_MIN, 4096, 32768):
+        block = list(set(rng.choice(formats) % (rng.randrange(10000),
+                                                rng.randrange(10000))
+                         for _ in range(size)))
+        repeat = max(1, 32768 // len(block))
+        scalar_time = vector_time = 0.0
+        for _ in range(repeat):
+            #Distinct values: the cache cannot help the scalar version
+            set_cache_size(CACHE_SIZE)
+            elapsed, expected = timed(lambda: [update_phone(value)
+                                               for value in block])
+            scalar_time += elapsed
+            elapsed, result = timed(lambda: vectorised(block))
+            vector_time += elapsed
+        count = len(block) * repeat
+        print("phone %6d distinct  scalar %.3f  vectorised %.3f us/value  "
+              "same=%s" % (len(block), scalar_time * 1e6 / count,
+                           vector_time * 1e6 / count, result == expected))
+
+
+def bench_compressed(copies=10, threads=None, osm_file=SAMPLE_FILE):
+    """
+        Parse time of the replicated sample, plain and compressed (gzip,
+        bzip2 in one stream and in 900 kB streams like pbzip2, zstd when
+        installed), next to the time to only decompress it.
+    """
+    import bz2
+    import gzip
+    from osm_io import get_element, open_osm, zstandard
+    tmp = tempfile.mkdtemp()
+    try:
+        big_file = os.path.join(tmp, 'x%d.osm' % copies)
+        replicate_osm(os.path.join(HERE, osm_file), copies, big_file)
+        with open(big_file, 'rb') as f:
+            data = f.read()
+        megabytes = len(data) / 1e6
+        variants = [('plain', big_file, None)]
+        compressed = [('gz', 'x.osm.gz', gzip.compress),
+                      ('bz2', 'x.osm.bz2', bz2.compress),
+                      ('bz2-multi', 'xm.osm.bz2', lambda raw: b''.join(
+                          bz2.compress(raw[i:i + 900000])
+                          for i in range(0, len(raw), 900000)))]
+        if zstandard is not None:
+            compressed.append(('zst', 'x.osm.zst',
+                               zstandard.ZstdCompressor().compress))
+        for name, path, compress in compressed:
+            path = os.path.join(tmp, path)
+            with open(path, 'wb') as f:
+                f.write(compress(data))
+            variants.append((name, path, compress))
+        for name, path, _ in variants:
+            start = time.time()
+            with open_osm(path, threads) as f:
+                while f.read(1024 * 1024):
+                    pass
+            read_time = time.time() - start
+            start = time.time()
+            count = sum(1 for _ in get_element(path))
+            parse_time = time.time() - start
+            print("%-10s %8.1f MB  read %7.3f s  parse %7.3f s %8.1f MB/s "
+                  "%10d elements" % (name, os.path.getsize(path) / 1e6,
+                                     read_time, parse_time,
+                                     megabytes / parse_time, count))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_pbf(copies=10, workers=2, osm_file=SAMPLE_FILE):
+    """
+        Elements/s of the replicated sample read as XML (etree and expat)
+        and as PBF, and the file sizes; then the process_map time of the PBF
+        serially and with `workers` processes (which decode and shape their
+        byte ranges and send back rows).
+    """
+    from osm_io import get_element
+    from pbf import write_pbf, get_element_pbf
+    from preparing_database import process_map
+    tmp = tempfile.mkdtemp()
+    try:
+        big_file = os.path.join(tmp, 'x%d.osm' % copies)
+        replicate_osm(os.path.join(HERE, osm_file), copies, big_file)
+        pbf_file = os.path.join(tmp, 'x%d.osm.pbf' % copies)
+        write_pbf(get_element(big_file), pbf_file)
+        runs = [('xml etree', big_file, lambda: get_element(big_file)),
+                ('xml expat', big_file,
+                 lambda: get_element(big_file, parser='expat')),
+                ('pbf', pbf_file, lambda: get_element_pbf(pbf_file))]
+        for name, path, elements in runs:
+            start = time.time()
+            count = sum(1 for _ in elements())
+            elapsed = time.time() - start
+            print("%-10s %8.1f MB %8.3f s %10.0f elements/s" % (
+                name, os.path.getsize(path) / 1e6, elapsed, count / elapsed))
+        times = {}
+        for n in sorted({1, workers}):
+            start = time.time()
+            process_map(pbf_file, validate=True, workers=n, out_dir=tmp)
+            times[n] = time.time() - start
+            print("process_map pbf x%-3d %8.3f s %6.2fx" % (
+                n, times[n], times[1] / times[n]))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_streets(names=20000, lookups=2000, seed=0, osm_file=SAMPLE_FILE):
+    """
+        Street index lookups on `names` streets made from the words of the
+        sample's street names and made up ones: time per lookup and share
+        mapped back to the right street, for exact, abbreviated, unaccented
+        and misspelled values (the rest is kept as is or goes to another
+        street), next to a scan scoring every key.
+    """
+    import random
+    from osm_io import get_element
+    from street_index import StreetIndex, WORD, plain, trigrams
+    rng = random.Random(seed)
+    words = set()
+    for element in get_element(os.path.join(HERE, osm_file)):
+        for tag in element.iter('tag'):
+            if tag.get('k') == 'addr:street':
+                words.update(word for word in WORD.findall(tag.get('v'))
+                             if len(word) > 3 and word[0].isupper())
+    #A city has thousands of distinct words in its street names, not the
+    #few hundred of the sample: made up surnames fill in the rest
+    syllables = [consonant + vowel for consonant in 'bcdfglmnprstv'
+                 for vowel in 'aeiou']
+    while len(words) < names // 4:
+        words.add(''.join(rng.choice(syllables) for _ in
+                          range(rng.randint(2, 4))).capitalize())
+    words = sorted(words)
+    titles = ['', 'General ', 'Presidente ', 'Doutor ', 'Professor ',
+              'Nossa Senhora ', 'Santa ']
+    streets = set()
+    while len(streets) < names:
+        streets.add('%s %s%s %s' % (rng.choice(['Rua', 'Avenida', 'Estrada']),
+                                    rng.choice(titles), rng.choice(words),
+                                    rng.choice(words)))
+    streets = sorted(streets)
+    start = time.time()
+    index = StreetIndex()
+    for street in streets:
+        index.add(street, rng.randint(1, 20))
+    print("build %d streets: %.3f s" % (len(index), time.time() - start))
+
+    def abbreviated(street):
+        for full, short in (('Rua ', 'R. '), ('Avenida ', 'Av. '),
+                            ('Estrada ', 'Estr. '), ('Doutor ', 'Dr. '),
+                            ('Nossa Senhora ', 'N. S. '),
+                            ('General ', 'Gen. ')):
+            street = street.replace(full, short)
+        return street
+
+    def misspelled(street):
+        i = rng.randrange(street.index(' ') + 2, len(street))
+        return street[:i] + street[i + 1:]
+
+    unaccented = lambda street: plain(street).title()
+    sample = rng.sample(streets, min(lookups, len(streets)))
+    for name, variant in (('exact', lambda street: street),
+                          ('abbreviated', abbreviated),
+                          ('unaccented', unaccented),
+                          ('misspelled', misspelled)):
+        values = [variant(street) for street in sample]
+        start = time.time()
+        found = [index.canonical(value) for value in values]
+        elapsed = time.time() - start
+        right = sum(1 for street, value in zip(sample, found)
+                    if value == street)
+        kept = sum(1 for street, value, canonical in
+                   zip(sample, values, found)
+                   if canonical == value != street)
+        print("%-12s %8.1f us/lookup %6.1f%% right %6.1f%% kept as is" % (
+            name, elapsed * 1e6 / len(values), 100.0 * right / len(values),
+            100.0 * kept / len(values)))
+    #Scoring every key, as a pairwise comparison would
+    values = [misspelled(street) for street in sample[:50]]
+    start = time.time()
+    for value in values:
+        grams = trigrams(index.folder.fold(value)[0])
+        max(range(len(index)), key=lambda i: 2.0 * len(grams & index.grams[i])
+            / (len(grams) + len(index.grams[i])))
+    elapsed = time.time() - start
+    print("%-12s %8.1f us/lookup" % ('full scan', elapsed * 1e6 / len(values)))
+
+
+# ================================================== #
+#               Stage suite                          #
+# ================================================== #
+def default_stages():
+    """Every stage that can run with the installed packages"""
+    #Only looked up: importing them here would count in the peak RSS the
+    #stage processes start from
+    stages = ['parse:etree', 'parse:expat']
+    if importlib.util.find_spec('lxml') is not None:
+        stages.append('parse:lxml')
+    stages += ['shape', 'normalize:street', 'normalize:postcode',
+               'normalize:phone', 'validate', 'write:csv', 'write:sqlite']
+    if importlib.util.find_spec('pyarrow') is not None:
+        stages.append('write:parquet')
+    return stages
+
+
+def run_stage(stage, osm_file, tmp):
+    """
+        Runs one stage on osm_file and times only that stage's calls.
+        Stages: parse:<parser>, shape, normalize:<name>, validate and
+        write:<output>. Returns: (seconds, items handled)
+    """
+    from osm_io import get_element
+    kind, _, variant = stage.partition(':')
+    clock = time.perf_counter
+    if kind == 'parse':
+        start = clock()
+        count = sum(1 for _ in get_element(osm_file, parser=variant))
+        return clock() - start, count
+
+    from preparing_database import (shape_element, validate_element,
+                                    open_output, SCHEMA)
+    from schema_validator import SchemaValidator
+    elapsed = 0.0
+    count = 0
+    if kind == 'shape':
+        for element in get_element(osm_file):
+            start = clock()
+            shape_element(element)
+            elapsed += clock() - start
+            count += 1
+    elif kind == 'normalize':
+        from cleaning_rules import CLEANING_RULES
+        from normalize_cache import NORMALIZERS
+        normalizer = NORMALIZERS[variant]
+        keys = set(key for key, (_, cleaner) in CLEANING_RULES.table.items()
+                   if cleaner is normalizer)
+        for element in get_element(osm_file):
+            for tag in element.iter('tag'):
+                if tag.get('k') in keys:
+                    value = tag.get('v')
+                    start = clock()
+                    normalizer(value)
+                    elapsed += clock() - start
+                    count += 1
+    elif kind == 'validate':
+        validator = SchemaValidator(SCHEMA)
+        for element in get_element(osm_file):
+            el = shape_element(element)
+            start = clock()
+            validate_element(el, validator)
+            elapsed += clock() - start
+            count += 1
+    elif kind == 'write':
+        out = open_output(variant, db_path=os.path.join(tmp, 'stage.db'),
+                          out_dir=tmp)
+        start = clock()
+        out.__enter__()
+        elapsed += clock() - start
+        try:
+            for element in get_element(osm_file):
+                el = shape_element(element)
+                start = clock()
+                out.write(el)
+                elapsed += clock() - start
+                count += 1
+        finally:
+            start = clock()
+            out.__exit__(None, None, None)
+            elapsed += clock() - start
+    else:
+        raise ValueError("unknown stage: %r" % (stage,))
+    return elapsed, count
+
+
+def bench_stage(stage, osm_file):
+    """Runs one stage in this process and prints its metrics as JSON"""
+    import resource
+    tmp = tempfile.mkdtemp()
+    try:
+        seconds, count = run_stage(stage, osm_file, tmp)
+    finally:
+        shutil.rmtree(tmp)
+    print(json.dumps({'seconds': seconds, 'count': count,
+                      'peak_rss_kb': resource.getrusage(
+                          resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(osm_file=None, size=None, seed=0, stages=None,
+                json_file=None, tag_density=None, way_length=None, mix=None):
+    """
+        Times every stage on osm_file, or on a synthetic file of `size`
+        bytes made with `seed` (and the tag_density, way_length and mix of
+        synthetic_osm.SyntheticOsm, its defaults when None). Each stage
+        runs in a fresh interpreter so its peak RSS is its own. MB/s is only
+        reported for the stages that handle the whole file, parse and write.
+        Returns: the report (also written to json_file if given)
+    """
+    import synthetic_osm
+    stages = stages or default_stages()
+    tmp = tempfile.mkdtemp()
+    try:
+        meta = {'commit': _commit(), 'python': platform.python_version(),
+                'platform': platform.platform(), 'time': time.time()}
+        if osm_file is None:
+            options = dict((name, value) for name, value in
+                           (('tag_density', tag_density),
+                            ('way_length', way_length), ('mix', mix))
+                           if value is not None)
+            generator = synthetic_osm.SyntheticOsm(seed, **options)
+            osm_file = os.path.join(tmp, 'synthetic.osm')
+            meta['synthetic'] = dict(generator.options(),
+                                     size=size or synthetic_osm.SIZE)
+            meta['elements'] = generator.write(osm_file,
+                                               size or synthetic_osm.SIZE)
+        else:
+            osm_file = os.path.abspath(osm_file)
+            meta['osm_file'] = osm_file
+        megabytes = os.path.getsize(osm_file) / 1e6
+        meta['bytes'] = os.path.getsize(osm_file)
+        results = {}
+        print("%-20s %10s %14s %10s %12s" %
+              ('stage', 'seconds', 'items/s', 'MB/s', 'peak RSS kB'))
+        for stage in stages:
+            output = subprocess.check_output(
+                [sys.executable, os.path.join(HERE, 'benchmark.py'), 'stage',
+                 stage, osm_file], cwd=HERE)
+            metrics = json.loads(output.decode().strip().split('\n')[-1])
+            seconds = metrics['seconds'] or 1e-9
+            #The other stages only time their own calls on part of the file
+            whole_file = stage.partition(':')[0] in ('parse', 'write')
+            results[stage] = {
+                'seconds': metrics['seconds'],
+                'items': metrics['count'],
+                'items_per_s': metrics['count'] / seconds,
+                'mb_per_s': megabytes / seconds if whole_file else None,
+                'peak_rss_kb': metrics['peak_rss_kb'],
+            }
+            print("%-20s %10.3f %14.0f %10s %12d" % (
+                stage, metrics['seconds'], results[stage]['items_per_s'],
+                '%.1f' % results[stage]['mb_per_s'] if whole_file else '-',
+                metrics['peak_rss_kb']))
+    finally:
+        shutil.rmtree(tmp)
+    report = {'meta': meta, 'stages': results}
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def bench_compare(old_file, new_file, threshold=0.1):
+    """
+        Compares the items/s of two suite reports.
+        Returns: True if no stage got slower by more than threshold
+    """
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print("%-20s %14s %14s %8s" % ('stage', 'old items/s', 'new items/s',
+                                   'ratio'))
+    ok = True
+    for stage in sorted(set(old['stages']) & set(new['stages'])):
+        before = old['stages'][stage]['items_per_s']
+        after = new['stages'][stage]['items_per_s']
+        ratio = after / before if before else float('inf')
+        slower = ratio < 1 - threshold
+        ok = ok and not slower
+        print("%-20s %14.0f %14.0f %8.2f%s" % (stage, before, after, ratio,
+                                               '  SLOWER' if slower else ''))
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    sub = parser.add_subparsers(dest='command')
+    memory = sub.add_parser('memory', help='peak RSS of the audits, 1x vs Nx')
+    memory.add_argument('--copies', type=int, default=10)
+    memory.add_argument('--max-ratio', type=float, default=1.5)
+    ways = sub.add_parser('ways', help='shape_element time vs way length')
+    ways.add_argument('--sizes', default='10,1000,50000')
+    shape = sub.add_parser('shape', help='shape_element cost per element')
+    shape.add_argument('--module', default='preparing_database')
+    csv_parser = sub.add_parser('csv', help='csv writer throughput')
+    csv_parser.add_argument('--copies', type=int, default=10)
+    columnar = sub.add_parser('columnar',
+                              help='Parquet and Arrow outputs, many batches')
+    columnar.add_argument('--copies', type=int, default=10)
+    columnar.add_argument('--row-group-size', type=int, default=1000)
+    cache = sub.add_parser('cache', help='normalizer cost with/without cache')
+    cache.add_argument('--copies', type=int, default=10)
+    relations = sub.add_parser('relations',
+                               help='process_map cost of converting relations')
+    relations.add_argument('--copies', type=int, default=10)
+    parse = sub.add_parser('parse', help='throughput of the parser backends')
+    parse.add_argument('--copies', type=int, default=10)
+    parse.add_argument('--parsers', default='etree,expat,lxml')
+    records = sub.add_parser('records',
+                             help='memory and time of the shaped records')
+    records.add_argument('--copies', type=int, default=10)
+    records.add_argument('--module', default='preparing_database')
+    sample = sub.add_parser('sample', help='throughput of the sampling modes')
+    sample.add_argument('--copies', type=int, default=10)
+    sample.add_argument('--workers', type=int, default=1)
+    spatial = sub.add_parser('spatial', help='rtree queries vs full scans')
+    spatial.add_argument('--copies', type=int, default=10)
+    clip = sub.add_parser('clip', help='cost and effect of clipping')
+    clip.add_argument('--copies', type=int, default=10)
+    clip.add_argument('--vertices', type=int, default=2000)
+    batch = sub.add_parser('batch', help='batch vs scalar normalizers')
+    batch.add_argument('--copies', type=int, default=100)
+    compressed = sub.add_parser('compressed',
+                                help='parse time of compressed inputs')
+    compressed.add_argument('--copies', type=int, default=10)
+    compressed.add_argument('--threads', type=int, default=None)
+    pbf = sub.add_parser('pbf', help='PBF vs XML read throughput')
+    pbf.add_argument('--copies', type=int, default=10)
+    pbf.add_argument('--workers', type=int, default=2)
+    streets = sub.add_parser('streets', help='street index lookups')
+    streets.add_argument('--names', type=int, default=20000)
+    streets.add_argument('--lookups', type=int, default=2000)
+    suite = sub.add_parser('suite', help='time every pipeline stage')
+    suite.add_argument('--osm-file', help='default: a synthetic file')
+    suite.add_argument('--size', default=None,
+                       help='size of the synthetic file, e.g. 2.8MB or 1GB')
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--tag-density', type=float,
+                       help='share of synthetic nodes with tags')
+    suite.add_argument('--way-length', type=float,
+                       help='mean number of nodes per synthetic way')
+    suite.add_argument('--mix', help='synthetic tag kind weights, e.g. '
+                                     'phone=1,postcode=2,street=3,other=10')
+    suite.add_argument('--stages', help='comma separated, default: all')
+    suite.add_argument('--json', dest='json_file',
+                       help='write the results to this file')
+    stage = sub.add_parser('stage', help='run one suite stage (internal)')
+    stage.add_argument('stage')
+    stage.add_argument('osm_file')
+    compare = sub.add_parser('compare', help='compare two suite reports')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'memory':
+        return 0 if bench_memory(args.copies, args.max_ratio) else 1
+    if args.command == 'ways':
+        bench_ways([int(size) for size in args.sizes.split(',')])
+        return 0
+    if args.command == 'shape':
+        bench_shape(args.module)
+        return 0
+    if args.command == 'csv':
+        bench_csv(args.copies)
+        return 0
+    if args.command == 'columnar':
+        bench_columnar(args.copies, args.row_group_size)
+        return 0
+    if args.command == 'cache':
+        bench_cache(args.copies)
+        return 0
+    if args.command == 'relations':
+        bench_relations(args.copies)
+        return 0
+    if args.command == 'parse':
+        bench_parse(args.copies, args.parsers.split(','))
+        return 0
+    if args.command == 'records':
+        bench_records(args.copies, args.module)
+        return 0
+    if args.command == 'sample':
+        bench_sample(args.copies, args.workers)
+        return 0
+    if args.command == 'spatial':
+        bench_spatial(args.copies)
+        return 0
+    if args.command == 'clip':
+        bench_clip(args.copies, args.vertices)
+        return 0
+    if args.command == 'batch':
+        bench_batch(args.copies)
+        return 0
+    if args.command == 'compressed':
+        bench_compressed(args.copies, args.threads)
+        return 0
+    if args.command == 'pbf':
+        bench_pbf(args.copies, args.workers)
+        return 0
+    if args.command == 'streets':
+        bench_streets(args.names, args.lookups)
+        return 0
+    if args.command == 'suite':
+        from synthetic_osm import parse_size, parse_mix
+        if args.osm_file and (args.size or args.tag_density is not None or
+                              args.way_length is not None or args.mix):
+            parser.error("--size, --tag-density, --way-length and --mix are "
+                         "for the synthetic file, not --osm-file")
+        bench_suite(args.osm_file, args.size and parse_size(args.size),
+                    args.seed, args.stages and args.stages.split(','),
+                    args.json_file, args.tag_density, args.way_length,
+                    args.mix and parse_mix(args.mix))
+        return 0
+    if args.command == 'stage':
+        bench_stage(args.stage, args.osm_file)
+        return 0
+    if args.command == 'compare':
+        return 0 if bench_compare(args.old, args.new, args.threshold) else 1
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Checkpoints of long process_map runs, and the file of rejected elements.
+
+With checkpoints on, process_map converts the file chunk by chunk (the
+byte ranges of find_chunks, or stream_chunks for compressed files) and,
+after each chunk, flushes the csv files and records how many chunks are
+done, the input byte offset, the last element written and the size of
+every output file. A resumed run truncates the outputs back to those
+sizes, so rows written after the last checkpoint are dropped instead of
+duplicated, and goes on with the next chunk.
+
+Usage:
+    python preparing_database.py rj_map.osm --checkpoint
+    python preparing_database.py rj_map.osm --resume [--skip-invalid]
+"""
+import json
+import os
+
+CHECKPOINT_PATH = "process_map.checkpoint.json"
+REJECTS_PATH = "rejects.jsonl"
+
+
+class Checkpoint(object):
+    """
+        The checkpoint file of a run, rewritten atomically after each chunk.
+        Args:
+            path: the checkpoint file
+            options: what must not change between a run and its resume
+                (input file, size, chunk size, ...)
+    """
+
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+
+    def load(self):
+        """
+            Returns the state saved by the interrupted run.
+            Raises ValueError if there is none or it is for other options.
+        """
+        if not os.path.exists(self.path):
+            raise ValueError("no checkpoint to resume from: %s" % self.path)
+        with open(self.path) as f:
+            state = json.load(f)
+        if state['options'] != self.options:
+            changed = sorted(key for key in set(self.options) |
+                             set(state['options'])
+                             if self.options.get(key) !=
+                             state['options'].get(key))
+            raise ValueError("the checkpoint in %s was made with other %s"
+                             % (self.path, ', '.join(changed)))
+        return state
+
+    def save(self, chunks, offset, last, sizes, rejects):
+        """
+            Records chunks done, the input offset reached, the (tag, id) of
+            the last element written and the output file sizes.
+        """
+        state = {'options': self.options, 'chunks': chunks, 'offset': offset,
+                 'last': last, 'sizes': sizes, 'rejects': rejects}
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+
+    def remove(self):
+        """Deletes the checkpoint once the run is complete"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def truncate(path, size):
+    """Cuts a file back to the size it had at a checkpoint"""
+    if os.path.getsize(path) < size:
+        raise ValueError("%s is shorter than at the checkpoint" % path)
+    os.truncate(path, size)
+
+
+class RejectLog(object):
+    """
+        JSON lines file of the elements that could not be shaped or did not
+        validate: their type, id, errors and, when shaped, the document
+        that was validated. append() takes the dicts made by reject_record.
+        Args:
+            path: the file, replaced unless size is given
+            size: resume after the first size bytes of the file
+    """
+
+    def __init__(self, path=REJECTS_PATH, size=None):
+        self.path = path
+        if size is None:
+            self.file = open(path, 'w', encoding='utf-8')
+        else:
+            truncate(path, size)
+            self.file = open(path, 'a', encoding='utf-8')
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, record):
+        self.file.write(json.dumps(record, sort_keys=True, default=str) + '\n')
+        self.count += 1
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def flush(self):
+        """Flushes the file and returns its size"""
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
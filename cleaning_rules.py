@@ -0,0 +1,115 @@
+"""
+Dispatch table of the cleaning rules, keyed by tag key.
+
+The table is compiled once from the rules data so cleaning a tag costs one
+dict lookup instead of rebuilding the mappings and running a chain of ifs.
+"""
+from rules_config import RULES
+from Update_Street_Types import update_name
+from Clean_Postal_Codes import update_postal, update_postal_batch
+from Clean_Phone_Numbers import update_phone, update_phone_batch
+from normalize_cache import cached
+from street_index import StreetIndex
+
+
+def make_street_cleaner(mapping, name="street", street_index=None):
+    #Returns a cached cleaner; names without a known type are kept as they
+    #are, so they are cached too instead of raising every time. With a
+    #street_index.StreetIndex, names first go to their canonical spelling
+    def clean_street(value):
+        if street_index is not None:
+            value = street_index.canonical(value)
+        try: #try except was used because of the street names that had no type
+            return update_name(value, mapping)
+        except KeyError:
+            return value
+    return cached(name)(clean_street)
+
+
+class CleaningRules(object):
+    """
+        Compiled cleaning rules.
+        Args:
+            rules: rules dict as loaded by rules_config.load_rules
+            street_index: a street_index.StreetIndex giving the canonical
+                spelling of the street names (optional)
+    """
+
+    def __init__(self, rules=RULES, street_index=None):
+        self.rules = rules
+        self.compile(street_index)
+
+    def compile(self, street_index=None):
+        """(Re)builds the dispatch table, with or without a street index"""
+        rules = self.rules
+        cleaners = {}
+        clean_street = make_street_cleaner(rules['street_types']['mapping'],
+                                           street_index=street_index)
+        for key in rules['street_types']['keys']:
+            cleaners[key] = clean_street
+        for key in rules['postal_keys']:
+            cleaners[key] = update_postal
+        for key in rules['phone_keys']:
+            cleaners[key] = update_phone
+
+        #key -> (key after aliasing, value cleaner or None)
+        self.table = dict((key, (key, cleaner))
+                          for key, cleaner in cleaners.items())
+        for key, alias in rules['key_aliases'].items():
+            self.table[key] = (alias, cleaners.get(alias))
+
+        #Cleaners with a version taking a whole list of values
+        self.batch_cleaners = {update_postal: update_postal_batch,
+                               update_phone: update_phone_batch}
+
+    def clean(self, key, value):
+        """Returns the (key, value) pair of a tag after cleaning"""
+        entry = self.table.get(key)
+        if entry is None:
+            return key, value
+        key, cleaner = entry
+        if cleaner is not None:
+            value = cleaner(value)
+        return key, value
+
+    def clean_many(self, pairs):
+        """
+            Cleans a block of (key, value) pairs, e.g. the tags of a block of
+            elements or the key/value columns of an existing table. The
+            values of each batch cleaner go through it in a single call.
+            Returns: the list of cleaned (key, value) pairs, in order
+        """
+        pairs = list(pairs)
+        cleaned = list(pairs)
+        groups = {}
+        for i, (key, value) in enumerate(pairs):
+            entry = self.table.get(key)
+            if entry is None:
+                continue
+            key, cleaner = entry
+            cleaned[i] = (key, value)
+            if cleaner is not None:
+                groups.setdefault(cleaner, []).append(i)
+        for cleaner, indexes in groups.items():
+            values = [pairs[i][1] for i in indexes]
+            batch = self.batch_cleaners.get(cleaner)
+            if batch is not None:
+                values = batch(values)
+            else:
+                values = [cleaner(value) for value in values]
+            for i, value in zip(indexes, values):
+                cleaned[i] = (cleaned[i][0], value)
+        return cleaned
+
+
+CLEANING_RULES = CleaningRules()
+
+
+def set_street_index(path):
+    """
+    Makes CLEANING_RULES give street names their canonical spelling from the
+    index saved at path, or stop doing it when path is None. The table is
+    rebuilt in place, so shape_element and the pool workers see the change.
+    """
+    street_index = StreetIndex.load(path) if path is not None else None
+    CLEANING_RULES.compile(street_index)
@@ -0,0 +1,354 @@
+"""
+Geographic clipping: drops the elements outside an area while the file is
+parsed, instead of converting them and filtering them out afterwards.
+
+The area is a bbox, a GeoJSON (Multi)Polygon or the boundary relation of
+an .osm file. Nodes are tested in batches of coordinates, with numpy when
+it is installed. A way is kept if one of its nodes was kept, and a
+relation if one of its node or way members (or an earlier relation) was.
+
+Usage:
+    get_element(path, clip=load_area('rio.geojson'))
+    python preparing_database.py rj_map.osm --clip rio.geojson
+    python preparing_database.py rj_map.osm --clip=-23.1,-43.8,-22.7,-43.1
+
+    A bbox starting with "-" goes after "=", or argparse takes it for an
+    option.
+"""
+import json
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from geometry import polygon_bbox
+from osm_io import get_element, NodeIdBitmap
+
+BATCH_SIZE = 4096
+# Edges are bucketed by latitude slab so a point is only tested against
+# the edges crossing its slab
+EDGES_PER_SLAB = 4
+MAX_SLABS = 4096
+
+
+class ClipArea(object):
+    """
+        An area made of rings of (lat, lon) vertices. A point is inside if
+        it is inside an odd number of rings, so holes and several outer
+        rings work without telling them apart.
+        Args:
+            rings: list of rings; the last vertex may repeat the first
+            box_only: the area is exactly its bbox (no polygon test needed)
+    """
+
+    def __init__(self, rings, box_only=False):
+        self.rings = [[(float(lat), float(lon)) for lat, lon in ring]
+                      for ring in rings if ring]
+        if not self.rings:
+            raise ValueError("a clip area needs at least one ring")
+        self.bbox = polygon_bbox([point for ring in self.rings
+                                  for point in ring])
+        self.box_only = box_only
+        self._build_slabs()
+
+    @classmethod
+    def from_bbox(cls, minlat, minlon, maxlat, maxlon):
+        return cls([[(minlat, minlon), (minlat, maxlon), (maxlat, maxlon),
+                     (maxlat, minlon)]], box_only=True)
+
+    @classmethod
+    def from_geojson(cls, geojson):
+        """Area of the (Multi)Polygons of a GeoJSON file, dict or string"""
+        if isinstance(geojson, str):
+            if geojson.lstrip().startswith('{'):
+                geojson = json.loads(geojson)
+            else:
+                with open(geojson) as f:
+                    geojson = json.load(f)
+        rings = []
+        for polygon in _geojson_polygons(geojson):
+            for ring in polygon:
+                #GeoJSON positions are [lon, lat]
+                rings.append([(position[1], position[0]) for position in ring])
+        return cls(rings)
+
+    @classmethod
+    def from_osm(cls, osm_file, relation_id=None):
+        """
+            Area of a boundary (or multipolygon) relation of an .osm file
+            that also holds its member ways and their nodes, e.g. an
+            Overpass export of the relation. The first such relation is
+            used unless relation_id is given.
+        """
+        coords = {}
+        ways = {}
+        relation = None
+        for element in get_element(osm_file):
+            if element.tag == 'node':
+                coords[int(element.get('id'))] = (float(element.get('lat')),
+                                                  float(element.get('lon')))
+            elif element.tag == 'way':
+                ways[int(element.get('id'))] = [int(nd.get('ref'))
+                                                for nd in element.iter('nd')]
+            elif element.tag == 'relation' and relation is None:
+                tags = dict((tag.get('k'), tag.get('v'))
+                            for tag in element.iter('tag'))
+                if (int(element.get('id')) == relation_id or
+                        relation_id is None and
+                        tags.get('type') in ('boundary', 'multipolygon')):
+                    relation = [int(member.get('ref'))
+                                for member in element.iter('member')
+                                if member.get('type') == 'way']
+        if relation is None:
+            raise ValueError("no boundary relation in %s" % (osm_file,))
+        try:
+            rings = _join_rings([ways[way_id] for way_id in relation])
+            return cls([[coords[node_id] for node_id in ring]
+                        for ring in rings])
+        except KeyError as e:
+            raise ValueError("the boundary references %s, which is not in %s"
+                             % (e, osm_file))
+
+    def _build_slabs(self):
+        minlat, _, maxlat, _ = self.bbox
+        edges = []
+        for ring in self.rings:
+            previous = ring[-1]
+            for vertex in ring:
+                if vertex[0] != previous[0]:
+                    edges.append(previous + vertex)
+                previous = vertex
+        count = max(1, min(MAX_SLABS, len(edges) // EDGES_PER_SLAB))
+        self._slab_count = count
+        self._slab_height = (maxlat - minlat) / count or 1.0
+        self._slabs = [[] for _ in range(count)]
+        for edge in edges:
+            low = self._slab(min(edge[0], edge[2]))
+            high = self._slab(max(edge[0], edge[2]))
+            for slab in range(low, high + 1):
+                self._slabs[slab].append(edge)
+        if np is not None:
+            self._slab_arrays = [np.array(slab, dtype=float).reshape(-1, 4).T
+                                 for slab in self._slabs]
+
+    def _slab(self, lat):
+        slab = int((lat - self.bbox[0]) / self._slab_height)
+        return min(max(slab, 0), self._slab_count - 1)
+
+    def contains_point(self, lat, lon):
+        minlat, minlon, maxlat, maxlon = self.bbox
+        if not (minlat <= lat <= maxlat and minlon <= lon <= maxlon):
+            return False
+        if self.box_only:
+            return True
+        inside = False
+        for lat_i, lon_i, lat_j, lon_j in self._slabs[self._slab(lat)]:
+            if ((lat_i > lat) != (lat_j > lat) and
+                    lon < lon_i + (lat - lat_i) * (lon_j - lon_i) /
+                    (lat_j - lat_i)):
+                inside = not inside
+        return inside
+
+    def contains(self, lats, lons):
+        """Returns a list of bools, one per (lat, lon) of the batch"""
+        if np is None:
+            return [self.contains_point(lat, lon)
+                    for lat, lon in zip(lats, lons)]
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        minlat, minlon, maxlat, maxlon = self.bbox
+        inside = ((lats >= minlat) & (lats <= maxlat) &
+                  (lons >= minlon) & (lons <= maxlon))
+        if self.box_only:
+            return inside.tolist()
+        candidates = np.nonzero(inside)[0]
+        if not len(candidates):
+            return inside.tolist()
+        slabs = ((lats[candidates] - minlat) / self._slab_height).astype(int)
+        np.clip(slabs, 0, self._slab_count - 1, out=slabs)
+        order = np.argsort(slabs, kind='stable')
+        candidates = candidates[order]
+        slabs = slabs[order]
+        starts = np.flatnonzero(np.r_[True, slabs[1:] != slabs[:-1]])
+        stops = np.r_[starts[1:], len(slabs)]
+        #Every point of a slab against every edge of the slab at once
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for start, stop in zip(starts, stops):
+                points = candidates[start:stop]
+                lat_i, lon_i, lat_j, lon_j = self._slab_arrays[slabs[start]]
+                lat = lats[points][:, None]
+                lon = lons[points][:, None]
+                crossing = ((lat_i > lat) != (lat_j > lat)) & (
+                    lon < lon_i + (lat - lat_i) * (lon_j - lon_i) /
+                    (lat_j - lat_i))
+                inside[points] = np.count_nonzero(crossing, axis=1) % 2 == 1
+        return inside.tolist()
+
+    def filter(self, elements, batch_size=BATCH_SIZE):
+        """Yields the elements in the area, in order (see Clipper)"""
+        return Clipper(self, batch_size).filter(elements)
+
+    def filter_nodes(self, elements, batch_size=BATCH_SIZE):
+        """
+            Yields the nodes in the area and every other element. This only
+            needs the elements themselves, so byte ranges can be filtered
+            on their own; ways and relations are left to a Clipper.
+        """
+        batch = []
+        for element in elements:
+            if element.tag == 'node':
+                batch.append(element)
+                if len(batch) >= batch_size:
+                    for node in self._inside(batch):
+                        yield node
+                    batch = []
+                continue
+            if batch:
+                for node in self._inside(batch):
+                    yield node
+                batch = []
+            yield element
+        for node in self._inside(batch):
+            yield node
+
+    def _inside(self, nodes):
+        if not nodes:
+            return []
+        lats = [_coordinate(node.get('lat')) for node in nodes]
+        lons = [_coordinate(node.get('lon')) for node in nodes]
+        return [node for node, inside in zip(nodes, self.contains(lats, lons))
+                if inside]
+
+
+def _coordinate(value):
+    #Nodes without coordinates are never inside
+    return float(value) if value is not None else float('nan')
+
+
+class Clipper(object):
+    """
+        Clips a stream of elements in file order (nodes, then ways, then
+        relations), remembering the kept ids so ways and relations can
+        follow their members.
+    """
+
+    def __init__(self, area, batch_size=BATCH_SIZE):
+        self.area = area
+        self.batch_size = batch_size
+        self.kept = dict((tag, NodeIdBitmap())
+                         for tag in ('node', 'way', 'relation'))
+
+    def keep_way(self, way_id, refs):
+        nodes = self.kept['node']
+        if any(ref in nodes for ref in refs):
+            self.kept['way'].add(way_id)
+            return True
+        return False
+
+    def keep_relation(self, relation_id, members):
+        #members: (type, ref) pairs
+        for member_type, ref in members:
+            if ref in self.kept.get(member_type, ()):
+                self.kept['relation'].add(relation_id)
+                return True
+        return False
+
+    def filter(self, elements):
+        """Yields the raw elements (from get_element) in the area"""
+        for element in self.area.filter_nodes(elements, self.batch_size):
+            osm_id = int(element.get('id'))
+            if element.tag == 'node':
+                self.kept['node'].add(osm_id)
+                yield element
+            elif element.tag == 'way':
+                if self.keep_way(osm_id, (int(nd.get('ref'))
+                                          for nd in element.iter('nd'))):
+                    yield element
+            elif element.tag == 'relation':
+                if self.keep_relation(osm_id, (
+                        (member.get('type'), int(member.get('ref')))
+                        for member in element.iter('member'))):
+                    yield element
+            else:
+                yield element
+
+    def keep_shaped(self, el):
+        """
+            True if a shaped element stays. Its nodes must already have gone
+            through ClipArea.filter_nodes (e.g. in the pool workers).
+        """
+        if 'node' in el:
+            self.kept['node'].add(int(el['node'].id))
+            return True
+        if 'way' in el:
+            return self.keep_way(int(el['way'].id), el['way_nodes'])
+        if 'relation' in el:
+            return self.keep_relation(
+                int(el['relation'].id),
+                ((member.type, int(member.member_id))
+                 for member in el['relation_members']))
+        return True
+
+
+def _geojson_polygons(geojson):
+    #Yields the polygons (lists of rings) of any GeoJSON object
+    kind = geojson.get('type')
+    if kind == 'FeatureCollection':
+        for feature in geojson['features']:
+            for polygon in _geojson_polygons(feature):
+                yield polygon
+    elif kind == 'Feature':
+        for polygon in _geojson_polygons(geojson['geometry']):
+            yield polygon
+    elif kind == 'GeometryCollection':
+        for geometry in geojson['geometries']:
+            for polygon in _geojson_polygons(geometry):
+                yield polygon
+    elif kind == 'Polygon':
+        yield geojson['coordinates']
+    elif kind == 'MultiPolygon':
+        for polygon in geojson['coordinates']:
+            yield polygon
+    else:
+        raise ValueError("no polygon in GeoJSON %s" % (kind,))
+
+
+def _join_rings(ways):
+    #Joins the node lists of the member ways into closed rings
+    ways = [list(way) for way in ways if way]
+    rings = []
+    while ways:
+        ring = ways.pop(0)
+        while ring[0] != ring[-1]:
+            for i, way in enumerate(ways):
+                if way[0] == ring[-1]:
+                    ring.extend(way[1:])
+                elif way[-1] == ring[-1]:
+                    ring.extend(reversed(way[:-1]))
+                else:
+                    continue
+                del ways[i]
+                break
+            else:
+                raise ValueError("boundary ring is not closed at node %d"
+                                 % ring[-1])
+        rings.append(ring)
+    return rings
+
+
+def load_area(spec):
+    """
+        Returns the ClipArea of a 'minlat,minlon,maxlat,maxlon' bbox, a
+        GeoJSON file (.geojson/.json) or an .osm file with a boundary.
+    """
+    if spec.lower().endswith(('.geojson', '.json')):
+        return ClipArea.from_geojson(spec)
+    if spec.lower().endswith('.osm'):
+        return ClipArea.from_osm(spec)
+    try:
+        minlat, minlon, maxlat, maxlon = [float(value)
+                                          for value in spec.split(',')]
+    except ValueError:
+        raise ValueError("not a bbox, GeoJSON or .osm file: %r" % (spec,))
+    return ClipArea.from_bbox(minlat, minlon, maxlat, maxlon)
@@ -0,0 +1,117 @@
+"""
+Geometry helpers on (lat, lon) coordinates in degrees.
+
+Distances are great circle distances in meters. Polygons are sequences
+of (lat, lon) vertices; the last vertex may repeat the first one or not.
+"""
+import math
+
+EARTH_RADIUS = 6371008.8
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in meters between two points"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = (math.sin(dphi / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def line_length(points):
+    """Length in meters of a line through a sequence of (lat, lon) points"""
+    length = 0.0
+    for (lat1, lon1), (lat2, lon2) in zip(points, points[1:]):
+        length += haversine(lat1, lon1, lat2, lon2)
+    return length
+
+
+def bbox_around(lat, lon, meters):
+    """
+        Returns the (minlat, minlon, maxlat, maxlon) box holding every point
+        within meters of (lat, lon).
+    """
+    dlat = math.degrees(meters / EARTH_RADIUS)
+    minlat = max(-90.0, lat - dlat)
+    maxlat = min(90.0, lat + dlat)
+    if minlat == -90.0 or maxlat == 90.0:
+        return (minlat, -180.0, maxlat, 180.0)
+    #The widest longitude span is at the latitude farthest from the equator
+    cos_lat = math.cos(math.radians(max(abs(minlat), abs(maxlat))))
+    dlon = math.degrees(meters / (EARTH_RADIUS * cos_lat))
+    if dlon >= 180.0:
+        return (minlat, -180.0, maxlat, 180.0)
+    return (minlat, lon - dlon, maxlat, lon + dlon)
+
+
+def point_bbox_distance(lat, lon, bbox):
+    """Distance in meters from a point to the closest point of a bbox"""
+    minlat, minlon, maxlat, maxlon = bbox
+    return haversine(lat, lon, min(max(lat, minlat), maxlat),
+                     min(max(lon, minlon), maxlon))
+
+
+def polygon_bbox(polygon):
+    """Returns the (minlat, minlon, maxlat, maxlon) of a polygon"""
+    lats = [lat for lat, _ in polygon]
+    lons = [lon for _, lon in polygon]
+    return (min(lats), min(lons), max(lats), max(lons))
+
+
+def point_in_polygon(lat, lon, polygon):
+    """True if the point is inside the polygon (even-odd rule)"""
+    inside = False
+    lat_j, lon_j = polygon[-1]
+    for lat_i, lon_i in polygon:
+        if (lat_i > lat) != (lat_j > lat):
+            cross = lon_i + (lat - lat_i) * (lon_j - lon_i) / (lat_j - lat_i)
+            if lon < cross:
+                inside = not inside
+        lat_j, lon_j = lat_i, lon_i
+    return inside
+
+
+def _orientation(a, b, c):
+    value = (b[1] - a[1]) * (c[0] - b[0]) - (b[0] - a[0]) * (c[1] - b[1])
+    return (value > 0) - (value < 0)
+
+
+def _on_segment(a, b, c):
+    return (min(a[0], c[0]) <= b[0] <= max(a[0], c[0]) and
+            min(a[1], c[1]) <= b[1] <= max(a[1], c[1]))
+
+
+def segments_intersect(p1, p2, q1, q2):
+    """True if the segments p1-p2 and q1-q2 touch or cross"""
+    o1 = _orientation(p1, p2, q1)
+    o2 = _orientation(p1, p2, q2)
+    o3 = _orientation(q1, q2, p1)
+    o4 = _orientation(q1, q2, p2)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and _on_segment(p1, q1, p2)) or
+            (o2 == 0 and _on_segment(p1, q2, p2)) or
+            (o3 == 0 and _on_segment(q1, p1, q2)) or
+            (o4 == 0 and _on_segment(q1, p2, q2)))
+
+
+def bbox_intersects_polygon(bbox, polygon):
+    """True if a (minlat, minlon, maxlat, maxlon) box and a polygon overlap"""
+    minlat, minlon, maxlat, maxlon = bbox
+    corners = [(minlat, minlon), (minlat, maxlon), (maxlat, maxlon),
+               (maxlat, minlon)]
+    if any(point_in_polygon(lat, lon, polygon) for lat, lon in corners):
+        return True
+    if any(minlat <= lat <= maxlat and minlon <= lon <= maxlon
+           for lat, lon in polygon):
+        return True
+    edges = list(zip(corners, corners[1:] + corners[:1]))
+    previous = polygon[-1]
+    for vertex in polygon:
+        for a, b in edges:
+            if segments_intersect(previous, vertex, a, b):
+                return True
+        previous = vertex
+    return False
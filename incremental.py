@@ -0,0 +1,251 @@
+"""
+Applies an OsmChange (.osc) diff to a database built by process_map with
+output='sqlite', instead of rebuilding it from the full extract.
+
+Created and modified elements are shaped and cleaned like in process_map
+and replace the rows of the same id; deleted elements lose all their rows.
+If the database has a spatial index, the boxes of the changed nodes and
+ways (and of the ways using changed nodes) are refreshed too, and so are
+their ways_geometry rows if it was built with geometry.
+
+--check makes a diff of an extract, applies it to a database of the
+extract and compares every element table with a database rebuilt from
+the changed extract.
+
+Usage:
+    python incremental.py changes.osc [--db rj_map.db] [--no-validate]
+    python incremental.py --check sample_rj_map.osm
+"""
+import argparse
+import collections
+import os
+import pprint
+import shutil
+import sqlite3
+import sys
+import tempfile
+import xml.etree.cElementTree as ET
+
+from osm_io import get_element, open_osm, OsmRecord
+from preparing_database import (process_map, shape_element, validate_element,
+                                SCHEMA, ELEMENT_TAGS)
+from schema_validator import SchemaValidator
+from sqlite_loader import (DB_PATH, ELEMENT_TABLES, INDEXES, delete_element,
+                           insert_element, has_spatial_index,
+                           update_spatial_index, has_geometry,
+                           update_geometry, table_names)
+
+ACTIONS = ('create', 'modify', 'delete')
+
+
+def get_changes(osc_file):
+    """
+        Parses through an OsmChange file.
+        Args: osc_file: OsmChange data (path or file object); .osc.gz,
+            .bz2 and .zst diffs are decompressed on the fly
+        Yield: (action, element) for every node, way and relation, in file
+            order; action is 'create', 'modify' or 'delete'
+    """
+    if not hasattr(osc_file, 'read'):
+        with open_osm(osc_file) as f:
+            for change in get_changes(f):
+                yield change
+        return
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+    depth = 0
+    block = None
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                block = elem
+            continue
+        depth -= 1
+        if depth == 1 and block.tag in ACTIONS and elem.tag in ELEMENT_TAGS:
+            yield block.tag, elem
+            block.clear()
+        elif depth == 0:
+            root.clear()
+
+
+def apply_changes(osc_file, db_path=DB_PATH, validate=True):
+    """
+        Upserts and deletes the elements of an OsmChange file in one
+        transaction, so a failing element leaves the database untouched.
+        Returns: a Counter of (action, element type)
+    """
+    validator = SchemaValidator(SCHEMA)
+    counts = collections.Counter()
+    changed = {'node': set(), 'way': set(), 'relation': set()}
+    connection = sqlite3.connect(db_path)
+    try:
+        #Databases built before an index was added get it on their first diff
+        connection.executescript(INDEXES)
+        with connection:
+            tables = table_names(connection)
+            for action, element in get_changes(osc_file):
+                element_id = int(element.get('id'))
+                delete_element(connection, element.tag, element_id, tables)
+                if action != 'delete':
+                    el = shape_element(element)
+                    if validate is True:
+                        validate_element(el, validator)
+                    insert_element(connection, el)
+                changed[element.tag].add(element_id)
+                counts[(action, element.tag)] += 1
+            if has_spatial_index(connection):
+                update_spatial_index(connection, changed['node'],
+                                     changed['way'])
+            if has_geometry(connection):
+                update_geometry(connection, changed['node'], changed['way'])
+    finally:
+        connection.close()
+    return counts
+
+
+def _xml(element):
+    #The XML of an Element or of an OsmRecord (expat parser, PBF file)
+    if isinstance(element, OsmRecord):
+        element = element.to_element()
+    return ET.tostring(element, encoding='unicode').strip()
+
+
+def write_change_file(changes, out_file):
+    """
+        Writes an OsmChange file, e.g. to build diffs for local testing.
+        Args:
+            changes: iterable of (action, element) pairs; elements are
+                ElementTree Elements or osm_io.OsmRecord objects
+            out_file: path of the .osc file
+    """
+    with open(out_file, 'wb') as output:
+        output.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write(b'<osmChange version="0.6" generator="incremental.py">\n')
+        for action, element in changes:
+            output.write(('<%s>\n' % action).encode('utf-8'))
+            output.write(_xml(element).encode('utf-8') + b'\n')
+            output.write(('</%s>\n' % action).encode('utf-8'))
+        output.write(b'</osmChange>\n')
+
+
+def _copy(record):
+    return OsmRecord(record.tag, dict(record.attrib), list(record.children))
+
+
+def _refs(way):
+    return [child for child in way if child.tag == 'nd']
+
+
+def make_changes(elements):
+    """
+        Builds a diff of a list of records: a node used by a way moves, a
+        node is created, a way loses its last node, another way and the
+        first relation are deleted.
+        Returns: (changes, changed elements) with changes as
+            write_change_file takes them
+    """
+    nodes = dict((e.get('id'), e) for e in elements if e.tag == 'node')
+    ways = [e for e in elements if e.tag == 'way' and len(_refs(e)) > 2]
+    relations = [e for e in elements if e.tag == 'relation']
+    moved = _copy(next(nodes[nd.get('ref')] for way in ways
+                       for nd in _refs(way) if nd.get('ref') in nodes))
+    moved.attrib['lat'] = '%.7f' % (float(moved.get('lat')) + 0.001)
+    created = _copy(moved)
+    created.attrib['id'] = str(max(int(i) for i in nodes) + 1)
+    created.children = [OsmRecord('tag', {'k': 'amenity', 'v': 'cafe'})]
+    shortened = _copy(ways[0])
+    shortened.children.remove(_refs(shortened)[-1])
+    changes = [('modify', moved), ('create', created),
+               ('modify', shortened), ('delete', ways[-1])]
+    if relations:
+        changes.append(('delete', relations[0]))
+    #None for the deleted elements
+    replaced = dict(((e.tag, e.get('id')), None if action == 'delete' else e)
+                    for action, e in changes)
+    after = []
+    for element in elements:
+        element = replaced.get((element.tag, element.get('id')), element)
+        if element is not None:
+            after.append(element)
+    #After the last node, where a full extract would have it
+    last = max(i for i, e in enumerate(after) if e.tag == 'node')
+    after.insert(last + 1, created)
+    return changes, after
+
+
+def _rows(db_path, tables):
+    connection = sqlite3.connect(db_path)
+    try:
+        rows = {}
+        for table in sorted(tables & table_names(connection)):
+            columns = len(connection.execute(
+                "PRAGMA table_info(%s)" % table).fetchall())
+            rows[table] = connection.execute(
+                "SELECT * FROM %s ORDER BY %s" % (
+                    table, ', '.join(str(i + 1) for i in range(columns)))
+            ).fetchall()
+        return rows
+    finally:
+        connection.close()
+
+
+def check_round_trip(osm_file):
+    """
+        Writes a diff of osm_file (see make_changes) with write_change_file,
+        applies it with apply_changes to a database of osm_file (built with
+        the spatial index and geometry) and compares the rows of every
+        element table with those of a database rebuilt from the changed
+        extract.
+        Returns: the sorted list of the tables whose rows differ
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        elements = list(get_element(osm_file, parser='expat'))
+        changes, after = make_changes(elements)
+        osc_file = os.path.join(tmp, 'changes.osc')
+        write_change_file(changes, osc_file)
+        after_file = os.path.join(tmp, 'after.osm')
+        with open(after_file, 'wb') as output:
+            output.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+            output.write(b'<osm version="0.6" generator="incremental.py">\n')
+            for element in after:
+                output.write(('  %s\n' % _xml(element)).encode('utf-8'))
+            output.write(b'</osm>\n')
+        applied = os.path.join(tmp, 'applied.db')
+        rebuilt = os.path.join(tmp, 'rebuilt.db')
+        for source, db_path in ((osm_file, applied), (after_file, rebuilt)):
+            process_map(source, validate=True, output='sqlite',
+                        db_path=db_path, spatial_index=True, geometry=True)
+        apply_changes(osc_file, applied)
+        tables = set(table for names in ELEMENT_TABLES.values()
+                     for table in names) | {'nodes_rtree', 'ways_rtree'}
+        expected = _rows(rebuilt, tables)
+        found = _rows(applied, tables)
+        return sorted(table for table in set(expected) | set(found)
+                      if expected.get(table) != found.get(table))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Apply an OsmChange diff to the SQLite database")
+    parser.add_argument('osc_file', nargs='?')
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--no-validate', dest='validate', action='store_false')
+    parser.add_argument('--check', metavar='OSM_FILE',
+                        help="check a diff of OSM_FILE against a rebuild")
+    args = parser.parse_args()
+
+    if args.check:
+        differ = check_round_trip(args.check)
+        if differ:
+            print("rows differ from the rebuild in: %s" % ', '.join(differ))
+            sys.exit(1)
+        print("applied diff matches the rebuild")
+    elif args.osc_file:
+        pprint.pprint(dict(apply_changes(args.osc_file, args.db,
+                                         args.validate)))
+    else:
+        parser.error("an OsmChange file or --check is needed")
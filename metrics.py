@@ -0,0 +1,196 @@
+"""
+Instrumentation of process_map: counters and cumulative timers per stage
+and per cleaning rule, live progress on stderr, optional cProfile and
+tracemalloc hooks, and a final JSON report.
+
+Stages are timed around the calls themselves ('parse' is the time spent
+waiting for the next element), so their times add up to about the wall
+time of a serial run. Cleaning rules run inside shape_element, so the
+'rules' timers are part of the 'shape' time.
+"""
+import collections
+import contextlib
+import cProfile
+import json
+import sys
+import time
+import tracemalloc
+
+PROGRESS_INTERVAL = 2.0
+
+
+class Metrics(object):
+    """Counters and cumulative timers, merged across pool workers"""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.seconds = collections.defaultdict(float)
+        self.extra = {}
+        self.started = time.time()
+
+    def add(self, name, seconds, count=1):
+        self.seconds[name] += seconds
+        self.counts[name] += count
+
+    def timed(self, iterable, name):
+        """Yields from iterable, timing each next() under name"""
+        clock = time.perf_counter
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds[name] += clock() - start
+                return
+            self.seconds[name] += clock() - start
+            self.counts[name] += 1
+            yield item
+
+    def timed_call(self, func, name):
+        """Returns func wrapped to time (and count) each call under name"""
+        clock = time.perf_counter
+        seconds = self.seconds
+        counts = self.counts
+
+        def call(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds[name] += clock() - start
+                counts[name] += 1
+        return call
+
+    def instrument_rules(self, rules):
+        """Returns a copy of a CleaningRules whose cleaners are timed"""
+        timed = {}
+        instrumented = rules.__class__.__new__(rules.__class__)
+        instrumented.__dict__.update(rules.__dict__)
+        instrumented.table = {}
+        for key, (alias, cleaner) in rules.table.items():
+            if cleaner is not None and cleaner not in timed:
+                name = getattr(cleaner, 'name', None) or cleaner.__name__
+                timed[cleaner] = self.timed_call(cleaner, 'rule:' + name)
+            instrumented.table[key] = (alias, timed.get(cleaner))
+        return instrumented
+
+    def merge(self, other):
+        """Adds the counters and timers of another Metrics (or its state)"""
+        if isinstance(other, Metrics):
+            other = other.state()
+        self.counts.update(other['counts'])
+        for name, seconds in other['seconds'].items():
+            self.seconds[name] += seconds
+
+    def state(self):
+        #Picklable counters and timers, e.g. sent back by pool workers
+        return {'counts': dict(self.counts), 'seconds': dict(self.seconds)}
+
+    def report(self):
+        """Returns the metrics as a JSON-ready dict"""
+        elapsed = time.time() - self.started
+        stages = {}
+        rules = {}
+        for name in sorted(set(self.seconds) | set(self.counts)):
+            seconds = self.seconds.get(name, 0.0)
+            count = self.counts.get(name, 0)
+            entry = {'seconds': seconds, 'count': count,
+                     'per_s': count / seconds if seconds else None}
+            if name.startswith('rule:'):
+                rules[name[len('rule:'):]] = entry
+            else:
+                stages[name] = entry
+        report = {'elapsed': elapsed, 'stages': stages, 'rules': rules}
+        report.update(self.extra)
+        return report
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+
+class Progress(object):
+    """
+        Prints bytes done out of total, elements/s and ETA to stream, at
+        most every interval seconds.
+    """
+
+    def __init__(self, total_bytes, stream=None, interval=PROGRESS_INTERVAL):
+        self.total_bytes = total_bytes
+        self.stream = stream if stream is not None else sys.stderr
+        self.interval = interval
+        self.started = self._last = time.time()
+
+    def update(self, done_bytes, elements, force=False):
+        now = time.time()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        elapsed = max(now - self.started, 1e-9)
+        share = done_bytes / float(self.total_bytes) if self.total_bytes else 1
+        eta = elapsed / share - elapsed if share > 0 else float('nan')
+        self.stream.write(
+            "\r%5.1f%% %9.1f/%.1f MB %10d elements %9.0f elements/s "
+            "ETA %s " % (100 * share, done_bytes / 1e6, self.total_bytes / 1e6,
+                         elements, elements / elapsed, _duration(eta)))
+        self.stream.flush()
+
+    def follow(self, iterable, position, every=1024):
+        """
+            Yields from iterable, updating the progress every `every` items
+            with the byte position returned by position().
+        """
+        count = 0
+        for item in iterable:
+            yield item
+            count += 1
+            if not count % every:
+                self.update(position(), count)
+        self.finish(count)
+
+    def finish(self, elements):
+        self.update(self.total_bytes, elements, force=True)
+        self.stream.write('\n')
+        self.stream.flush()
+
+
+def _duration(seconds):
+    if seconds != seconds:
+        return '?'
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """Runs the block under cProfile and dumps the stats to path"""
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+
+
+@contextlib.contextmanager
+def traced(metrics, top=10):
+    """
+        Runs the block under tracemalloc and adds the peak traced memory and
+        the top allocation sites to the metrics report.
+    """
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        metrics.extra['tracemalloc'] = {
+            'current_bytes': current,
+            'peak_bytes': peak,
+            'top': [{'where': str(stat.traceback[0]), 'bytes': stat.size,
+                     'blocks': stat.count}
+                    for stat in snapshot.statistics('lineno')[:top]],
+        }
@@ -0,0 +1,290 @@
+"""
+On-disk store of node locations, used to build the geometry of ways
+without joining ways_nodes back to nodes.
+
+Node ids are kept as a sorted file of int64 and the coordinates as int32
+fixed point (1e-7 degree, the precision of OSM), so a node costs 16 bytes
+on disk. The files are memory-mapped and searched with a binary search, or
+by offset when the ids are contiguous. Only buffer_size nodes are held in
+memory while the store is filled; nodes that do not come sorted are
+written as sorted runs and merged from disk, so RAM stays fixed whatever
+the size of the extract.
+
+Usage:
+    python preparing_database.py rj_map.osm --geometry
+"""
+import bisect
+import csv
+import heapq
+import io
+import mmap
+import os
+import shutil
+import tempfile
+from array import array
+
+from geometry import polygon_bbox, line_length
+
+COORDINATE_SCALE = 10 ** 7
+BUFFER_SIZE = 1 << 16
+GEOMETRY_PATH = "ways_geometry.csv"
+GEOMETRY_FIELDS = ['id', 'minlat', 'minlon', 'maxlat', 'maxlon', 'length',
+                   'node_count', 'missing', 'linestring']
+
+
+def fixed(value):
+    """A coordinate in degrees as the int32 fixed point the store keeps"""
+    return int(round(value * COORDINATE_SCALE))
+
+
+class NodeStore(object):
+    """
+        Node locations, added in file order with add() then looked up with
+        get() once finish() has been called (get() calls it if needed).
+        Args:
+            directory: where the files go; a temporary directory, removed
+                on close, by default
+            buffer_size: nodes held in memory before they are written
+    """
+
+    def __init__(self, directory=None, buffer_size=BUFFER_SIZE):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.ids = None
+        self.coords = None
+        self._temp = None
+        self._files = None
+        self._maps = []
+        self._buffer_ids = array('q')
+        self._buffer_coords = array('i')
+        self._runs = []
+        self._count = 0
+        self._last = None
+        self._sorted = True
+        self._first = None
+        self._dense = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._count + len(self._buffer_ids)
+
+    def _path(self, name):
+        if self._temp is None and self.directory is None:
+            self._temp = tempfile.mkdtemp(prefix='node_store')
+        directory = self.directory if self.directory is not None else self._temp
+        return os.path.join(directory, name)
+
+    def _open(self):
+        if self.directory is not None and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._files = (open(self._path('ids.bin'), 'wb'),
+                       open(self._path('coords.bin'), 'wb'))
+
+    def add(self, node_id, lat, lon):
+        if self.ids is not None:
+            raise ValueError("nodes must come before the ways that use them")
+        if self._last is not None and node_id <= self._last:
+            self._sorted = False
+        self._last = node_id
+        self._buffer_ids.append(node_id)
+        self._buffer_coords.append(fixed(lat))
+        self._buffer_coords.append(fixed(lon))
+        if len(self._buffer_ids) >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        #Writes the buffer as one sorted run
+        ids = self._buffer_ids
+        if not ids:
+            return
+        coords = self._buffer_coords
+        if not self._sorted and any(ids[i] > ids[i + 1]
+                                    for i in range(len(ids) - 1)):
+            order = sorted(range(len(ids)), key=ids.__getitem__)
+            ids = array('q', (ids[i] for i in order))
+            coords = array('i', (coords[2 * i + j] for i in order
+                                 for j in (0, 1)))
+        if self._files is None:
+            self._open()
+        ids.tofile(self._files[0])
+        coords.tofile(self._files[1])
+        self._runs.append((self._count, len(ids)))
+        self._count += len(ids)
+        self._buffer_ids = array('q')
+        self._buffer_coords = array('i')
+
+    def finish(self):
+        """Writes what is left, merges the runs if needed and maps the files"""
+        if self.ids is not None:
+            return
+        self._flush()
+        if self._files is None:
+            self.ids = array('q')
+            self.coords = array('i')
+            return
+        for f in self._files:
+            f.close()
+        if not self._sorted and len(self._runs) > 1:
+            self._merge()
+        self.ids = self._map('ids.bin', 'q')
+        self.coords = self._map('coords.bin', 'i')
+        self._first = self.ids[0]
+        #Only strictly increasing ids (added in order, with no repeats) are
+        #all found at an offset: 1, 2, 2, 4 also spans as many ids as it holds
+        self._dense = (self._sorted and
+                       self.ids[-1] - self._first + 1 == len(self.ids))
+
+    def _map(self, name, typecode):
+        with open(self._path(name), 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return memoryview(mapped).cast(typecode)
+
+    def _merge(self):
+        #k-way merge of the sorted runs into new files, buffer_size at a time
+        ids = self._map('ids.bin', 'q')
+        coords = self._map('coords.bin', 'i')
+
+        def run(start, count):
+            for i in range(start, start + count):
+                yield ids[i], i
+
+        merged = heapq.merge(*[run(start, count)
+                               for start, count in self._runs])
+        with open(self._path('ids.tmp'), 'wb') as ids_out, \
+                open(self._path('coords.tmp'), 'wb') as coords_out:
+            out_ids = array('q')
+            out_coords = array('i')
+            for node_id, i in merged:
+                out_ids.append(node_id)
+                out_coords.append(coords[2 * i])
+                out_coords.append(coords[2 * i + 1])
+                if len(out_ids) >= self.buffer_size:
+                    out_ids.tofile(ids_out)
+                    out_coords.tofile(coords_out)
+                    out_ids = array('q')
+                    out_coords = array('i')
+            out_ids.tofile(ids_out)
+            out_coords.tofile(coords_out)
+        self._unmap(ids, coords)
+        os.replace(self._path('ids.tmp'), self._path('ids.bin'))
+        os.replace(self._path('coords.tmp'), self._path('coords.bin'))
+        self._runs = [(0, self._count)]
+
+    def _unmap(self, *views):
+        for view in views:
+            if isinstance(view, memoryview):
+                view.release()
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+
+    def get(self, node_id):
+        """Returns the (lat, lon) of a node, or None if it is not stored"""
+        if self.ids is None:
+            self.finish()
+        ids = self.ids
+        if self._dense:
+            i = node_id - self._first
+            if not 0 <= i < len(ids):
+                return None
+        else:
+            i = bisect.bisect_left(ids, node_id)
+            if i == len(ids) or ids[i] != node_id:
+                return None
+        return (self.coords[2 * i] / COORDINATE_SCALE,
+                self.coords[2 * i + 1] / COORDINATE_SCALE)
+
+    def close(self):
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+        self._unmap(self.ids, self.coords)
+        self.ids = self.coords = None
+        if self._temp is not None:
+            shutil.rmtree(self._temp, ignore_errors=True)
+            self._temp = None
+
+
+def linestring(points):
+    """WKT of a line through (lat, lon) points (WKT puts lon first)"""
+    return 'LINESTRING (%s)' % ', '.join('%.7f %.7f' % (lon, lat)
+                                         for lat, lon in points)
+
+
+def geometry_row(way_id, node_count, points):
+    """
+        The geometry row of a way with node_count refs, points being the
+        (lat, lon) of the refs found, in order.
+    """
+    missing = node_count - len(points)
+    if not points:
+        return (way_id, None, None, None, None, None, node_count, missing,
+                None)
+    return ((way_id,) + polygon_bbox(points) +
+            (round(line_length(points), 2), node_count, missing,
+             linestring(points)))
+
+
+class WayGeometry(object):
+    """
+        Keeps the nodes of a stream of shaped elements in a NodeStore and
+        returns the geometry row of each way: id, bbox, length in meters,
+        number of refs, refs missing from the extract and WKT linestring.
+        Missing nodes are left out of the geometry.
+    """
+
+    def __init__(self, directory=None, buffer_size=BUFFER_SIZE):
+        self.store = NodeStore(directory, buffer_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.store.close()
+
+    def row(self, el):
+        """Stores a node and returns None, or returns the row of a way"""
+        if 'node' in el:
+            node = el['node']
+            if node.lat is not None and node.lon is not None:
+                self.store.add(int(node.id), float(node.lat), float(node.lon))
+            return None
+        if 'way' not in el:
+            return None
+        refs = el['way_nodes']
+        get = self.store.get
+        points = [point for point in (get(ref) for ref in refs)
+                  if point is not None]
+        return geometry_row(int(el['way'].id), len(refs), points)
+
+
+class GeometryOutput(object):
+    """Writes the geometry of each way to ways_geometry.csv in out_dir"""
+
+    def __init__(self, out_dir='.', directory=None):
+        self.path = os.path.join(out_dir, GEOMETRY_PATH)
+        self.geometry = WayGeometry(directory)
+        self.file = None
+        self.writer = None
+
+    def __enter__(self):
+        self.file = io.open(self.path, 'w', encoding='utf-8', newline='',
+                            buffering=1024 * 1024)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(GEOMETRY_FIELDS)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.geometry.store.close()
+        self.file.close()
+
+    def write(self, el):
+        row = self.geometry.row(el)
+        if row is not None:
+            self.writer.writerow(row)
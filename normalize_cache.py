@@ -0,0 +1,62 @@
+"""
+Bounded LRU cache in front of the value normalizers.
+
+Street names, postcodes and phone numbers repeat a lot in a city extract,
+so each normalizer only computes a value the first time it sees it. Every
+cached normalizer is registered here, which lets the audits and
+shape_element share the same caches and report hits and misses together.
+"""
+import functools
+import os
+
+CACHE_SIZE = int(os.environ.get('OSM_NORMALIZE_CACHE_SIZE', 65536))
+
+NORMALIZERS = {}
+
+
+class CachedNormalizer(object):
+    """
+        Wraps a one-argument normalizer with a functools.lru_cache.
+        Args:
+            func: the normalizer, called with a hashable value
+            name: name of the normalizer in the stats
+            maxsize: number of values kept (0 disables the cache)
+    """
+
+    def __init__(self, func, name, maxsize=CACHE_SIZE):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.name = name
+        self.resize(maxsize)
+
+    def resize(self, maxsize):
+        """Replaces the cache by an empty one of maxsize values"""
+        self._cached = functools.lru_cache(maxsize=maxsize)(self.func)
+
+    def __call__(self, value):
+        return self._cached(value)
+
+    def stats(self):
+        info = self._cached.cache_info()
+        return {'hits': info.hits, 'misses': info.misses,
+                'maxsize': info.maxsize, 'size': info.currsize}
+
+
+def cached(name):
+    """Decorator registering a cached normalizer under name"""
+    def decorator(func):
+        normalizer = NORMALIZERS[name] = CachedNormalizer(func, name)
+        return normalizer
+    return decorator
+
+
+def set_cache_size(maxsize):
+    """Resizes (and empties) the cache of every registered normalizer"""
+    for normalizer in NORMALIZERS.values():
+        normalizer.resize(maxsize)
+
+
+def cache_stats():
+    """Returns the hits/misses/maxsize/size of every registered normalizer"""
+    return dict((name, normalizer.stats())
+                for name, normalizer in sorted(NORMALIZERS.items()))
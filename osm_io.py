@@ -0,0 +1,729 @@
+"""
+Streaming access to OpenStreetMap XML files.
+"""
+import array
+import bisect
+import bz2
+import collections
+import concurrent.futures
+import gzip
+import io
+import os
+import queue
+import re
+import threading
+import xml.etree.cElementTree as ET
+from xml.parsers import expat
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+PARSERS = ('etree', 'expat', 'lxml')
+READ_SIZE = 1024 * 1024
+
+
+def get_element(osm_file, tags=('node', 'way', 'relation'), parser='etree',
+                clip=None):
+    """
+        Parses through file and gets specified elements.
+        Every top level element is dropped from the root once it has been
+        handled, so memory stays flat whatever the size of the file.
+        Args:
+            osm_file: OpenStreetMap data (path or file object); .bz2, .gz
+                and .zst files are decompressed on the fly (see open_osm)
+                and .osm.pbf files are read by pbf.py
+            tags: The three tags of interest; node, way, and relation.
+            parser: 'etree' (ElementTree, the reference), 'expat' (SAX
+                callbacks building OsmRecord objects) or 'lxml'; PBF files
+                always give OsmRecord objects
+            clip: a clipping.ClipArea; elements outside it are skipped
+        Yield:
+            Yield element if it is the right type of tag
+    """
+    if not hasattr(osm_file, 'read') and compression(osm_file) is not None:
+        return _get_element_compressed(osm_file, tags, parser, clip)
+    if clip is None and is_pbf(osm_file):
+        #Imported here: pbf builds on OsmRecord
+        from pbf import get_element_pbf
+        return get_element_pbf(osm_file, tags)
+    if clip is not None:
+        #Ways and relations follow their nodes, so those are always read
+        wanted = tags
+        elements = clip.filter(get_element(osm_file,
+                                           tuple(set(tags) | set(['node'])),
+                                           parser))
+        if 'node' in wanted:
+            return elements
+        return (element for element in elements if element.tag in wanted)
+    if parser == 'expat':
+        return _get_element_expat(osm_file, tags)
+    if parser == 'lxml':
+        return _get_element_lxml(osm_file, tags)
+    if parser != 'etree':
+        raise ValueError("unknown parser: %r" % (parser,))
+    return _get_element_etree(osm_file, tags)
+
+
+def _get_element_compressed(path, tags, parser, clip):
+    with open_osm(path) as f:
+        for elem in get_element(f, tags, parser, clip):
+            yield elem
+
+
+def _get_element_etree(osm_file, tags):
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            #End of a child of <osm>: yield it if wanted and drop it (and
+            #anything else not wanted, like <bounds>) from the root
+            if elem.tag in tags:
+                yield elem
+            root.clear()
+
+
+class OsmRecord(object):
+    """
+        Lightweight stand-in for an Element: the tag, the attrib dict and the
+        list of children (<tag>, <nd> and <member> records, which have no
+        children of their own). Supports what the cleaning code uses.
+    """
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, attrib, children=()):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = children
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def iter(self, tag=None):
+        if tag is None or tag == self.tag:
+            yield self
+        for child in self.children:
+            if tag is None or child.tag == tag:
+                yield child
+
+    def to_element(self):
+        """Returns the record as an ElementTree Element"""
+        element = ET.Element(self.tag, self.attrib)
+        for child in self.children:
+            ET.SubElement(element, child.tag, child.attrib)
+        return element
+
+
+def _open(osm_file):
+    #Returns (binary file object, whether we opened it)
+    if hasattr(osm_file, 'read'):
+        return osm_file, False
+    return open(osm_file, 'rb'), True
+
+
+def _get_element_expat(osm_file, tags):
+    #Builds OsmRecord objects straight from the expat callbacks; nothing
+    #but the wanted top level elements and their children is allocated
+    records = []
+    depth = 0
+    children = None
+
+    def start(name, attrib):
+        nonlocal depth, children
+        depth += 1
+        if depth == 3:
+            if children is not None:
+                children.append(OsmRecord(name, attrib))
+        elif depth == 2:
+            if name in tags:
+                children = []
+                records.append(OsmRecord(name, attrib, children))
+            else:
+                children = None
+
+    def end(name):
+        nonlocal depth
+        depth -= 1
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    f, close = _open(osm_file)
+    try:
+        while True:
+            data = f.read(READ_SIZE)
+            parser.Parse(data, not data)
+            #The last record may still be open (its children not all read)
+            complete = len(records) - 1 if data and depth > 1 else len(records)
+            for record in records[:complete]:
+                yield record
+            del records[:complete]
+            if not data:
+                break
+    finally:
+        if close:
+            f.close()
+
+
+def _get_element_lxml(osm_file, tags):
+    if lxml_etree is None:
+        raise ImportError("lxml is required for the lxml parser")
+    context = lxml_etree.iterparse(osm_file, events=('end',), tag=tags)
+    for _, elem in context:
+        #Only direct children of <osm> are wanted
+        parent = elem.getparent()
+        if parent is None or parent.getparent() is not None:
+            continue
+        yield elem
+        #Detach the element and everything before it from the tree; like
+        #with the other backends, it stays whole while still referenced
+        while elem.getprevious() is not None:
+            del parent[0]
+        parent.remove(elem)
+
+
+# ================================================== #
+#               Byte range chunks                    #
+# ================================================== #
+CHUNK_SIZE = 8 * 1024 * 1024
+# Top level elements can only start with one of these; '<' is always
+# escaped inside attribute values so the pattern cannot match there
+ELEMENT_START = re.compile(br'<(?:node|way|relation)[\s/>]')
+BLOCK_SIZE = 64 * 1024
+
+
+def _next_element_start(f, pos):
+    #Returns the offset of the first element starting at or after pos
+    f.seek(pos)
+    carry = b''
+    while True:
+        block = f.read(BLOCK_SIZE)
+        if not block:
+            return None
+        data = carry + block
+        m = ELEMENT_START.search(data)
+        if m:
+            return pos - len(carry) + m.start()
+        carry = data[-16:]
+        pos += len(block)
+
+
+def _osm_end(f, size):
+    #Returns the offset of the closing </osm> tag
+    f.seek(max(0, size - BLOCK_SIZE))
+    tail = f.read()
+    return size - len(tail) + tail.rindex(b'</osm>')
+
+
+def find_chunks(path, chunk_size=CHUNK_SIZE):
+    """
+        Splits an OSM file into byte ranges that start and end on top level
+        element boundaries.
+        Args:
+            path: OpenStreetMap file
+            chunk_size: approximate size of each range in bytes
+        Returns:
+            A list of (start, end) offsets covering every node, way and
+            relation of the file, in file order
+    """
+    if compression(path) is not None:
+        raise ValueError("%s is compressed and has no byte ranges; read it "
+                         "with stream_chunks" % (path,))
+    if is_pbf(path):
+        from pbf import find_blobs
+        return find_blobs(path, chunk_size)
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        end = _osm_end(f, size)
+        first = _next_element_start(f, 0)
+        if first is None or first >= end:
+            return []
+        bounds = [first]
+        while bounds[-1] + chunk_size < end:
+            start = _next_element_start(f, bounds[-1] + chunk_size)
+            if start is None or start >= end:
+                break
+            bounds.append(start)
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class RangeReader(object):
+    """Read-only file object over bytes [start, end) wrapped in <osm></osm>"""
+
+    def __init__(self, path, start, end):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._left = end - start
+        self._head = b'<osm>'
+        self._tail = b'</osm>'
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._left + len(self._head) + len(self._tail)
+        data = self._head[:size]
+        self._head = self._head[len(data):]
+        if len(data) < size and self._left > 0:
+            block = self._file.read(min(size - len(data), self._left))
+            self._left -= len(block)
+            data += block
+        if len(data) < size and self._left == 0:
+            extra = self._tail[:size - len(data)]
+            self._tail = self._tail[len(extra):]
+            data += extra
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def get_element_range(path, start, end, tags=('node', 'way', 'relation'),
+                      parser='etree', clip=None):
+    """
+        Yield the wanted elements found in bytes [start, end) of path.
+        With clip, only the nodes are clipped (see ClipArea.filter_nodes):
+        ways and relations depend on nodes of other ranges. For PBF files
+        the range holds whole blobs (see pbf.find_blobs).
+    """
+    if is_pbf(path):
+        from pbf import get_element_range_pbf
+        elements = get_element_range_pbf(path, start, end, tags)
+        if clip is not None:
+            elements = clip.filter_nodes(elements)
+        for elem in elements:
+            yield elem
+        return
+    reader = RangeReader(path, start, end)
+    try:
+        elements = get_element(reader, tags=tags, parser=parser)
+        if clip is not None:
+            elements = clip.filter_nodes(elements)
+        for elem in elements:
+            yield elem
+    finally:
+        reader.close()
+
+
+# ================================================== #
+#               Compressed input                     #
+# ================================================== #
+# PBF files start with the size of a BlobHeader and its 'OSMHeader' type
+PBF_MAGIC = b'\x0a\x09OSMHeader'
+# Magic bytes of the supported compressions
+MAGICS = {b'BZh': 'bz2', b'\x1f\x8b': 'gz', b'\x28\xb5\x2f\xfd': 'zst'}
+DECOMPRESS_SIZE = 1024 * 1024
+# Decompressed blocks waiting for the parser
+QUEUE_SIZE = 16
+# A bzip2 stream header followed by the magic of its first block; pbzip2
+# and lbzip2 write one such stream per 900 kB block of input
+BZ2_STREAM = re.compile(br'BZh[1-9]1AY&SY')
+
+
+def compression(path):
+    """Returns 'bz2', 'gz', 'zst' or None from the first bytes of a file"""
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    for magic, name in MAGICS.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def is_pbf(osm_file):
+    """True if a path, or a file object that can peek, is an OSM PBF file"""
+    if hasattr(osm_file, 'read'):
+        if not hasattr(osm_file, 'peek'):
+            return False
+        head = osm_file.peek(16)
+    else:
+        with open(osm_file, 'rb') as f:
+            head = f.read(16)
+    return head[4:4 + len(PBF_MAGIC)] == PBF_MAGIC
+
+
+class CountingFile(object):
+    """Binary file that counts the bytes read so far in position"""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.position += len(data)
+        return data
+
+    def peek(self, size=1):
+        return self._file.peek(size)
+
+    def close(self):
+        self._file.close()
+
+
+class DecompressingReader(object):
+    """
+        Binary file of the decompressed data of a compressed file. A thread
+        decompresses ahead of the reader through a bounded queue, so
+        decompression overlaps with parsing (zlib, bz2 and zstd release the
+        GIL). position counts the compressed bytes read.
+    """
+
+    def __init__(self, path, threads=None, queue_size=QUEUE_SIZE):
+        self._raw = CountingFile(path)
+        self._queue = queue.Queue(queue_size)
+        self._stop = threading.Event()
+        self._data = b''
+        self._offset = 0
+        self._done = False
+        try:
+            blocks = _decompressed_blocks(self._raw, compression(path),
+                                          threads or os.cpu_count() or 1)
+        except Exception:
+            self._raw.close()
+            raise
+        self._thread = threading.Thread(target=self._produce, args=(blocks,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def position(self):
+        return self._raw.position
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, blocks):
+        try:
+            for block in blocks:
+                if not self._put(block):
+                    break
+            else:
+                self._put(None)
+        except Exception as e:
+            self._put(e)
+        finally:
+            blocks.close()
+
+    def _next_block(self):
+        item = self._queue.get()
+        if item is None:
+            self._done = True
+            return b''
+        if isinstance(item, Exception):
+            self._done = True
+            raise item
+        return item
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self._data[self._offset:]]
+            while not self._done:
+                parts.append(self._next_block())
+            self._data, self._offset = b'', 0
+            return b''.join(parts)
+        while len(self._data) - self._offset < size and not self._done:
+            rest = self._data[self._offset:]
+            self._data, self._offset = rest + self._next_block(), 0
+        data = self._data[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._raw.close()
+
+
+def _decompressed_blocks(raw, kind, threads):
+    #Generator of the decompressed blocks of the raw file
+    if kind == 'gz':
+        stream = gzip.GzipFile(fileobj=raw)
+    elif kind == 'zst':
+        if zstandard is None:
+            raise ImportError("zstandard is required to read .zst files")
+        stream = zstandard.ZstdDecompressor().stream_reader(
+            raw, read_across_frames=True)
+    elif kind == 'bz2':
+        head = raw.read(DECOMPRESS_SIZE)
+        if threads > 1 and BZ2_STREAM.search(head, 1):
+            return _bz2_parallel(raw, head, threads)
+        stream = bz2.BZ2File(_Prefixed(head, raw))
+    else:
+        raise ValueError("unknown compression: %r" % (kind,))
+    return _read_blocks(stream)
+
+
+def _read_blocks(stream):
+    try:
+        while True:
+            block = stream.read(DECOMPRESS_SIZE)
+            if not block:
+                return
+            yield block
+    finally:
+        stream.close()
+
+
+class _Prefixed(object):
+    #File that returns head before the rest of raw
+    def __init__(self, head, raw):
+        self._head = head
+        self._raw = raw
+
+    def read(self, size=-1):
+        if not self._head:
+            return self._raw.read(size)
+        if size is None or size < 0:
+            data, self._head = self._head + self._raw.read(), b''
+            return data
+        data, self._head = self._head[:size], self._head[size:]
+        return data
+
+
+def _bz2_parallel(raw, head, threads):
+    #Multi-stream bzip2: whole streams are decompressed by a thread pool,
+    #at most 2 * threads at a time, and yielded in file order
+    pending = collections.deque()
+    buffer = bytearray(head)
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        while True:
+            last = None
+            for m in BZ2_STREAM.finditer(buffer, 1):
+                last = m.start()
+            if last is not None:
+                pending.append(pool.submit(bz2.decompress,
+                                           bytes(buffer[:last])))
+                del buffer[:last]
+            while pending and (len(pending) > 2 * threads or
+                               pending[0].done()):
+                yield pending.popleft().result()
+            block = raw.read(DECOMPRESS_SIZE)
+            if not block:
+                break
+            buffer += block
+        if buffer:
+            pending.append(pool.submit(bz2.decompress, bytes(buffer)))
+        while pending:
+            yield pending.popleft().result()
+
+
+def open_osm(path, threads=None):
+    """
+        Opens an OpenStreetMap file for reading, decompressing .bz2, .gz
+        and .zst files (told apart by their first bytes) in a background
+        thread. Multi-stream bzip2 files are decompressed in parallel by
+        threads threads (one per CPU by default). The returned file has a
+        position attribute: the bytes of path read so far.
+    """
+    if compression(path) is None:
+        return CountingFile(path)
+    return DecompressingReader(path, threads)
+
+
+def stream_chunks(f, chunk_size=CHUNK_SIZE):
+    """
+        Splits a file object, e.g. from open_osm, into chunks of whole top
+        level elements of about chunk_size bytes: the stream counterpart of
+        find_chunks, for files without byte ranges. Yields the bytes of
+        each chunk, to be read with get_element_data.
+    """
+    buffer = bytearray()
+    started = False
+    while True:
+        block = f.read(BLOCK_SIZE)
+        buffer += block
+        if not started:
+            m = ELEMENT_START.search(buffer)
+            if m is None:
+                if not block:
+                    return
+                continue
+            del buffer[:m.start()]
+            started = True
+        while len(buffer) > chunk_size:
+            m = ELEMENT_START.search(buffer, chunk_size)
+            if m is None:
+                break
+            yield bytes(buffer[:m.start()])
+            del buffer[:m.start()]
+        if not block:
+            break
+    end = buffer.rfind(b'</osm>')
+    if end >= 0:
+        del buffer[end:]
+    if buffer.strip():
+        yield bytes(buffer)
+
+
+def get_element_data(data, tags=('node', 'way', 'relation'), parser='etree',
+                     clip=None):
+    """
+        Yield the wanted elements of a chunk from stream_chunks. Like
+        get_element_range, only the nodes are clipped.
+    """
+    elements = get_element(io.BytesIO(b'<osm>' + data + b'</osm>'),
+                           tags=tags, parser=parser)
+    if clip is not None:
+        elements = clip.filter_nodes(elements)
+    return elements
+
+
+# ================================================== #
+#               Id sets                              #
+# ================================================== #
+PAGE_BITS = 16
+PAGE_MASK = (1 << PAGE_BITS) - 1
+# A page keeps its ids as a sorted array of 16 bit offsets until it holds
+# more than fit in the size of a bitmap page, then becomes a bitmap
+ARRAY_PAGE_MAX = 1 << (PAGE_BITS - 4)
+BITMAP_PAGE_SIZE = 1 << (PAGE_BITS - 3)
+
+
+def _to_bitmap(offsets):
+    page = bytearray(BITMAP_PAGE_SIZE)
+    for offset in offsets:
+        page[offset >> 3] |= 1 << (offset & 7)
+    return page
+
+
+def _page_offsets(page):
+    if isinstance(page, array.array):
+        return iter(page)
+    return _bitmap_offsets(page)
+
+
+def _bitmap_offsets(page):
+    bits = int.from_bytes(page, 'little')
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def _page_count(page):
+    if isinstance(page, array.array):
+        return len(page)
+    return int.from_bytes(page, 'little').bit_count()
+
+
+class NodeIdBitmap(object):
+    """
+        Compact set of OSM ids (node ids, but any 64 bit id works).
+        Ids are grouped in pages of 2**PAGE_BITS ids. Sparse pages keep a
+        sorted array of 16 bit offsets and dense pages a bitmap, so both a
+        few ids scattered over the id space and the nodes of whole ways
+        (runs of close ids) take little memory.
+    """
+
+    def __init__(self, ids=()):
+        self.pages = {}
+        self._count = 0
+        self.update(ids)
+
+    def add(self, osm_id):
+        key = osm_id >> PAGE_BITS
+        offset = osm_id & PAGE_MASK
+        page = self.pages.get(key)
+        if page is None:
+            self.pages[key] = array.array('H', [offset])
+        elif isinstance(page, array.array):
+            i = bisect.bisect_left(page, offset)
+            if i < len(page) and page[i] == offset:
+                return
+            if len(page) < ARRAY_PAGE_MAX:
+                page.insert(i, offset)
+            else:
+                page = self.pages[key] = _to_bitmap(page)
+                page[offset >> 3] |= 1 << (offset & 7)
+        else:
+            mask = 1 << (offset & 7)
+            if page[offset >> 3] & mask:
+                return
+            page[offset >> 3] |= mask
+        self._count += 1
+
+    def update(self, ids):
+        for osm_id in ids:
+            self.add(osm_id)
+
+    def union(self, other):
+        """Adds every id of another NodeIdBitmap"""
+        for key, other_page in other.pages.items():
+            page = old_page = self.pages.get(key)
+            if page is None:
+                page = other_page[:]
+            elif (isinstance(page, array.array) and
+                  isinstance(other_page, array.array) and
+                  len(page) + len(other_page) <= ARRAY_PAGE_MAX):
+                page = array.array('H', sorted(set(page).union(other_page)))
+            else:
+                if isinstance(page, array.array):
+                    page = _to_bitmap(page)
+                if isinstance(other_page, array.array):
+                    other_page = _to_bitmap(other_page)
+                merged = (int.from_bytes(page, 'little') |
+                          int.from_bytes(other_page, 'little'))
+                page = bytearray(merged.to_bytes(BITMAP_PAGE_SIZE, 'little'))
+            self._count += _page_count(page)
+            if old_page is not None:
+                self._count -= _page_count(old_page)
+            self.pages[key] = page
+
+    def __contains__(self, osm_id):
+        page = self.pages.get(osm_id >> PAGE_BITS)
+        if page is None:
+            return False
+        offset = osm_id & PAGE_MASK
+        if isinstance(page, array.array):
+            i = bisect.bisect_left(page, offset)
+            return i < len(page) and page[i] == offset
+        return bool(page[offset >> 3] & (1 << (offset & 7)))
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for key in sorted(self.pages):
+            base = key << PAGE_BITS
+            for offset in _page_offsets(self.pages[key]):
+                yield base + offset
@@ -0,0 +1,162 @@
+"""
+Writes shaped OpenStreetMap elements as columnar Parquet (or Arrow IPC)
+files, one per table, with typed and dictionary encoded columns.
+
+An Arrow IPC file allows one dictionary per column, so the Arrow output
+keeps each column's dictionary for the whole file: a batch only appends
+its new values, which are written as a dictionary delta.
+
+pyarrow is only needed for this output mode.
+"""
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from sqlite_loader import element_rows
+
+OUT_DIR = "."
+ROW_GROUP_SIZE = 256 * 1024
+# Columns with few distinct values are stored dictionary encoded
+DICTIONARY_COLUMNS = frozenset(['user', 'key', 'type'])
+
+
+def _schemas():
+    tag_fields = [('id', pa.int64()), ('key', pa.string()),
+                  ('value', pa.string()), ('type', pa.string())]
+    fields = {
+        'nodes': [('id', pa.int64()), ('lat', pa.float64()),
+                  ('lon', pa.float64()), ('user', pa.string()),
+                  ('uid', pa.int64()), ('version', pa.int32()),
+                  ('changeset', pa.int64()), ('timestamp', pa.string())],
+        'nodes_tags': tag_fields,
+        'ways': [('id', pa.int64()), ('user', pa.string()),
+                 ('uid', pa.int64()), ('version', pa.int32()),
+                 ('changeset', pa.int64()), ('timestamp', pa.string())],
+        'ways_nodes': [('id', pa.int64()), ('node_id', pa.int64()),
+                       ('position', pa.int32())],
+        'ways_tags': tag_fields,
+        'relations': [('id', pa.int64()), ('user', pa.string()),
+                      ('uid', pa.int64()), ('version', pa.int32()),
+                      ('changeset', pa.int64()), ('timestamp', pa.string())],
+        'relation_members': [('id', pa.int64()), ('member_id', pa.int64()),
+                             ('type', pa.string()), ('role', pa.string()),
+                             ('position', pa.int32())],
+        'relation_tags': tag_fields,
+    }
+    schemas = {}
+    for table, columns in fields.items():
+        schemas[table] = pa.schema([
+            pa.field(name, pa.dictionary(pa.int32(), pa.string())
+                     if name in DICTIONARY_COLUMNS else type_)
+            for name, type_ in columns])
+    return schemas
+
+
+class ParquetOutput(object):
+    """
+        Writes each table as a <table>.parquet (or <table>.arrow) file.
+        Args:
+            out_dir: directory of the output files
+            row_group_size: rows per row group (and per write)
+            file_format: 'parquet' or 'arrow' (Arrow IPC file)
+            compression: Parquet compression codec
+    """
+
+    def __init__(self, out_dir=OUT_DIR, row_group_size=ROW_GROUP_SIZE,
+                 file_format='parquet', compression='zstd'):
+        if pa is None:
+            raise ImportError("pyarrow is required for the %s output"
+                              % file_format)
+        if file_format not in ('parquet', 'arrow'):
+            raise ValueError("unknown file format: %r" % (file_format,))
+        self.out_dir = out_dir
+        self.row_group_size = row_group_size
+        self.file_format = file_format
+        self.compression = compression
+        self.schemas = _schemas()
+        self.buffers = dict((table, []) for table in self.schemas)
+        self.writers = {}
+        #{(table, column): ({value: index}, [values])} of the Arrow output
+        self.dictionaries = {}
+
+    def __enter__(self):
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        for table, schema in self.schemas.items():
+            path = os.path.join(self.out_dir,
+                                '%s.%s' % (table, self.file_format))
+            if self.file_format == 'parquet':
+                self.writers[table] = pq.ParquetWriter(
+                    path, schema, compression=self.compression,
+                    use_dictionary=sorted(DICTIONARY_COLUMNS))
+            else:
+                self.writers[table] = pa.ipc.new_file(
+                    path, schema, options=pa.ipc.IpcWriteOptions(
+                        emit_dictionary_deltas=True))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                for table in self.buffers:
+                    self._write_batch(table)
+        finally:
+            for writer in self.writers.values():
+                writer.close()
+            self.writers = {}
+
+    def _write_batch(self, table):
+        #Transposes the buffered rows into columns and writes them at once
+        rows = self.buffers[table]
+        if not rows:
+            return
+        schema = self.schemas[table]
+        columns = []
+        for field, values in zip(schema, zip(*rows)):
+            if not pa.types.is_dictionary(field.type):
+                columns.append(pa.array(values, field.type))
+            elif self.file_format == 'parquet':
+                columns.append(pa.array(values, pa.string())
+                               .dictionary_encode())
+            else:
+                columns.append(self._encode(table, field.name, values))
+        batch = pa.Table.from_arrays(columns, schema=schema)
+        if self.file_format == 'parquet':
+            self.writers[table].write_table(batch,
+                                            row_group_size=self.row_group_size)
+        else:
+            self.writers[table].write_table(batch)
+        del rows[:]
+
+    def _encode(self, table, name, values):
+        #Indices into the column's dictionary, which only grows, so every
+        #batch's dictionary starts with the one written before it
+        index, dictionary = self.dictionaries.setdefault((table, name),
+                                                         ({}, []))
+        indices = []
+        for value in values:
+            if value is not None:
+                i = index.get(value)
+                if i is None:
+                    i = index[value] = len(dictionary)
+                    dictionary.append(value)
+                value = i
+            indices.append(value)
+        return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()),
+                                              pa.array(dictionary,
+                                                       pa.string()))
+
+    def _add(self, table, rows):
+        buffer = self.buffers[table]
+        buffer.extend(rows)
+        if len(buffer) >= self.row_group_size:
+            self._write_batch(table)
+
+    def write(self, el):
+        """Buffers the rows of one shaped element"""
+        for table, rows in element_rows(el):
+            self._add(table, rows)
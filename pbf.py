@@ -0,0 +1,598 @@
+"""
+Reader and writer of the OSM PBF format (.osm.pbf), in pure Python.
+
+The reader yields osm_io.OsmRecord objects with the same attributes and
+children as the XML elements (coordinates with 7 decimals, ISO
+timestamps), so get_element, shape_element and the writers work on PBF
+files unchanged: get_element and find_chunks/get_element_range switch to
+this module when a file starts with a PBF header. Dense nodes, delta
+coded refs and member ids are decoded. Info fields left at 0 or the empty
+string (how the writer stores missing attributes) are left out, like
+attributes missing from the XML. For parallel reads, process_map with
+workers > 1 decodes and shapes byte ranges of blobs in its pool workers,
+which send back compact rows instead of records.
+
+The writer converts any stream of elements, e.g. to make small fixtures
+from the sample:
+    python pbf.py sample_rj_map.osm sample_rj_map.osm.pbf [--block-size N]
+"""
+import argparse
+import calendar
+import collections
+import itertools
+import lzma
+import struct
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from osm_io import OsmRecord
+
+SUPPORTED_FEATURES = set(['OsmSchema-V0.6', 'DenseNodes'])
+BLOCK_SIZE = 8000
+MAX_BLOB_SIZE = 32 * 1024 * 1024
+MEMBER_TYPES = ('node', 'way', 'relation')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+MASK64 = (1 << 64) - 1
+
+
+# ================================================== #
+#               Protobuf decoding                    #
+# ================================================== #
+def _varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _signed(value):
+    #int32/int64 fields hold negative values as 64 bit two's complement
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _message(data):
+    """
+        Returns {field number: [values]} of a protobuf message; varints are
+        ints and length-delimited values bytes.
+    """
+    fields = collections.defaultdict(list)
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = _varint(data, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = _varint(data, pos)
+        elif wire == 2:
+            length, pos = _varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("unsupported protobuf wire type %d" % wire)
+        fields[key >> 3].append(value)
+    return fields
+
+
+def _packed(data):
+    """The varints of a packed repeated field"""
+    if not data or max(data) < 0x80:
+        #Every value fits in one byte
+        return list(data)
+    values = []
+    append = values.append
+    value = shift = 0
+    for byte in data:
+        if byte < 0x80:
+            append(value | (byte << shift))
+            value = shift = 0
+        else:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+    return values
+
+
+def _deltas(data):
+    #A packed sint64 field of delta coded values
+    return list(itertools.accumulate((value >> 1) ^ -(value & 1)
+                                     for value in _packed(data)))
+
+
+def _first(fields, number, default=None):
+    values = fields.get(number)
+    return values[-1] if values else default
+
+
+# ================================================== #
+#               Blocks to records                    #
+# ================================================== #
+class _Block(object):
+    #The string table and the coordinate/date scales of a PrimitiveBlock
+    def __init__(self, fields):
+        table = _message(_first(fields, 1, b''))
+        self.strings = [s.decode('utf-8') for s in table.get(1, [])]
+        self.granularity = _first(fields, 17, 100)
+        self.date_granularity = _first(fields, 18, 1000)
+        self.lat_offset = _signed(_first(fields, 19, 0))
+        self.lon_offset = _signed(_first(fields, 20, 0))
+
+    def coordinate(self, offset, value):
+        #Nanodegrees, written with 7 decimals like the XML extracts
+        return '%.7f' % ((offset + self.granularity * value) * 1e-9)
+
+    def timestamp(self, value):
+        return time.strftime(TIMESTAMP_FORMAT, time.gmtime(
+            value * self.date_granularity // 1000))
+
+    def info(self, attrib, version, timestamp, changeset, uid, user_sid):
+        #0 and string 0 ('') stand for a missing attribute
+        if version:
+            attrib['version'] = str(version)
+        if timestamp:
+            attrib['timestamp'] = self.timestamp(timestamp)
+        if changeset:
+            attrib['changeset'] = str(changeset)
+        if uid:
+            attrib['uid'] = str(uid)
+        if user_sid:
+            attrib['user'] = self.strings[user_sid]
+
+    def tags(self, keys, values):
+        strings = self.strings
+        return [OsmRecord('tag', {'k': strings[k], 'v': strings[v]})
+                for k, v in zip(keys, values)]
+
+
+def _info(block, attrib, data):
+    if data is None:
+        return
+    fields = _message(data)
+    block.info(attrib, _signed(_first(fields, 1, 0)),
+               _signed(_first(fields, 2, 0)), _signed(_first(fields, 3, 0)),
+               _signed(_first(fields, 4, 0)), _first(fields, 5, 0))
+
+
+def _dense_nodes(block, data):
+    fields = _message(data)
+    ids = _deltas(_first(fields, 1, b''))
+    lats = _deltas(_first(fields, 8, b''))
+    lons = _deltas(_first(fields, 9, b''))
+    keys_vals = _packed(_first(fields, 10, b''))
+    info = _first(fields, 5)
+    if info is not None:
+        info = _message(info)
+        #A missing array leaves its attribute out for every node
+        infos = zip(*[decode(_first(info, n, b'')) or itertools.repeat(0)
+                      for n, decode in ((1, _packed), (2, _deltas),
+                                        (3, _deltas), (4, _deltas),
+                                        (5, _deltas))])
+    else:
+        infos = itertools.repeat(None)
+    strings = block.strings
+    granularity = block.granularity * 1e-9
+    lat_offset = block.lat_offset * 1e-9
+    lon_offset = block.lon_offset * 1e-9
+    pos = 0
+    records = []
+    for node_id, lat, lon, node_info in zip(ids, lats, lons, infos):
+        attrib = {'id': str(node_id),
+                  'lat': '%.7f' % (lat_offset + granularity * lat),
+                  'lon': '%.7f' % (lon_offset + granularity * lon)}
+        if node_info is not None:
+            block.info(attrib, *node_info)
+        tags = []
+        #keys_vals: key, value, key, value, ..., 0 for each node
+        while pos < len(keys_vals) and keys_vals[pos] != 0:
+            tags.append(OsmRecord('tag', {'k': strings[keys_vals[pos]],
+                                          'v': strings[keys_vals[pos + 1]]}))
+            pos += 2
+        pos += 1
+        records.append(OsmRecord('node', attrib, tags))
+    return records
+
+
+def _node(block, data):
+    fields = _message(data)
+    attrib = {'id': str(_zigzag(_first(fields, 1, 0))),
+              'lat': block.coordinate(block.lat_offset,
+                                      _zigzag(_first(fields, 8, 0))),
+              'lon': block.coordinate(block.lon_offset,
+                                      _zigzag(_first(fields, 9, 0)))}
+    _info(block, attrib, _first(fields, 4))
+    return OsmRecord('node', attrib, block.tags(
+        _packed(_first(fields, 2, b'')), _packed(_first(fields, 3, b''))))
+
+
+def _way(block, data):
+    fields = _message(data)
+    attrib = {'id': str(_signed(_first(fields, 1, 0)))}
+    _info(block, attrib, _first(fields, 4))
+    children = [OsmRecord('nd', {'ref': str(ref)})
+                for ref in _deltas(_first(fields, 8, b''))]
+    children.extend(block.tags(_packed(_first(fields, 2, b'')),
+                               _packed(_first(fields, 3, b''))))
+    return OsmRecord('way', attrib, children)
+
+
+def _relation(block, data):
+    fields = _message(data)
+    attrib = {'id': str(_signed(_first(fields, 1, 0)))}
+    _info(block, attrib, _first(fields, 4))
+    strings = block.strings
+    children = [OsmRecord('member', {'type': MEMBER_TYPES[member_type],
+                                     'ref': str(ref),
+                                     'role': strings[role]})
+                for role, ref, member_type in zip(
+                    _packed(_first(fields, 8, b'')),
+                    _deltas(_first(fields, 9, b'')),
+                    _packed(_first(fields, 10, b'')))]
+    children.extend(block.tags(_packed(_first(fields, 2, b'')),
+                               _packed(_first(fields, 3, b''))))
+    return OsmRecord('relation', attrib, children)
+
+
+def decode_block(data, tags=MEMBER_TYPES):
+    """Returns the wanted records of a decompressed PrimitiveBlock"""
+    fields = _message(data)
+    block = _Block(fields)
+    records = []
+    for group in fields.get(2, []):
+        group = _message(group)
+        if 'node' in tags:
+            for node in group.get(1, []):
+                records.append(_node(block, node))
+            for dense in group.get(2, []):
+                records.extend(_dense_nodes(block, dense))
+        if 'way' in tags:
+            records.extend(_way(block, way) for way in group.get(3, []))
+        if 'relation' in tags:
+            records.extend(_relation(block, relation)
+                           for relation in group.get(4, []))
+    return records
+
+
+# ================================================== #
+#               Blobs                                #
+# ================================================== #
+def _read_blob(f):
+    """Returns the (type, Blob bytes) of the next blob, or None at the end"""
+    head = f.read(4)
+    if not head:
+        return None
+    if len(head) < 4:
+        raise ValueError("truncated PBF file")
+    size = struct.unpack('>I', head)[0]
+    header = _message(f.read(size))
+    datasize = _first(header, 3, 0)
+    if datasize > MAX_BLOB_SIZE:
+        raise ValueError("PBF blob of %d bytes is too big" % datasize)
+    data = f.read(datasize)
+    if len(data) < datasize:
+        raise ValueError("truncated PBF file")
+    return _first(header, 1, b'').decode('utf-8'), data
+
+
+def blob_data(blob):
+    """The decompressed content of a Blob"""
+    fields = _message(blob)
+    if 1 in fields:
+        return _first(fields, 1)
+    if 3 in fields:
+        return zlib.decompress(_first(fields, 3))
+    if 4 in fields:
+        return lzma.decompress(_first(fields, 4))
+    if 7 in fields:
+        if zstandard is None:
+            raise ImportError("zstandard is required for zstd PBF blobs")
+        return zstandard.ZstdDecompressor().decompress(
+            _first(fields, 7), max_output_size=_first(fields, 2, 0))
+    raise ValueError("unsupported PBF blob compression")
+
+
+def _check_header(blob):
+    header = _message(blob_data(blob))
+    required = set(feature.decode('utf-8') for feature in header.get(4, []))
+    unsupported = required - SUPPORTED_FEATURES
+    if unsupported:
+        raise ValueError("unsupported PBF features: %s"
+                         % ', '.join(sorted(unsupported)))
+
+
+def decode_blob(args):
+    """Returns the wanted records of an OSMData blob"""
+    blob, tags = args
+    return decode_block(blob_data(blob), tags)
+
+
+def iter_blobs(f):
+    """Yields the OSMData blobs of a PBF file object, checking its header"""
+    while True:
+        item = _read_blob(f)
+        if item is None:
+            return
+        kind, blob = item
+        if kind == 'OSMHeader':
+            _check_header(blob)
+        elif kind == 'OSMData':
+            yield blob
+
+
+def find_blobs(path, chunk_size):
+    """
+        Splits a PBF file into byte ranges of whole OSMData blobs of about
+        chunk_size bytes, like osm_io.find_chunks for XML.
+    """
+    bounds = []
+    with open(path, 'rb') as f:
+        start = None
+        while True:
+            offset = f.tell()
+            head = f.read(4)
+            if not head:
+                break
+            header = _message(f.read(struct.unpack('>I', head)[0]))
+            kind = _first(header, 1, b'').decode('utf-8')
+            if kind == 'OSMHeader':
+                _check_header(f.read(_first(header, 3, 0)))
+                continue
+            f.seek(_first(header, 3, 0), 1)
+            if kind != 'OSMData':
+                continue
+            if start is None:
+                start = offset
+            if f.tell() - start >= chunk_size:
+                bounds.append((start, f.tell()))
+                start = None
+        if start is not None:
+            bounds.append((start, offset))
+    return bounds
+
+
+class _Range(object):
+    #File object over bytes [start, end) of a file
+    def __init__(self, path, start, end):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._left = end - start
+
+    def read(self, size):
+        data = self._file.read(min(size, self._left))
+        self._left -= len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def get_element_pbf(osm_file, tags=MEMBER_TYPES):
+    """
+        Yields the wanted records of a PBF file (path or file object), in
+        file order.
+    """
+    f = open(osm_file, 'rb') if not hasattr(osm_file, 'read') else osm_file
+    try:
+        for blob in iter_blobs(f):
+            for record in decode_blob((blob, tags)):
+                yield record
+    finally:
+        if f is not osm_file:
+            f.close()
+
+
+def get_element_range_pbf(path, start, end, tags=MEMBER_TYPES):
+    """Yields the wanted records of the blobs in bytes [start, end)"""
+    reader = _Range(path, start, end)
+    try:
+        for record in get_element_pbf(reader, tags):
+            yield record
+    finally:
+        reader.close()
+
+
+# ================================================== #
+#               Writer                               #
+# ================================================== #
+def _encode_varint(value):
+    value &= MASK64
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _encode_zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _field(number, data):
+    #A length-delimited field
+    return (_encode_varint(number << 3 | 2) + _encode_varint(len(data)) +
+            data)
+
+
+def _int_field(number, value):
+    return _encode_varint(number << 3) + _encode_varint(value)
+
+
+def _packed_field(number, values):
+    return _field(number, b''.join(_encode_varint(value) for value in values))
+
+
+def _delta_field(number, values):
+    previous = 0
+    deltas = []
+    for value in values:
+        deltas.append(_encode_zigzag(value - previous))
+        previous = value
+    return _packed_field(number, deltas)
+
+
+def _nanodegrees(value):
+    #Coordinates in units of 100 nanodegrees (the default granularity)
+    return int(round(float(value) * 10 ** 7))
+
+
+def _epoch(timestamp):
+    return calendar.timegm(time.strptime(timestamp, TIMESTAMP_FORMAT))
+
+
+class _StringTable(object):
+    def __init__(self):
+        self.index = {'': 0}
+        self.strings = ['']
+
+    def __call__(self, value):
+        value = value or ''
+        i = self.index.get(value)
+        if i is None:
+            i = self.index[value] = len(self.strings)
+            self.strings.append(value)
+        return i
+
+    def encode(self):
+        return b''.join(_field(1, s.encode('utf-8')) for s in self.strings)
+
+
+def _encode_info(element, strings):
+    return (_int_field(1, int(element.get('version') or 0)) +
+            _int_field(2, _epoch(element.get('timestamp')) if
+                       element.get('timestamp') else 0) +
+            _int_field(3, int(element.get('changeset') or 0)) +
+            _int_field(4, int(element.get('uid') or 0)) +
+            _int_field(5, strings(element.get('user'))))
+
+
+def _encode_tags(element, strings):
+    tags = list(element.iter('tag'))
+    return (_packed_field(2, [strings(tag.get('k')) for tag in tags]) +
+            _packed_field(3, [strings(tag.get('v')) for tag in tags]))
+
+
+def _encode_dense(nodes, strings):
+    keys_vals = []
+    for node in nodes:
+        for tag in node.iter('tag'):
+            keys_vals.append(strings(tag.get('k')))
+            keys_vals.append(strings(tag.get('v')))
+        keys_vals.append(0)
+    info = (_packed_field(1, [int(node.get('version') or 0)
+                              for node in nodes]) +
+            _delta_field(2, [_epoch(node.get('timestamp'))
+                             if node.get('timestamp') else 0
+                             for node in nodes]) +
+            _delta_field(3, [int(node.get('changeset') or 0)
+                             for node in nodes]) +
+            _delta_field(4, [int(node.get('uid') or 0) for node in nodes]) +
+            _delta_field(5, [strings(node.get('user')) for node in nodes]))
+    return (_delta_field(1, [int(node.get('id')) for node in nodes]) +
+            _field(5, info) +
+            _delta_field(8, [_nanodegrees(node.get('lat')) for node in nodes]) +
+            _delta_field(9, [_nanodegrees(node.get('lon')) for node in nodes]) +
+            _packed_field(10, keys_vals))
+
+
+def _encode_way(way, strings):
+    return (_int_field(1, int(way.get('id'))) + _encode_tags(way, strings) +
+            _field(4, _encode_info(way, strings)) +
+            _delta_field(8, [int(nd.get('ref')) for nd in way.iter('nd')]))
+
+
+def _encode_relation(relation, strings):
+    members = list(relation.iter('member'))
+    return (_int_field(1, int(relation.get('id'))) +
+            _encode_tags(relation, strings) +
+            _field(4, _encode_info(relation, strings)) +
+            _packed_field(8, [strings(member.get('role'))
+                              for member in members]) +
+            _delta_field(9, [int(member.get('ref')) for member in members]) +
+            _packed_field(10, [MEMBER_TYPES.index(member.get('type'))
+                               for member in members]))
+
+
+def encode_block(elements):
+    """PrimitiveBlock of a list of elements of one type"""
+    strings = _StringTable()
+    kind = elements[0].tag
+    if kind == 'node':
+        group = _field(2, _encode_dense(elements, strings))
+    elif kind == 'way':
+        group = b''.join(_field(3, _encode_way(way, strings))
+                         for way in elements)
+    else:
+        group = b''.join(_field(4, _encode_relation(relation, strings))
+                         for relation in elements)
+    return _field(1, strings.encode()) + _field(2, group)
+
+
+def _write_blob(out, kind, data, compress=True):
+    if compress:
+        blob = _int_field(2, len(data)) + _field(3, zlib.compress(data))
+    else:
+        blob = _field(1, data)
+    header = _field(1, kind.encode('utf-8')) + _int_field(3, len(blob))
+    out.write(struct.pack('>I', len(header)))
+    out.write(header)
+    out.write(blob)
+
+
+def write_pbf(elements, out_file, block_size=BLOCK_SIZE, compress=True):
+    """
+        Writes elements (from get_element, in file order) to a PBF file:
+        nodes as dense nodes, block_size elements of one type per block.
+        Returns: the number of elements written per type
+    """
+    counts = dict((tag, 0) for tag in MEMBER_TYPES)
+    with open(out_file, 'wb') as out:
+        header = (_field(4, b'OsmSchema-V0.6') + _field(4, b'DenseNodes') +
+                  _field(16, b'pbf.py'))
+        _write_blob(out, 'OSMHeader', header, compress)
+        block = []
+        for element in elements:
+            if element.tag not in counts:
+                continue
+            if block and (block[0].tag != element.tag or
+                          len(block) >= block_size):
+                _write_blob(out, 'OSMData', encode_block(block), compress)
+                block = []
+            block.append(element)
+            counts[element.tag] += 1
+        if block:
+            _write_blob(out, 'OSMData', encode_block(block), compress)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Convert an OpenStreetMap XML file to PBF")
+    parser.add_argument('osm_file')
+    parser.add_argument('pbf_file')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE,
+                        help="elements per block")
+    parser.add_argument('--no-compress', dest='compress',
+                        action='store_false')
+    args = parser.parse_args()
+
+    from osm_io import get_element
+    print(write_pbf(get_element(args.osm_file), args.pbf_file,
+                    args.block_size, args.compress))
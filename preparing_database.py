@@ -1,15 +1,33 @@
 
+import argparse
+import array
+import collections
+import contextlib
 import csv
-import codecs
+import io
+import itertools
+import json
+import multiprocessing
+import os
 import pprint
 import re
-import xml.etree.cElementTree as ET
-import cerberus
-from Update_Street_Types import update_name
-from Clean_Postal_Codes import update_postal
-from Similar_Tags import update_tags
-from Clean_Phone_Numbers import update_phone
+import sys
+import time
+from osm_io import (get_element, get_element_range, get_element_data,
+                    find_chunks, stream_chunks, open_osm, compression,
+                    CHUNK_SIZE, PARSERS)
+from checkpoint import (Checkpoint, RejectLog, truncate, CHECKPOINT_PATH,
+                        REJECTS_PATH)
+from cleaning_rules import CLEANING_RULES, set_street_index
+from clipping import Clipper, load_area
+from metrics import Metrics, Progress, profiled, traced
+from node_store import GeometryOutput
+from normalize_cache import CACHE_SIZE, cache_stats, set_cache_size
 from schema import schema
+from schema_validator import SchemaValidator
+from sqlite_loader import SQLiteOutput, DB_PATH, way_node_rows
+from parquet_writer import ParquetOutput, OUT_DIR, ROW_GROUP_SIZE
+from spatial_index import SpatialIndexOutput, INDEX_PATH
 
 OSM_PATH = "sample_rj_map.osm"
 NODES_PATH = "nodes.csv"
@@ -17,6 +35,9 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+RELATIONS_PATH = "relations.csv"
+RELATION_MEMBERS_PATH = "relation_members.csv"
+RELATION_TAGS_PATH = "relation_tags.csv"
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
@@ -31,274 +52,646 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_MEMBERS_FIELDS = ['id', 'member_id', 'type', 'role', 'position']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
+
+ELEMENT_TAGS = ('node', 'way', 'relation')
+
+
+# Compact records for the shaped rows: tuples in the csv column order, so
+# they go to the writers as they are. Way node refs are kept in an
+# array('q'); the row of the i-th ref is (way id, ref, i).
+Node = collections.namedtuple('Node', NODE_FIELDS)
+Way = collections.namedtuple('Way', WAY_FIELDS)
+Relation = collections.namedtuple('Relation', RELATION_FIELDS)
+Tag = collections.namedtuple('Tag', NODE_TAGS_FIELDS)
+Member = collections.namedtuple('Member', RELATION_MEMBERS_FIELDS)
+
+
+def shape_tag(element_id, child, rules=CLEANING_RULES,
+              default_tag_type='regular'):
+    """Clean and shape a <tag> child of an element to a Tag record"""
+    #Key aliases, street types, postal codes and phones are fixed with a
+    #single lookup in the compiled rules table
+    key, value = rules.clean(child.get('k'), child.get('v'))
+
+    #key: the full tag "k" attribute value if no colon is present or the
+    #characters after the colon if one is.
+    #type: either the characters before the colon in the tag "k" value or
+    #"regular" if a colon is not present.
+    local_colon = key.find(':')
+    if local_colon > 0:
+        return Tag(element_id, key[local_colon+1:], value, key[:local_colon])
+    return Tag(element_id, key, value, default_tag_type)
 
 
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    """Clean and shape node or way XML element to Python dict"""
-
-    node_attribs = {}
-    node_child = {}#before tags
-    way_child = {} #before way_nodes ans tags
-    way_child2 = {} #before way_nodes ans tags
-    way_attribs = {}
-    way_nodes = []
-    tags = []  # Handle secondary tags the same way for both node and way elements
-    mapping = { "Av.": "Avenida",
-                               "Av": "Avenida",
-                               "av.": "Avenida",
-                               "Est.": "Estrada",
-                               "Estr.": "Estrada",
-                               "estrada": "Estrada",
-                               "PLAZA": "Praça",
-                               "Pca": "Praça",
-                               "Praca": "Praça",
-                               "Pça": "Praça",
-                               "Pça.": "Praça",
-                               "R.": "Rua",
-                               "Rod.": "Rodovia",
-                               "Ruas": "Rua",
-                               "Rue": "Rua",
-                               "Ruo": "Rua" ,
-                               "rua": "Rua",
-                               "vila": "Vila"
-                                }
-    mapping_tags = { 
-           "CEP_LD": "zip:right",
-           "CEP_LE": "zip:left",
-           "cep:par": "zip:right",
-           "cep:impar": "zip:left",
-           "addr:zipcode": "addr:postcode"
-            }
-    key_postal = ["zip:right", "zip:left", "addr:postcode" ]
-
-    #List of attribs that are useful in nodes and way
-    attribs_nodes = ["id", "user", "uid", "version", "lat", "lon", "timestamp",
-                     "changeset"]
-    attribs_way = ["id", "user", "uid", "version", "timestamp", "changeset"]
-    
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular',
+                  rules=CLEANING_RULES, relation_attr_fields=RELATION_FIELDS):
+    """
+    Clean and shape node, way or relation XML element to a dict of records.
+    Attributes missing from the element are None in the records.
+    """
+
     if element.tag == 'node':
-        for attrib in element.attrib:
-            #Get only the attribs and texts in attribs_nodes
-            if attrib in attribs_nodes: 
-                node_attribs[attrib] = element.get(attrib)
-        
-        i = 0 
-        #Get the child attribs 
-        for child in element:
-            i += 1
-            #id: the top level node id attribute value
-            node_child['id'] = element.get('id')
-
-            #value: the tag "v" attribute value
-            node_child['value'] = child.get('v')
-
-            #key: the full tag "k" attribute value if no colon is present or 
-            #the characters after 
-            #the colon if one is.
-            node_child['key'] = child.get('k')
-            local_colon = node_child['key'].find(':')
-            
-            ## Update Street Names
-            if node_child['key'] == 'addr:street':   
-                try: #try except was used because of the street names that had no type
-                    node_child['value'] = update_name(node_child['value'], mapping)
-                except KeyError:
-                    pass
-            
-            ## Update postal tags
-            if node_child['key'] in mapping_tags:
-                node_child['key'] = update_tags(child, mapping_tags)
-
-            
-            ## Update postal numbers
-            if node_child['key'] in key_postal:
-                node_child['value'] = update_postal(node_child['value'])
-
-            ## Update phone numbers
-            if node_child['key'] == 'phone':
-                node_child['value'] = update_phone(node_child['value'])
-                
-            if local_colon > 0:
-                aux = node_child['key']
-
-                node_child['key'] = aux[local_colon+1:len(aux)]
-
-                #type: either the characters before the colon in the tag "k" 
-                #value or "regular" 
-                #if a colon is not present.
-                node_child['type'] = aux[0:local_colon]
+        #Get only the attribs in node_attr_fields
+        attrib = element.attrib
+        node = Node._make(map(attrib.get, node_attr_fields))
+        tags = [shape_tag(node.id, child, rules, default_tag_type)
+                for child in element]
+        return {'node': node, 'node_tags': tags}
 
-            else:
-                node_child['type'] = "regular"
-            
-            tags.append(node_child.copy())
-            
-        #if i == 0:
-        #    tags.append({'value': '', 'type': '', 'id': element.get('id'), 
-        #                'key': ''})
-        
-        return {'node': node_attribs, 'node_tags': tags}
-
-        
     if element.tag == 'way':
-        for attrib in element.attrib:
-            #Get only the attribs and texts in attribs_way
-            if attrib in attribs_way: 
-                way_attribs[attrib] = element.get(attrib)
-
-        
-        position = 0 
-        #Get the child attribs 
-
+        #Get only the attribs in way_attr_fields
+        attrib = element.attrib
+        way = Way._make(map(attrib.get, way_attr_fields))
+        #Each <nd> adds its ref; the position is its index in the array
+        way_nodes = array.array('q')
+        tags = []
         for child in element:
             if child.tag == 'nd':
-                way_child2['id'] = element.get('id') 
-                way_child2['node_id'] = child.get('ref')
-                way_child2['position'] = position
+                way_nodes.append(int(child.get('ref')))
+            elif child.tag == 'tag':
+                tags.append(shape_tag(way.id, child, rules, default_tag_type))
+
+        return {'way': way, 'way_nodes': way_nodes, 'way_tags': tags}
+
+    if element.tag == 'relation':
+        #Get only the attribs in relation_attr_fields
+        attrib = element.attrib
+        relation = Relation._make(map(attrib.get, relation_attr_fields))
+        members = []
+        tags = []
+        position = 0
+        for child in element:
+            if child.tag == 'member':
+                #type: node, way or relation; role: e.g. outer, stop
+                members.append(Member(relation.id, child.get('ref'),
+                                      child.get('type'), child.get('role', ''),
+                                      position))
                 position += 1
-            
-            if way_child2 not in way_nodes:
-                way_nodes.append(way_child2.copy())
-            
-            i = 0 
-            if child.tag == 'tag':
-                #Get the child attribs 
-                i += 1
-                
-                #id: the top level node id attribute value
-                way_child['id'] = element.get('id')
-
-                #value: the tag "v" attribute value
-                way_child['value'] = child.get('v')
-
-                
-                #key: the full tag "k" attribute value if no colon is present 
-                #or the characters after 
-                #the colon if one is.
-                way_child['key'] = child.get('k')
-
-                local_colon = way_child['key'].find(':')
-                
-                ## Update Street Names
-                if way_child['key'] == 'addr:street':   
-                    try: #try except was used because of the street names that had no type
-                        way_child['value'] = update_name(way_child['value'], mapping)
-                    except KeyError:
-                        pass
-                    
-                ## Update postal tags
-                if way_child['key'] in mapping_tags:
-                    way_child['key'] = update_tags(child, mapping_tags)
-
-                
-                ## Update postal numbers
-                if way_child['key'] in  key_postal:
-                    way_child['value'] = update_postal(way_child['value'])
-                
-                ## Update phone numbers
-                if way_child['key'] == 'phone':
-                    way_child['value'] = update_phone(way_child['value'])
-            
-                if local_colon > 0:
-                    aux = way_child['key']
-                    way_child['key'] = aux[local_colon+1:len(aux)]
-
-                    #type: either the characters before the colon in the tag 
-                    #"k" value or "regular" 
-                    #if a colon is not present.
-                    way_child['type'] = aux[0:local_colon]
-
-                else:
-                    way_child['type'] = "regular"
-                    
-
-
-                tags.append(way_child.copy())
-                
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
-        
-
-# ================================================== #
-#               Helper Functions                     #
-# ================================================== #
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+            elif child.tag == 'tag':
+                tags.append(shape_tag(relation.id, child, rules,
+                                      default_tag_type))
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+        return {'relation': relation, 'relation_members': members,
+                'relation_tags': tags}
 
 
-def validate_element(element, validator, schema=SCHEMA):
-    """Raise ValidationError if element does not match schema"""
-    if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
-        message_string = "\nElement of type '{0}' has the following errors:\n{1}"
-        error_string = pprint.pformat(errors)
-        
-        raise Exception(message_string.format(field, error_string))
+def element_document(el):
+    """
+    Returns the dict view of a shaped element that the schema describes,
+    e.g. {'node': {...}, 'node_tags': [{...}]}, for validation.
+    """
+    if 'way' in el:
+        way_id = el['way'].id
+        return {'way': _document(el['way']),
+                'way_nodes': [{'id': way_id, 'node_id': node_id,
+                               'position': position}
+                              for position, node_id in enumerate(el['way_nodes'])],
+                'way_tags': [tag._asdict() for tag in el['way_tags']]}
+    return dict((name, [record._asdict() for record in value]
+                 if isinstance(value, list) else _document(value))
+                for name, value in el.items())
 
 
-class UnicodeDictWriter(csv.DictWriter, object):
-    """Extend csv.DictWriter to handle Unicode input"""
+def _document(record):
+    #Missing attributes are left out, like they were in the dicts
+    return dict((field, value) for field, value in zip(record._fields, record)
+                if value is not None)
 
-    def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-            k: (v.encode('utf-8') if isinstance(v, str) else v) for k, v 
-            in row.items()
-        })
 
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+# ================================================== #
+#               Helper Functions                     #
+# ================================================== #
+def validate_element(element, validator, schema=SCHEMA, rejects=None):
+    """
+    Raise ValidationError if element does not match schema. With a rejects
+    list (or RejectLog) the element is added to it and False is returned
+    instead.
+    """
+    if validator.validate(element_document(element), schema) is not True:
+        if rejects is None:
+            raise_validation_error(validator.errors)
+        rejects.append(reject_record(element, validator.errors))
+        return False
+    return True
+
+
+def validate_elements(elements, validator, schema=SCHEMA, rejects=None):
+    """
+    Batch version of validate_element for a block of shaped elements.
+    Returns: the valid elements (all of them unless rejects is given)
+    """
+    invalid = validator.validate_many(map(element_document, elements), schema)
+    if not invalid:
+        return elements
+    if rejects is None:
+        index, errors = invalid[0]
+        raise_validation_error(errors)
+    bad = set(index for index, _ in invalid)
+    rejects.extend(reject_record(elements[index], errors)
+                   for index, errors in invalid)
+    return [el for index, el in enumerate(elements) if index not in bad]
+
+
+def element_key(el):
+    """Returns the (tag, id) of a shaped element"""
+    for tag in ELEMENT_TAGS:
+        if tag in el:
+            return tag, el[tag].id
+    return None
+
+
+def reject_record(element, errors):
+    """
+    The rejects file entry of an element that did not validate (a shaped
+    element) or could not be shaped (a parsed element and the exception).
+    """
+    if isinstance(errors, Exception):
+        return {'tag': element.tag, 'id': element.get('id'),
+                'errors': repr(errors)}
+    tag, element_id = element_key(element)
+    return {'tag': tag, 'id': element_id, 'errors': errors,
+            'element': element_document(element)}
+
+
+def raise_validation_error(errors):
+    field, errors = next(iter(errors.items()))
+    message_string = "\nElement of type '{0}' has the following errors:\n{1}"
+    error_string = pprint.pformat(errors)
+
+    raise Exception(message_string.format(field, error_string))
+
+
+CSV_PATHS = [NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH,
+             WAY_TAGS_PATH, RELATIONS_PATH, RELATION_MEMBERS_PATH,
+             RELATION_TAGS_PATH]
+CSV_BUFFER_SIZE = 1024 * 1024
+
+
+class CsvOutput(object):
+    """
+    Writes shaped elements to the eight csv files as utf-8 text, one record
+    per row (the records are already in the fields order), through
+    buffer_size byte buffers. With sizes (from a checkpoint) the files are
+    cut back to those sizes and appended to instead of replaced.
+    """
+
+    def __init__(self, out_dir=OUT_DIR, buffer_size=CSV_BUFFER_SIZE,
+                 sizes=None):
+        self.out_dir = out_dir
+        self.buffer_size = buffer_size
+        self.sizes = sizes
+        self.files = []
+
+    def __enter__(self):
+        fields = [NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS,
+                  WAY_TAGS_FIELDS, RELATION_FIELDS, RELATION_MEMBERS_FIELDS,
+                  RELATION_TAGS_FIELDS]
+        writers = []
+        for path, row_fields in zip(CSV_PATHS, fields):
+            full_path = os.path.join(self.out_dir, path)
+            if self.sizes is not None:
+                truncate(full_path, self.sizes[path])
+            f = io.open(full_path, 'w' if self.sizes is None else 'a',
+                        encoding='utf-8', newline='',
+                        buffering=self.buffer_size)
+            self.files.append(f)
+            writer = csv.writer(f)
+            if self.sizes is None:
+                writer.writerow(row_fields)
+            writers.append(writer)
+
+        self.nodes_writer, self.node_tags_writer, self.ways_writer, \
+            self.way_nodes_writer, self.way_tags_writer, \
+            self.relations_writer, self.relation_members_writer, \
+            self.relation_tags_writer = writers
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for f in self.files:
+            f.close()
+        self.files = []
+
+    def flush(self):
+        """Flushes the files and returns their sizes, by csv name"""
+        sizes = {}
+        for path, f in zip(CSV_PATHS, self.files):
+            f.flush()
+            sizes[path] = f.buffer.tell()
+        return sizes
+
+    def write(self, el):
+        #Missing attributes are None, which csv writes as an empty column
+        if 'node' in el:
+            self.nodes_writer.writerow(el['node'])
+            self.node_tags_writer.writerows(el['node_tags'])
+        elif 'way' in el:
+            way_id = el['way'].id
+            self.ways_writer.writerow(el['way'])
+            self.way_nodes_writer.writerows(
+                way_node_rows(way_id, el['way_nodes']))
+            self.way_tags_writer.writerows(el['way_tags'])
+        elif 'relation' in el:
+            self.relations_writer.writerow(el['relation'])
+            self.relation_members_writer.writerows(el['relation_members'])
+            self.relation_tags_writer.writerows(el['relation_tags'])
+
+
+class MultiOutput(object):
+    """Writes every shaped element to each of several outputs"""
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+        self._stack = None
+
+    def __enter__(self):
+        self._stack = contextlib.ExitStack()
+        with self._stack:
+            for output in self.outputs:
+                self._stack.enter_context(output)
+            self._stack = self._stack.pop_all()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._stack.__exit__(exc_type, exc_value, traceback)
+
+    def write(self, el):
+        for output in self.outputs:
+            output.write(el)
+
+
+def open_output(output='csv', db_path=DB_PATH, out_dir=OUT_DIR,
+                row_group_size=ROW_GROUP_SIZE, spatial_index=False,
+                geometry=False, buffer_size=CSV_BUFFER_SIZE):
+    """
+    Returns the writer for the 'csv', 'sqlite', 'parquet' or 'arrow' mode.
+    With spatial_index the rtree tables go into the database, or into
+    out_dir/spatial_index.db for the file outputs. With geometry the way
+    geometries go into the ways_geometry table, or out_dir/ways_geometry.csv.
+    buffer_size is the byte buffer of each csv file.
+    """
+    if output == 'csv':
+        writer = CsvOutput(out_dir, buffer_size)
+    elif output == 'sqlite':
+        return SQLiteOutput(db_path, spatial_index=spatial_index,
+                            geometry=geometry)
+    elif output in ('parquet', 'arrow'):
+        writer = ParquetOutput(out_dir, row_group_size, file_format=output)
+    else:
+        raise ValueError("unknown output mode: %r" % (output,))
+    outputs = [writer]
+    if spatial_index:
+        outputs.append(SpatialIndexOutput(os.path.join(out_dir, INDEX_PATH)))
+    if geometry:
+        outputs.append(GeometryOutput(out_dir))
+    if len(outputs) > 1:
+        return MultiOutput(outputs)
+    return writer
+
+
+def shape_elements(elements, validate, metrics=None, rejects=None):
+    """
+    Shape (and validate if asked) each element, skipping empty results.
+    With a metrics.Metrics, parsing, shaping, validation and each cleaning
+    rule are timed and counted. With a rejects list (or RejectLog), the
+    elements that fail to shape or validate go to it and are skipped.
+    """
+    validator = SchemaValidator(SCHEMA)
+    shape, check, rules = shape_element, validate_element, CLEANING_RULES
+    if metrics is not None:
+        elements = metrics.timed(elements, 'parse')
+        shape = metrics.timed_call(shape_element, 'shape')
+        check = metrics.timed_call(validate_element, 'validate')
+        rules = metrics.instrument_rules(rules)
+    for element in elements:
+        if rejects is None:
+            el = shape(element, rules=rules)
+        else:
+            try:
+                el = shape(element, rules=rules)
+            except Exception as e:
+                rejects.append(reject_record(element, e))
+                continue
+        if el:
+            if validate is True and not check(el, validator,
+                                              rejects=rejects):
+                continue
+            yield el
+
+
+def shape_chunk(args):
+    """
+    Shape the elements found in one chunk of the file (pool worker): a byte
+    range of file_in, or the bytes of a chunk from stream_chunks when
+    file_in is that data and start and end are None.
+    Returns: the shaped elements, the state of the chunk metrics when
+    instrument is set (None otherwise) and the rejected elements when
+    skip_invalid is set (None otherwise)
+    """
+    (file_in, start, end, validate, tags, parser, clip, instrument,
+     skip_invalid) = args
+    metrics = Metrics() if instrument else None
+    rejects = [] if skip_invalid else None
+    if start is None:
+        elements = get_element_data(file_in, tags=tags, parser=parser,
+                                    clip=clip)
+    else:
+        elements = get_element_range(file_in, start, end, tags=tags,
+                                     parser=parser, clip=clip)
+    shaped = list(shape_elements(elements, validate=False, metrics=metrics,
+                                 rejects=rejects))
+    if validate is True:
+        started = time.perf_counter()
+        shaped = validate_elements(shaped, SchemaValidator(SCHEMA),
+                                   rejects=rejects)
+        if metrics is not None:
+            metrics.add('validate', time.perf_counter() - started, len(shaped))
+    return shaped, metrics.state() if metrics is not None else None, rejects
+
+
+def pool_exit(pool):
+    """
+    ExitStack exit callback of a process pool: on success it is closed and
+    joined, so the workers exit normally; on an error it is terminated.
+    """
+    def finish(exc_type, exc_value, traceback):
+        if exc_type is None:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+    return finish
+
+
+def imap_ordered(pool, func, items, window):
+    """Like pool.imap but with at most `window` results waiting in memory"""
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+def init_worker(cache_size, street_index=None):
+    #Each pool worker loads the same street index and has its own normalizer
+    #caches, sized like ours
+    set_street_index(street_index)
+    set_cache_size(cache_size)
+
+
+def process_map(file_in, validate, workers=1, chunk_size=CHUNK_SIZE,
+                output='csv', db_path=DB_PATH, out_dir=OUT_DIR,
+                row_group_size=ROW_GROUP_SIZE, cache_size=CACHE_SIZE,
+                relations=True, parser='etree', spatial_index=False,
+                clip=None, metrics=None, progress=False, geometry=False,
+                checkpoint=None, resume=False, skip_invalid=False,
+                street_index=None, buffer_size=CSV_BUFFER_SIZE):
+    """
+    Iteratively process each XML element and write to csv(s), straight
+    into a typed SQLite database with output='sqlite', or to columnar files
+    in out_dir with output='parquet' or 'arrow'. Relations go to their own
+    tables unless relations=False. parser picks the osm_io parser backend.
+    spatial_index=True also builds the rtree index of spatial_index.py.
+    clip (a clipping.ClipArea) drops the elements outside an area.
+    geometry=True also writes the bbox, length and linestring of each way,
+    from the node locations kept in a node_store.NodeStore.
+    metrics (a metrics.Metrics) collects the time and count of each stage
+    and cleaning rule; progress=True prints the bytes done, elements/s and
+    ETA to stderr.
+    checkpoint (a file path) makes the run go chunk by chunk and record
+    after each one what resume=True needs to go on from there (see
+    checkpoint.py); only the plain csv output can be checkpointed.
+    skip_invalid=True writes the elements that fail to shape or validate
+    to out_dir/rejects.jsonl instead of stopping the run.
+    street_index (the file of a street_index.StreetIndex) gives each street
+    name its canonical spelling. buffer_size is the byte buffer of each csv
+    file.
+
+    With workers > 1 the file is split at element boundaries into byte
+    ranges that are shaped in a process pool; the chunks are written back in
+    file order so the output is identical to the serial one.
+    """
+
+    tags = ELEMENT_TAGS if relations else ('node', 'way')
+    init_worker(cache_size, street_index)
+    size = os.path.getsize(file_in)
+    reporter = Progress(size) if progress else None
+    saver = state = None
+    if checkpoint is not None:
+        if (output != 'csv' or spatial_index or geometry or
+                clip is not None):
+            raise ValueError("only the csv output without spatial index, "
+                             "geometry or clip can be checkpointed")
+        saver = Checkpoint(checkpoint, {
+            'file': os.path.abspath(file_in), 'size': size,
+            'chunk_size': chunk_size, 'validate': validate,
+            'relations': relations, 'parser': parser,
+            'skip_invalid': skip_invalid,
+            'street_index': os.path.abspath(street_index)
+            if street_index is not None else None})
+        if resume:
+            state = saver.load()
+    elif resume:
+        raise ValueError("resume needs the checkpoint file")
+    with contextlib.ExitStack() as stack:
+        if saver is not None:
+            out = stack.enter_context(CsvOutput(
+                out_dir, buffer_size,
+                sizes=state['sizes'] if state else None))
+        else:
+            out = stack.enter_context(open_output(
+                output, db_path, out_dir, row_group_size, spatial_index,
+                geometry, buffer_size))
+        rejects = None
+        if skip_invalid:
+            rejects = stack.enter_context(RejectLog(
+                os.path.join(out_dir, REJECTS_PATH),
+                state['rejects'] if state else None))
+        write = out.write
+        if metrics is not None:
+            write = metrics.timed_call(out.write, 'write')
+        if workers > 1 or saver is not None:
+            instrument = metrics is not None
+            if compression(file_in) is None:
+                source = None
+                chunks = [(file_in, start, end, validate, tags, parser, clip,
+                           instrument, skip_invalid)
+                          for start, end in find_chunks(file_in, chunk_size)]
+            else:
+                #No byte ranges in a compressed file: the decompressed
+                #stream is cut into chunks that are sent to the workers
+                source = stack.enter_context(open_osm(file_in))
+                chunks = ((data, None, None, validate, tags, parser, clip,
+                           instrument, skip_invalid)
+                          for data in stream_chunks(source, chunk_size))
+            done = 0
+            last = None
+            if state is not None:
+                done = state['chunks']
+                last = state['last']
+                chunks = itertools.islice(chunks, done, None)
+            #Input offset reached by each chunk sent, in order
+            ends = collections.deque()
+
+            def sent(chunks):
+                for chunk in chunks:
+                    ends.append(chunk[2])
+                    yield chunk
+
+            #The workers drop the nodes outside the clip area; ways and
+            #relations are decided here, once the nodes before them are known
+            clipper = Clipper(clip) if clip is not None else None
+            if workers > 1:
+                pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                            initargs=(cache_size,
+                                                      street_index))
+                stack.push(pool_exit(pool))
+                results = imap_ordered(pool, shape_chunk, sent(chunks),
+                                       window=2 * workers)
+            else:
+                results = map(shape_chunk, sent(chunks))
+            if metrics is not None:
+                results = metrics.timed(results, 'wait')
+            written = 0
+            for shaped, chunk_metrics, chunk_rejects in results:
+                if chunk_metrics is not None:
+                    metrics.merge(chunk_metrics)
+                if chunk_rejects:
+                    rejects.extend(chunk_rejects)
+                for el in shaped:
+                    if clipper is None or clipper.keep_shaped(el):
+                        write(el)
+                written += len(shaped)
+                done += 1
+                end = ends.popleft()
+                offset = end if source is None else source.position
+                if saver is not None:
+                    if shaped:
+                        last = element_key(shaped[-1])
+                    saver.save(done, offset, last, out.flush(),
+                               rejects.flush() if rejects is not None
+                               else None)
+                if reporter is not None:
+                    reporter.update(offset, written)
+            if reporter is not None:
+                reporter.finish(written)
+        else:
+            source = stack.enter_context(open_osm(file_in))
+            elements = get_element(source, tags=tags, parser=parser,
+                                   clip=clip)
+            shaped = shape_elements(elements, validate, metrics, rejects)
+            if reporter is not None:
+                shaped = reporter.follow(shaped, lambda: source.position)
+            for el in shaped:
+                write(el)
+    if saver is not None:
+        #The run is complete: there is nothing left to resume
+        saver.remove()
+    if metrics is not None:
+        metrics.extra.update({'file': file_in, 'bytes': size,
+                              'workers': workers, 'parser': parser,
+                              'output': output})
+        if rejects is not None:
+            metrics.extra['rejects'] = rejects.count
+        if workers <= 1:
+            metrics.extra['cache'] = cache_stats()
 
 
 if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
-    process_map(OSM_PATH, validate=True)
+    parser = argparse.ArgumentParser(
+        description="Clean an OpenStreetMap file and write it to csv(s), "
+                    "SQLite or Parquet")
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="shape byte range chunks in N processes")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="approximate chunk size in bytes")
+    parser.add_argument('--no-validate', dest='validate', action='store_false')
+    parser.add_argument('--parser', choices=PARSERS, default='etree',
+                        help="XML parser backend (etree is the reference)")
+    parser.add_argument('--no-relations', dest='relations',
+                        action='store_false',
+                        help="only convert nodes and ways")
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        help="values cached per normalizer (0 disables)")
+    parser.add_argument('--cache-stats', action='store_true',
+                        help="print the normalizer cache hits and misses")
+    parser.add_argument('--output', choices=('csv', 'sqlite', 'parquet', 'arrow'),
+                        default='csv')
+    parser.add_argument('--db', default=DB_PATH,
+                        help="database file for --output sqlite")
+    parser.add_argument('--out-dir', default=OUT_DIR,
+                        help="directory for --output csv/parquet/arrow")
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE,
+                        help="rows per Parquet row group")
+    parser.add_argument('--buffer-size', type=int, default=CSV_BUFFER_SIZE,
+                        help="bytes buffered per csv file")
+    parser.add_argument('--spatial-index', action='store_true',
+                        help="build an rtree index of nodes and way bboxes")
+    parser.add_argument('--clip', type=load_area,
+                        help="only keep what is inside minlat,minlon,maxlat,"
+                             "maxlon (as --clip=... when it starts with "
+                             "'-'), a GeoJSON polygon or an .osm boundary")
+    parser.add_argument('--geometry', action='store_true',
+                        help="write the bbox, length and linestring of "
+                             "each way")
+    parser.add_argument('--street-index', metavar='JSON',
+                        help="give street names their canonical spelling "
+                             "from a street_index.py index")
+    parser.add_argument('--checkpoint', action='store_true',
+                        help="record a checkpoint after each chunk (csv "
+                             "output only)")
+    parser.add_argument('--resume', action='store_true',
+                        help="go on from the last checkpoint of an "
+                             "interrupted --checkpoint run")
+    parser.add_argument('--skip-invalid', action='store_true',
+                        help="write the elements that fail to shape or "
+                             "validate to rejects.jsonl instead of stopping")
+    parser.add_argument('--progress', action='store_true',
+                        help="print the progress and ETA to stderr")
+    parser.add_argument('--metrics', metavar='JSON',
+                        help="write the time and count of each stage and "
+                             "cleaning rule to a JSON file")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="run under cProfile and dump the stats to FILE")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="trace allocations; the peak and top sites go "
+                             "to the --metrics report (slow)")
+    args = parser.parse_args()
+
+    # Note: Validation uses the schema compiled by schema_validator and only
+    # adds a few percent to the run time, so it can stay on for full runs.
+    metrics = Metrics() if args.metrics or args.tracemalloc else None
+    with contextlib.ExitStack() as hooks:
+        if args.profile:
+            hooks.enter_context(profiled(args.profile))
+        if args.tracemalloc:
+            hooks.enter_context(traced(metrics))
+        process_map(args.osm_file, validate=args.validate,
+                    workers=args.workers, chunk_size=args.chunk_size,
+                    output=args.output, db_path=args.db, out_dir=args.out_dir,
+                    row_group_size=args.row_group_size,
+                    cache_size=args.cache_size, relations=args.relations,
+                    parser=args.parser, spatial_index=args.spatial_index,
+                    clip=args.clip, metrics=metrics, progress=args.progress,
+                    geometry=args.geometry,
+                    checkpoint=os.path.join(args.out_dir, CHECKPOINT_PATH)
+                    if args.checkpoint or args.resume else None,
+                    resume=args.resume, skip_invalid=args.skip_invalid,
+                    street_index=args.street_index,
+                    buffer_size=args.buffer_size)
+    if args.metrics:
+        metrics.write_json(args.metrics)
+    elif metrics is not None:
+        json.dump(metrics.report(), sys.stdout, indent=2, sort_keys=True)
+    if args.cache_stats:
+        #With --workers the normalizers run (and count) in the pool
+        pprint.pprint(cache_stats())
@@ -0,0 +1,20 @@
+"""
+Loads the cleaning rules data (street types, key aliases, postal and phone
+keys) from cleaning_rules.json, so a city's abbreviations are edited there
+and not in the code.
+"""
+import io
+import json
+import os
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "cleaning_rules.json")
+
+
+def load_rules(path=RULES_PATH):
+    """Returns the rules dict stored in the json file at path"""
+    with io.open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+RULES = load_rules()
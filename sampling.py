@@ -1,33 +1,387 @@
-import xml.etree.ElementTree as ET
+"""
+Creates a smaller OSM file from a full extract, e.g. sample_rj_map.osm.
+
+Modes:
+    every:     every k-th element, like the original sample (k=100)
+    reservoir: exactly --size elements picked at random
+    grid:      up to --size nodes at random from each cell of a grid over
+               --bbox, with the ways that use them
+
+The ways of the sample bring the nodes they reference along, so no way
+points to a missing node. Random picks rank the elements by a seeded
+hash of their id instead of drawing numbers in file order, so the same
+seed gives the same sample whether the file is read in one pass or in
+byte ranges by several workers.
+
+Usage:
+    python sampling.py [rj_map.osm] [sample_rj_map.osm] [--mode every]
+        [--k 100] [--size N] [--bbox=minlat,minlon,maxlat,maxlon]
+        [--grid 10x10] [--seed 0] [--workers 1] [--chunk-size BYTES]
+        [--no-close]
+
+    The bbox goes after "=" (--bbox=-23.1,-43.8,-22.7,-43.1): argparse
+    takes a separate value starting with "-" for an option.
+"""
+import argparse
+import heapq
+import itertools
+import multiprocessing
+import xml.etree.cElementTree as ET
+
+from osm_io import (get_element, get_element_range, find_chunks, compression,
+                    is_pbf, CHUNK_SIZE, ELEMENT_START, BLOCK_SIZE,
+                    NodeIdBitmap, OsmRecord)
 
 OSM_FILE = "rj_map.osm"
 SAMPLE_FILE = "sample_rj_map.osm"
 
-k = 100
+MODES = ('every', 'reservoir', 'grid')
+ELEMENT_TAGS = ('node', 'way', 'relation')
+K = 100
+GRID = (10, 10)
+
+MASK = (1 << 64) - 1
+TYPE_CODES = {'node': 1, 'way': 2, 'relation': 3}
+
+
+# ================================================== #
+#               Seeded ranks                         #
+# ================================================== #
+def splitmix64(x):
+    """The SplitMix64 mixing function: a well spread 64 bit hash of x"""
+    x = (x + 0x9E3779B97F4A7C15) & MASK
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK
+    return x ^ (x >> 31)
+
+
+def rank(seed, tag, osm_id):
+    """Random but reproducible rank of an element for a seed"""
+    key = splitmix64((seed ^ (TYPE_CODES[tag] << 60)) & MASK)
+    return splitmix64(key ^ (osm_id & MASK))
+
+
+# ================================================== #
+#               Selection passes                     #
+# ================================================== #
+def _elements(path, span, tags=ELEMENT_TAGS):
+    #span is a (start, end) byte range, or None for the whole file
+    if span is None:
+        return get_element(path, tags=tags)
+    return get_element_range(path, span[0], span[1], tags=tags)
+
+
+def _refs(element):
+    return [int(nd.get('ref')) for nd in element.iter('nd')]
+
+
+def new_selection():
+    """Returns the ids to keep, one NodeIdBitmap per element type"""
+    return dict((tag, NodeIdBitmap()) for tag in ELEMENT_TAGS)
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
+
+def _select(selection, tag, osm_id, refs, close):
+    selection[tag].add(osm_id)
+    if close and refs:
+        selection['node'].update(refs)
+
+
+def count_elements(path, span):
+    """Number of top level elements in a byte range, without parsing it"""
+    start, end = span
+    if is_pbf(path):
+        #Binary, so the blobs of the range are decoded instead
+        return sum(1 for _ in get_element_range(path, start, end))
+    count = 0
+    carry = b''
+    with open(path, 'rb') as f:
+        f.seek(start)
+        left = end - start
+        while left > 0:
+            block = f.read(min(BLOCK_SIZE, left))
+            if not block:
+                break
+            left -= len(block)
+            data = carry + block
+            #The last bytes may hold the beginning of an element start, so
+            #they are only searched with the next block
+            limit = len(data) if left <= 0 else max(0, len(data) - 16)
+            count += sum(1 for m in ELEMENT_START.finditer(data)
+                         if m.start() < limit)
+            carry = data[limit:]
+    return count
+
+
+def select_every(path, span, offset, k, close=True):
+    """Selects the elements whose index in the file is a multiple of k"""
+    selection = new_selection()
+    for i, element in enumerate(_elements(path, span), offset):
+        if i % k == 0:
+            _select(selection, element.tag, int(element.get('id')),
+                    _refs(element) if element.tag == 'way' else None, close)
+    return selection
+
+
+def select_reservoir(path, span, size, seed):
     """
-        Parses through file and gets specified elements.
-        Args: 
-            osm_file: OpenStreetMap data
-            tags: The three tags of interest; node, way, and relation.
-        Yield:
-            Yield element if it is the right type of tag
+        Returns the (rank, tag, id, refs) of the size lowest ranked elements.
+        Keeping the lowest ranks of a uniform hash is a reservoir sample
+        that can be merged across byte ranges.
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
-
-with open(SAMPLE_FILE, 'wb') as output:
-    """ Creates a subset of the code for every kth element """
-    #output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    #output.write('<osm>\n  ')
-
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
+    heap = []
+    for element in _elements(path, span):
+        osm_id = int(element.get('id'))
+        element_rank = rank(seed, element.tag, osm_id)
+        if len(heap) >= size and element_rank >= -heap[0][0]:
+            continue
+        refs = _refs(element) if element.tag == 'way' else None
+        item = (-element_rank, element.tag, osm_id, refs)
+        if len(heap) < size:
+            heapq.heappush(heap, item)
+        else:
+            heapq.heapreplace(heap, item)
+    return [(-neg_rank, tag, osm_id, refs)
+            for neg_rank, tag, osm_id, refs in heap]
+
+
+def grid_cell(lat, lon, bbox, grid):
+    """Returns the index of the grid cell of a point, None outside bbox"""
+    minlat, minlon, maxlat, maxlon = bbox
+    if not (minlat <= lat <= maxlat and minlon <= lon <= maxlon):
+        return None
+    rows, cols = grid
+    row = min(int((lat - minlat) / (maxlat - minlat) * rows), rows - 1)
+    col = min(int((lon - minlon) / (maxlon - minlon) * cols), cols - 1)
+    return row * cols + col
+
+
+def select_grid_nodes(path, span, bbox, grid, size, seed):
+    """Returns {cell: [(rank, id)]} of the size lowest ranked nodes per cell"""
+    heaps = {}
+    for element in _elements(path, span, tags=('node',)):
+        cell = grid_cell(float(element.get('lat')), float(element.get('lon')),
+                         bbox, grid)
+        if cell is None:
+            continue
+        osm_id = int(element.get('id'))
+        item = (-rank(seed, 'node', osm_id), osm_id)
+        heap = heaps.setdefault(cell, [])
+        if len(heap) < size:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    return dict((cell, [(-neg_rank, osm_id) for neg_rank, osm_id in heap])
+                for cell, heap in heaps.items())
+
+
+def select_grid_ways(path, span, close, nodes):
+    """Selects the ways that use one of the nodes"""
+    selection = new_selection()
+    for element in _elements(path, span, tags=('way',)):
+        refs = _refs(element)
+        if any(ref in nodes for ref in refs):
+            _select(selection, 'way', int(element.get('id')), refs, close)
+    return selection
+
+
+# ================================================== #
+#               Output                               #
+# ================================================== #
+def write_elements(path, span, selection):
+    """
+        Returns the XML of the selected elements of a byte range and the
+        number of them per type.
+    """
+    parts = []
+    counts = dict((tag, 0) for tag in ELEMENT_TAGS)
+    for element in _elements(path, span):
+        if int(element.get('id')) in selection[element.tag]:
+            counts[element.tag] += 1
+            if isinstance(element, OsmRecord):
+                #From a PBF file
+                element = element.to_element()
+            parts.append('  ' + ET.tostring(element, encoding='unicode')
+                         .strip() + '\n')
+    return ''.join(parts).encode('utf-8'), counts
+
+
+def write_header(output, bbox=None):
+    output.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+    output.write(b'<osm version="0.6" generator="sampling.py">\n')
+    if bbox is not None:
+        output.write(('  <bounds minlat="%r" minlon="%r" maxlat="%r" '
+                      'maxlon="%r"/>\n' % tuple(bbox)).encode('utf-8'))
+
+
+def write_footer(output):
+    output.write(b'</osm>\n')
+
+
+# ================================================== #
+#               Sampler                              #
+# ================================================== #
+_worker_state = {}
+
+
+def _init_worker(path, selection):
+    _worker_state['path'] = path
+    _worker_state['selection'] = selection
+
+
+def _call(task):
+    #Runs one pass function on a byte range in a worker process
+    func, args = task
+    if func is write_elements or func is select_grid_ways:
+        args = args + (_worker_state['selection'],)
+    return func(_worker_state['path'], *args)
+
+
+def _map(pool, path, func, tasks, selection=None):
+    if pool is None:
+        if func is write_elements or func is select_grid_ways:
+            tasks = [args + (selection,) for args in tasks]
+        return [func(path, *args) for args in tasks]
+    return pool.map(_call, [(func, args) for args in tasks])
+
+
+def _restart(pool, workers, path, selection):
+    #The workers get a new selection once, not with every range: the old
+    #pool is closed and joined before the next one starts
+    pool.close()
+    pool.join()
+    return multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(path, selection))
+
+
+def _merge(selections):
+    selection = new_selection()
+    for other in selections:
+        for tag, ids in other.items():
+            selection[tag].union(ids)
+    return selection
+
+
+def sample(osm_file=OSM_FILE, sample_file=SAMPLE_FILE, mode='every', k=K,
+           size=None, bbox=None, grid=GRID, seed=0, workers=1,
+           chunk_size=CHUNK_SIZE, close=True):
+    """
+        Writes a sample of osm_file to sample_file as an OSM XML file.
+        Args:
+            osm_file: the OpenStreetMap file to sample
+            sample_file: the OSM file written
+            mode: 'every', 'reservoir' or 'grid'
+            k: keep every k-th element ('every')
+            size: number of elements ('reservoir') or nodes per cell ('grid')
+            bbox: (minlat, minlon, maxlat, maxlon) of the grid ('grid')
+            grid: (rows, cols) of the grid ('grid')
+            seed: seed of the random picks
+            workers: processes reading byte ranges of osm_file in parallel
+                (compressed files are read by one process)
+            chunk_size: approximate size of each byte range in bytes
+            close: also keep the nodes of the sampled ways
+        Returns: a dict with the number of elements written per type
+    """
+    if mode not in MODES:
+        raise ValueError("unknown sampling mode: %r" % (mode,))
+    if mode != 'every' and not size:
+        raise ValueError("the %s mode needs a size" % mode)
+    if mode == 'grid' and bbox is None:
+        raise ValueError("the grid mode needs a bbox")
+
+    if workers > 1 and compression(osm_file) is not None:
+        #Every pass would decompress the whole file in each worker; one
+        #pass over the stream is cheaper
+        workers = 1
+    if workers > 1:
+        spans = find_chunks(osm_file, chunk_size)
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(osm_file, None))
+    else:
+        spans = [None]
+        pool = None
+    try:
+        if mode == 'every':
+            #Every k-th element of the whole file, so each range needs the
+            #index of its first element
+            if pool is None:
+                offsets = [0]
+            else:
+                counts = pool.map(_call, [(count_elements, (span,))
+                                          for span in spans])
+                offsets = list(itertools.accumulate([0] + counts[:-1]))
+            selection = _merge(_map(pool, osm_file, select_every,
+                                    [(span, offset, k, close) for span, offset
+                                     in zip(spans, offsets)]))
+        elif mode == 'reservoir':
+            candidates = heapq.nsmallest(size, itertools.chain.from_iterable(
+                _map(pool, osm_file, select_reservoir,
+                     [(span, size, seed) for span in spans])))
+            selection = new_selection()
+            for _, tag, osm_id, refs in candidates:
+                _select(selection, tag, osm_id, refs, close)
+        else:
+            cells = {}
+            for result in _map(pool, osm_file, select_grid_nodes,
+                               [(span, bbox, grid, size, seed)
+                                for span in spans]):
+                for cell, items in result.items():
+                    cells.setdefault(cell, []).extend(items)
+            nodes = NodeIdBitmap(osm_id for items in cells.values()
+                                 for _, osm_id in heapq.nsmallest(size, items))
+            if pool is not None:
+                pool = _restart(pool, workers, osm_file, nodes)
+            selection = _merge(_map(pool, osm_file, select_grid_ways,
+                                    [(span, close) for span in spans],
+                                    nodes))
+            selection['node'].union(nodes)
+
+        if pool is not None:
+            pool = _restart(pool, workers, osm_file, selection)
+        counts = dict((tag, 0) for tag in ELEMENT_TAGS)
+        with open(sample_file, 'wb') as output:
+            write_header(output, bbox)
+            for data, written in _map(pool, osm_file, write_elements,
+                                      [(span,) for span in spans], selection):
+                output.write(data)
+                for tag, count in written.items():
+                    counts[tag] += count
+            write_footer(output)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return counts
+
+
+def _floats(text, count):
+    values = tuple(float(value) for value in text.split(','))
+    if len(values) != count:
+        raise argparse.ArgumentTypeError("expected %d comma separated numbers"
+                                         % count)
+    return values
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Write a sample of an OpenStreetMap file")
+    parser.add_argument('osm_file', nargs='?', default=OSM_FILE)
+    parser.add_argument('sample_file', nargs='?', default=SAMPLE_FILE)
+    parser.add_argument('--mode', choices=MODES, default='every')
+    parser.add_argument('--k', type=int, default=K)
+    parser.add_argument('--size', type=int)
+    parser.add_argument('--bbox', type=lambda text: _floats(text, 4),
+                        help='minlat,minlon,maxlat,maxlon, given as '
+                             '--bbox=... when it starts with "-"')
+    parser.add_argument('--grid', default='%dx%d' % GRID,
+                        help='rows x columns of the grid, e.g. 10x10')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--no-close', dest='close', action='store_false',
+                        help="don't add the nodes of the sampled ways")
+    args = parser.parse_args()
 
-    #output.write('</osm>')
+    grid = tuple(int(value) for value in args.grid.lower().split('x'))
+    print(sample(args.osm_file, args.sample_file, args.mode, args.k,
+                 args.size, args.bbox, grid, args.seed, args.workers,
+                 args.chunk_size, args.close))
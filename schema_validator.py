@@ -0,0 +1,145 @@
+"""
+Schema validator compiled once from schema.py.
+
+Each field rule of the schema is turned into a small check-and-coerce
+function, so validating an element runs plain Python calls instead of
+interpreting the schema rules for every document. The results follow
+cerberus: validate() returns True/False, the coerced document is kept in
+.document and the error tree in .errors, with the same messages.
+"""
+
+TYPES = {
+    'boolean': bool,
+    'dict': dict,
+    'float': float,
+    'integer': int,
+    'list': list,
+    'string': str,
+}
+
+
+def _compile_field(name, rule):
+    #Returns check(value) -> (coerced value, list of errors or None)
+    coerce = rule.get('coerce')
+    type_name = rule.get('type')
+    expected_type = TYPES[type_name] if type_name else object
+    type_error = 'must be of %s type' % type_name
+    nested = None
+    if type_name == 'dict' and 'schema' in rule:
+        nested = _compile_mapping(rule['schema'])
+    elif type_name == 'list' and 'schema' in rule:
+        nested = _compile_items(rule['schema'])
+
+    def check(value):
+        coerce_error = None
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except (TypeError, ValueError) as e:
+                coerce_error = "field '%s' cannot be coerced: %s" % (name, e)
+        if value is None:
+            errors = ['null value not allowed']
+        elif not isinstance(value, expected_type):
+            errors = [type_error]
+        elif nested is not None:
+            value, nested_errors = nested(value)
+            if not nested_errors and coerce_error is None:
+                return value, None
+            errors = [nested_errors] if nested_errors else []
+        elif coerce_error is None:
+            return value, None
+        else:
+            errors = []
+        if coerce_error is not None:
+            errors.append(coerce_error)
+        return value, errors
+
+    return check
+
+
+def _compile_mapping(schema):
+    #Returns check(dict) -> (coerced dict, errors dict)
+    fields = [(name, _compile_field(name, rule), rule.get('required', False))
+              for name, rule in sorted(schema.items())]
+    known = frozenset(schema)
+
+    def check(document):
+        out = dict(document)
+        errors = {}
+        for name, check_field, required in fields:
+            if name in document:
+                value, field_errors = check_field(document[name])
+                out[name] = value
+                if field_errors:
+                    errors[name] = field_errors
+            elif required:
+                errors[name] = ['required field']
+        for name in document:
+            if name not in known:
+                errors[name] = ['unknown field']
+        if errors:
+            errors = dict(sorted(errors.items()))
+        return out, errors
+
+    return check
+
+
+def _compile_items(rule):
+    #Returns check(list) -> (coerced list, errors dict keyed by index)
+    def check(items):
+        out = []
+        errors = {}
+        for index, item in enumerate(items):
+            check_item = checkers.get(index)
+            if check_item is None:
+                check_item = checkers[index] = _compile_field(index, rule)
+            value, item_errors = check_item(item)
+            out.append(value)
+            if item_errors:
+                errors[index] = item_errors
+        return out, errors
+
+    #Item checkers only differ by the name used in coercion messages, so
+    #they are compiled on first use and reused for every list
+    checkers = {}
+    return check
+
+
+class SchemaValidator(object):
+    """
+        Validator compiled from a cerberus style schema.
+        Args: schema: the schema dict, compiled once here
+    """
+
+    def __init__(self, schema=None):
+        self._compiled = {}
+        self.schema = schema
+        self.document = None
+        self.errors = {}
+
+    def _check(self, schema):
+        schema = schema if schema is not None else self.schema
+        compiled = self._compiled.get(id(schema))
+        if compiled is None:
+            #Keep a reference to the schema so its id cannot be reused
+            compiled = self._compiled[id(schema)] = (schema,
+                                                     _compile_mapping(schema))
+        return compiled[1]
+
+    def validate(self, document, schema=None):
+        """Returns True if document matches the schema, False otherwise"""
+        self.document, self.errors = self._check(schema)(document)
+        return not self.errors
+
+    def validate_many(self, documents, schema=None):
+        """
+            Validates a block of documents at once.
+            Returns: a list of (index, errors) for the invalid documents
+        """
+        check = self._check(schema)
+        invalid = []
+        for index, document in enumerate(documents):
+            _, errors = check(document)
+            if errors:
+                invalid.append((index, errors))
+        return invalid
@@ -0,0 +1,208 @@
+"""
+R-tree spatial index over node coordinates and way bounding boxes.
+
+The index lives in SQLite rtree tables: nodes_rtree holds one box per node
+(with the exact coordinates next to it) and ways_rtree the bounding box
+of each way. process_map builds them inside the database with
+output='sqlite', or as a separate spatial_index.db for the other outputs.
+SpatialIndex runs bbox, radius and polygon queries on either file.
+
+Usage:
+    python spatial_index.py build rj_map.db
+    python spatial_index.py query rj_map.db --bbox=minlat,minlon,maxlat,maxlon
+    python spatial_index.py query rj_map.db --radius=lat,lon,meters [--ways]
+    python spatial_index.py query rj_map.db --polygon=lat,lon,lat,lon,...
+
+    The query values of Rio start with "-", so they go after "=", or
+    argparse takes them for options.
+"""
+import argparse
+import os
+import sqlite3
+
+from geometry import (haversine, bbox_around, point_bbox_distance,
+                      polygon_bbox, point_in_polygon, bbox_intersects_polygon)
+from sqlite_loader import (DB_PATH, BULK_PRAGMAS, RTREES, WAY_BOXES,
+                           build_spatial_index, has_spatial_index)
+
+INDEX_PATH = "spatial_index.db"
+# Values of each query option of the CLI (None: lat,lon pairs, 3 or more)
+QUERY_SIZES = {'bbox': 4, 'radius': 3, 'polygon': None}
+
+
+class SpatialIndexOutput(object):
+    """
+        Writes only the spatial index of the shaped elements, next to the
+        csv or Parquet outputs.
+        Args:
+            path: the index file, replaced if it exists
+            batch_size: rows buffered before they are inserted
+    """
+
+    def __init__(self, path=INDEX_PATH, batch_size=50000):
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = None
+        self.nodes = []
+        self.refs = []
+
+    def __enter__(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(BULK_PRAGMAS)
+        self.connection.executescript(RTREES)
+        self.connection.execute(
+            "CREATE TEMP TABLE way_refs (id INTEGER, node_id INTEGER)")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+                self.connection.execute(WAY_BOXES.format(
+                    refs='way_refs', nodes='nodes_rtree', where=''))
+                self.connection.commit()
+        finally:
+            self.connection.close()
+            self.connection = None
+
+    def flush(self):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO nodes_rtree VALUES (?, ?, ?, ?, ?, ?, ?)",
+            self.nodes)
+        self.connection.executemany("INSERT INTO way_refs VALUES (?, ?)",
+                                    self.refs)
+        del self.nodes[:]
+        del self.refs[:]
+
+    def write(self, el):
+        if 'node' in el:
+            node = el['node']
+            if node.lat is not None and node.lon is not None:
+                lat = float(node.lat)
+                lon = float(node.lon)
+                self.nodes.append((int(node.id), lat, lat, lon, lon, lat, lon))
+        elif 'way' in el:
+            way_id = int(el['way'].id)
+            self.refs.extend((way_id, node_id) for node_id in el['way_nodes'])
+        if len(self.nodes) + len(self.refs) >= self.batch_size:
+            self.flush()
+
+
+class SpatialIndex(object):
+    """
+        Queries on the rtree tables of a database or spatial_index.db.
+        Methods return node ids (with their distance for radius queries) or
+        the ids of the ways whose bounding box matches.
+    """
+
+    def __init__(self, path=DB_PATH):
+        if not os.path.exists(path):
+            raise IOError("no such index: %s" % path)
+        self.connection = sqlite3.connect(path)
+        if not has_spatial_index(self.connection):
+            self.connection.close()
+            raise ValueError("%s has no spatial index" % path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _nodes(self, bbox):
+        #Candidates from the float32 boxes, then the exact coordinates
+        minlat, minlon, maxlat, maxlon = bbox
+        rows = self.connection.execute(
+            "SELECT id, lat, lon FROM nodes_rtree WHERE maxlat >= ? AND "
+            "minlat <= ? AND maxlon >= ? AND minlon <= ?",
+            (minlat, maxlat, minlon, maxlon))
+        return [(osm_id, lat, lon) for osm_id, lat, lon in rows
+                if minlat <= lat <= maxlat and minlon <= lon <= maxlon]
+
+    def _ways(self, bbox):
+        minlat, minlon, maxlat, maxlon = bbox
+        return self.connection.execute(
+            "SELECT id, minlat, minlon, maxlat, maxlon FROM ways_rtree "
+            "WHERE maxlat >= ? AND minlat <= ? AND maxlon >= ? AND minlon <= ?",
+            (minlat, maxlat, minlon, maxlon)).fetchall()
+
+    def bbox(self, minlat, minlon, maxlat, maxlon, table='nodes'):
+        """Ids of the nodes inside, or the ways whose bbox overlaps, a bbox"""
+        bbox = (minlat, minlon, maxlat, maxlon)
+        if table == 'nodes':
+            return sorted(osm_id for osm_id, _, _ in self._nodes(bbox))
+        return sorted(row[0] for row in self._ways(bbox))
+
+    def radius(self, lat, lon, meters, table='nodes'):
+        """(id, meters) within a distance of a point, closest first"""
+        bbox = bbox_around(lat, lon, meters)
+        if table == 'nodes':
+            found = [(osm_id, haversine(lat, lon, node_lat, node_lon))
+                     for osm_id, node_lat, node_lon in self._nodes(bbox)]
+        else:
+            found = [(row[0], point_bbox_distance(lat, lon, row[1:]))
+                     for row in self._ways(bbox)]
+        return sorted(((osm_id, distance) for osm_id, distance in found
+                       if distance <= meters), key=lambda item: item[1])
+
+    def polygon(self, polygon, table='nodes'):
+        """Ids of the nodes inside, or the ways whose bbox overlaps, a polygon"""
+        bbox = polygon_bbox(polygon)
+        if table == 'nodes':
+            return sorted(osm_id for osm_id, lat, lon in self._nodes(bbox)
+                          if point_in_polygon(lat, lon, polygon))
+        return sorted(row[0] for row in self._ways(bbox)
+                      if bbox_intersects_polygon(row[1:], polygon))
+
+
+def _floats(text):
+    return [float(value) for value in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Build or query the spatial index of a database")
+    parser.add_argument('command', choices=('build', 'query'))
+    parser.add_argument('db', nargs='?', default=DB_PATH)
+    queries = parser.add_mutually_exclusive_group()
+    queries.add_argument('--bbox', type=_floats,
+                         help="minlat,minlon,maxlat,maxlon (as --bbox=...)")
+    queries.add_argument('--radius', type=_floats,
+                         help="lat,lon,meters (as --radius=...)")
+    queries.add_argument('--polygon', type=_floats,
+                         help="lat,lon pairs of the vertices "
+                              "(as --polygon=...)")
+    parser.add_argument('--ways', dest='table', action='store_const',
+                        const='ways', default='nodes')
+    #Options may come before the database too
+    args = parser.parse_intermixed_args()
+
+    if args.command == 'build':
+        connection = sqlite3.connect(args.db)
+        try:
+            build_spatial_index(connection)
+        finally:
+            connection.close()
+    else:
+        kind = next((kind for kind in QUERY_SIZES
+                     if getattr(args, kind) is not None), None)
+        if kind is None:
+            parser.error("query needs --bbox, --radius or --polygon")
+        values = getattr(args, kind)
+        size = QUERY_SIZES[kind]
+        if (len(values) != size if size is not None else
+                len(values) < 6 or len(values) % 2):
+            parser.error("wrong number of values for --%s" % kind)
+        with SpatialIndex(args.db) as index:
+            if kind == 'polygon':
+                results = index.polygon(list(zip(values[::2], values[1::2])),
+                                        table=args.table)
+            else:
+                results = getattr(index, kind)(*values, table=args.table)
+        for result in results:
+            print(result)
@@ -0,0 +1,405 @@
+"""
+Loads shaped OpenStreetMap elements straight into a SQLite database.
+
+Rows are buffered per table and inserted with executemany inside large
+transactions, with the pragmas tuned for a bulk load. Indexes (and the
+optional rtree spatial index, see spatial_index.py) are only built once
+everything is loaded.
+"""
+import os
+import sqlite3
+
+from node_store import WayGeometry, COORDINATE_SCALE, fixed, geometry_row
+
+DB_PATH = "rj_map.db"
+
+TABLES = """
+CREATE TABLE nodes (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat REAL,
+    lon REAL,
+    user TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT
+);
+CREATE TABLE nodes_tags (
+    id INTEGER NOT NULL,
+    key TEXT,
+    value TEXT,
+    type TEXT
+);
+CREATE TABLE ways (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT
+);
+CREATE TABLE ways_tags (
+    id INTEGER NOT NULL,
+    key TEXT,
+    value TEXT,
+    type TEXT
+);
+CREATE TABLE ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE TABLE relations (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT
+);
+CREATE TABLE relation_members (
+    id INTEGER NOT NULL,
+    member_id INTEGER NOT NULL,
+    type TEXT,
+    role TEXT,
+    position INTEGER NOT NULL
+);
+CREATE TABLE relation_tags (
+    id INTEGER NOT NULL,
+    key TEXT,
+    value TEXT,
+    type TEXT
+);
+"""
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS nodes_uid ON nodes(uid);
+CREATE INDEX IF NOT EXISTS ways_uid ON ways(uid);
+CREATE INDEX IF NOT EXISTS nodes_tags_key ON nodes_tags(key);
+CREATE INDEX IF NOT EXISTS nodes_tags_id ON nodes_tags(id);
+CREATE INDEX IF NOT EXISTS ways_tags_key ON ways_tags(key);
+CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags(id);
+CREATE INDEX IF NOT EXISTS ways_nodes_id_position ON ways_nodes(id, position);
+-- ways using a node, looked up for every OsmChange diff
+CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes(node_id);
+CREATE INDEX IF NOT EXISTS relation_members_id_position
+    ON relation_members(id, position);
+CREATE INDEX IF NOT EXISTS relation_members_member
+    ON relation_members(type, member_id);
+CREATE INDEX IF NOT EXISTS relation_tags_key ON relation_tags(key);
+CREATE INDEX IF NOT EXISTS relation_tags_id ON relation_tags(id);
+"""
+
+GEOMETRY_TABLE = """
+CREATE TABLE ways_geometry (
+    id INTEGER PRIMARY KEY NOT NULL,
+    minlat REAL,
+    minlon REAL,
+    maxlat REAL,
+    maxlon REAL,
+    length REAL,
+    node_count INTEGER,
+    missing INTEGER,
+    linestring TEXT
+);
+"""
+
+# rtree keeps 32 bit float boxes (rounded outwards), so nodes also keep
+# their exact coordinates as auxiliary columns
+RTREES = """
+CREATE VIRTUAL TABLE IF NOT EXISTS nodes_rtree
+    USING rtree(id, minlat, maxlat, minlon, maxlon, +lat REAL, +lon REAL);
+CREATE VIRTUAL TABLE IF NOT EXISTS ways_rtree
+    USING rtree(id, minlat, maxlat, minlon, maxlon);
+"""
+
+NODE_BOXES = """
+INSERT OR REPLACE INTO nodes_rtree
+SELECT id, lat, lat, lon, lon, lat, lon FROM nodes
+WHERE lat IS NOT NULL AND lon IS NOT NULL {where}
+"""
+
+# Refs of nodes missing from the extract are left out of the bbox
+WAY_BOXES = """
+INSERT OR REPLACE INTO ways_rtree
+SELECT w.id, min(n.lat), max(n.lat), min(n.lon), max(n.lon)
+FROM {refs} w JOIN {nodes} n ON n.id = w.node_id {where}
+GROUP BY w.id
+"""
+
+
+def build_spatial_index(connection):
+    """Builds the rtree tables from the nodes and ways_nodes tables"""
+    connection.executescript(RTREES)
+    connection.execute("DELETE FROM nodes_rtree")
+    connection.execute("DELETE FROM ways_rtree")
+    connection.execute(NODE_BOXES.format(where=''))
+    connection.execute(WAY_BOXES.format(refs='ways_nodes', nodes='nodes',
+                                        where=''))
+    connection.commit()
+
+
+def has_spatial_index(connection):
+    return connection.execute(
+        "SELECT count(*) FROM sqlite_master WHERE name = 'nodes_rtree'"
+    ).fetchone()[0] > 0
+
+
+def _in(column, ids):
+    return "AND %s IN (%s)" % (column, ','.join('%d' % i for i in ids))
+
+
+def ways_using(connection, node_ids):
+    """Returns the set of the ids of the ways using any of node_ids"""
+    if not node_ids:
+        return set()
+    return set(row[0] for row in connection.execute(
+        "SELECT DISTINCT id FROM ways_nodes WHERE 1 %s"
+        % _in('node_id', sorted(node_ids))))
+
+
+def update_spatial_index(connection, node_ids, way_ids):
+    """
+        Refreshes the boxes of changed nodes and ways, e.g. after an
+        OsmChange diff. Ways using a changed node get a new box as well.
+    """
+    node_ids = sorted(node_ids)
+    way_ids = set(way_ids)
+    if node_ids:
+        connection.execute("DELETE FROM nodes_rtree WHERE 1 %s"
+                           % _in('id', node_ids))
+        connection.execute(NODE_BOXES.format(where=_in('id', node_ids)))
+        way_ids.update(ways_using(connection, node_ids))
+    if way_ids:
+        way_ids = sorted(way_ids)
+        connection.execute("DELETE FROM ways_rtree WHERE 1 %s"
+                           % _in('id', way_ids))
+        connection.execute(WAY_BOXES.format(refs='ways_nodes', nodes='nodes',
+                                            where=_in('w.id', way_ids)))
+
+
+def has_geometry(connection):
+    return connection.execute(
+        "SELECT count(*) FROM sqlite_master WHERE name = 'ways_geometry'"
+    ).fetchone()[0] > 0
+
+
+def update_geometry(connection, node_ids, way_ids):
+    """
+        Recomputes the ways_geometry rows of changed ways and of the ways
+        using changed nodes, e.g. after an OsmChange diff. Deleted ways lose
+        their row. Coordinates go through the fixed point of node_store.py,
+        so the rows are the ones a full rebuild writes.
+    """
+    way_ids = sorted(set(way_ids) | ways_using(connection, node_ids))
+    if not way_ids:
+        return
+    connection.execute("DELETE FROM ways_geometry WHERE 1 %s"
+                       % _in('id', way_ids))
+    refs = dict((row[0], []) for row in connection.execute(
+        "SELECT id FROM ways WHERE 1 %s" % _in('id', way_ids)))
+    for way_id, lat, lon in connection.execute(
+            "SELECT w.id, n.lat, n.lon FROM ways_nodes w "
+            "LEFT JOIN nodes n ON n.id = w.node_id WHERE 1 %s "
+            "ORDER BY w.id, w.position" % _in('w.id', way_ids)):
+        if way_id in refs:
+            refs[way_id].append((lat, lon))
+    rows = []
+    for way_id, nodes in sorted(refs.items()):
+        points = [(fixed(lat) / COORDINATE_SCALE,
+                   fixed(lon) / COORDINATE_SCALE) for lat, lon in nodes
+                  if lat is not None and lon is not None]
+        rows.append(geometry_row(way_id, len(nodes), points))
+    connection.executemany(GEOMETRY_INSERT, rows)
+
+
+BULK_PRAGMAS = """
+PRAGMA journal_mode = OFF;
+PRAGMA synchronous = OFF;
+PRAGMA locking_mode = EXCLUSIVE;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -262144;
+"""
+
+INSERTS = {
+    'nodes': "INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+    'nodes_tags': "INSERT INTO nodes_tags VALUES (?, ?, ?, ?)",
+    'ways': "INSERT INTO ways VALUES (?, ?, ?, ?, ?, ?)",
+    'ways_tags': "INSERT INTO ways_tags VALUES (?, ?, ?, ?)",
+    'ways_nodes': "INSERT INTO ways_nodes VALUES (?, ?, ?)",
+    'relations': "INSERT INTO relations VALUES (?, ?, ?, ?, ?, ?)",
+    'relation_members': "INSERT INTO relation_members VALUES (?, ?, ?, ?, ?)",
+    'relation_tags': "INSERT INTO relation_tags VALUES (?, ?, ?, ?)",
+}
+GEOMETRY_INSERT = ("INSERT INTO ways_geometry VALUES "
+                   "(?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+def _int(value):
+    return int(value) if value is not None else None
+
+
+def _float(value):
+    return float(value) if value is not None else None
+
+
+def node_row(node):
+    return (int(node.id), _float(node.lat), _float(node.lon), node.user,
+            _int(node.uid), _int(node.version), _int(node.changeset),
+            node.timestamp)
+
+
+def way_row(way):
+    return (int(way.id), way.user, _int(way.uid), _int(way.version),
+            _int(way.changeset), way.timestamp)
+
+
+def relation_member_row(member):
+    return (int(member.id), int(member.member_id), member.type, member.role,
+            member.position)
+
+
+def tag_row(tag):
+    return (int(tag.id), tag.key, tag.value, tag.type)
+
+
+def way_node_rows(way_id, way_nodes):
+    #way_nodes is the array of node refs, in order
+    return [(way_id, node_id, position)
+            for position, node_id in enumerate(way_nodes)]
+
+
+def element_rows(el):
+    """Returns the (table, rows) pairs of one shaped element"""
+    if 'node' in el:
+        return [('nodes', [node_row(el['node'])]),
+                ('nodes_tags', [tag_row(tag) for tag in el['node_tags']])]
+    if 'way' in el:
+        way = way_row(el['way'])
+        return [('ways', [way]),
+                ('ways_nodes', way_node_rows(way[0], el['way_nodes'])),
+                ('ways_tags', [tag_row(tag) for tag in el['way_tags']])]
+    if 'relation' in el:
+        #Relations have the same attributes as ways
+        return [('relations', [way_row(el['relation'])]),
+                ('relation_members', [relation_member_row(member)
+                                      for member in el['relation_members']]),
+                ('relation_tags', [tag_row(tag) for tag in el['relation_tags']])]
+    return []
+
+
+# Parent table first, then the tables of its children (all keyed by id);
+# ways_geometry is only there when the database was built with geometry
+ELEMENT_TABLES = {
+    'node': ['nodes', 'nodes_tags'],
+    'way': ['ways', 'ways_nodes', 'ways_tags', 'ways_geometry'],
+    'relation': ['relations', 'relation_members', 'relation_tags'],
+}
+
+
+def table_names(connection):
+    """Returns the set of the tables of a database"""
+    return set(row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"))
+
+
+def delete_element(connection, tag, element_id, tables=None):
+    """
+        Deletes the rows of one element (e.g. 'way', 1234) from every table.
+        tables (from table_names) skips the optional tables the database
+        does not have; they are looked up on each call otherwise.
+    """
+    if tables is None:
+        tables = table_names(connection)
+    for table in ELEMENT_TABLES[tag]:
+        if table in tables:
+            connection.execute("DELETE FROM %s WHERE id = ?" % table,
+                               (element_id,))
+
+
+def insert_element(connection, el):
+    """Inserts the rows of one shaped element right away"""
+    for table, rows in element_rows(el):
+        connection.executemany(INSERTS[table], rows)
+
+
+class SQLiteOutput(object):
+    """
+        Writes shaped elements to a new SQLite database.
+        Args:
+            db_path: the database file, replaced if it exists
+            batch_size: rows buffered before they are inserted with executemany
+            transaction_size: rows inserted per transaction
+            spatial_index: also build the rtree tables of node coordinates
+                and way bounding boxes
+            geometry: also fill ways_geometry with the bbox, length and
+                linestring of each way (see node_store.py)
+    """
+
+    def __init__(self, db_path=DB_PATH, batch_size=50000,
+                 transaction_size=1000000, spatial_index=False,
+                 geometry=False):
+        self.db_path = db_path
+        self.spatial_index = spatial_index
+        self.geometry = WayGeometry() if geometry else None
+        self.batch_size = batch_size
+        self.transaction_size = transaction_size
+        self.connection = None
+        self.buffers = dict((table, []) for table in INSERTS)
+        if geometry:
+            self.buffers['ways_geometry'] = []
+        self._buffered = 0
+        self._uncommitted = 0
+
+    def __enter__(self):
+        if os.path.exists(self.db_path):
+            os.remove(self.db_path)
+        self.connection = sqlite3.connect(self.db_path,
+                                          isolation_level='DEFERRED')
+        self.connection.executescript(BULK_PRAGMAS)
+        self.connection.executescript(TABLES)
+        if self.geometry is not None:
+            self.connection.executescript(GEOMETRY_TABLE)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+                self.connection.commit()
+                self.connection.executescript(INDEXES)
+                if self.spatial_index:
+                    build_spatial_index(self.connection)
+                self.connection.execute("ANALYZE")
+                self.connection.commit()
+        finally:
+            if self.geometry is not None:
+                self.geometry.store.close()
+            self.connection.close()
+            self.connection = None
+
+    def flush(self):
+        """Inserts every buffered row"""
+        for table, buffer in self.buffers.items():
+            if buffer:
+                self.connection.executemany(
+                    INSERTS.get(table, GEOMETRY_INSERT), buffer)
+                self._uncommitted += len(buffer)
+                del buffer[:]
+        self._buffered = 0
+        if self._uncommitted >= self.transaction_size:
+            self.connection.commit()
+            self._uncommitted = 0
+
+    def write(self, el):
+        """Buffers the rows of one shaped element"""
+        for table, rows in element_rows(el):
+            self.buffers[table].extend(rows)
+            self._buffered += len(rows)
+        if self.geometry is not None:
+            row = self.geometry.row(el)
+            if row is not None:
+                self.buffers['ways_geometry'].append(row)
+                self._buffered += 1
+        if self._buffered >= self.batch_size:
+            self.flush()
@@ -0,0 +1,362 @@
+"""
+Index of the known street names, used to give every spelling of a street
+one canonical addr:street value.
+
+Names are folded before they are compared: case and accents are dropped,
+the street type and the usual abbreviations are spelled out and "de",
+"da", ... are left out, so "Av. N. S. Copacabana" and "Avenida Nossa
+Senhora de Copacabana" fold to the same key. Each key keeps the spellings
+seen with it and their counts; its canonical name is the most used
+spelling that needed no expansion.
+
+A value whose key is not known (a typo, a missing word) is matched to a
+known key by the Dice coefficient of their trigrams. Only a few keys are
+scored instead of the whole index: a key close enough holds nearly all the
+words of the value, so it holds one of its two rarest words, or a known
+word one edit away from it (found SymSpell style, through the one letter
+deletions of the known words).
+
+The index is saved as JSON (spellings, counts and the files they come
+from); its keys and word tables are rebuilt when it is loaded. build adds
+new files to an existing index. The folding rules and thresholds are the
+"street_names" entry of cleaning_rules.json.
+
+Usage:
+    python street_index.py build rj_map.osm [more.osm ...] [--index F]
+    python street_index.py lookup "Av. N. S. Copacabana" [--index F]
+    python street_index.py variants [--index F]
+"""
+import argparse
+import collections
+import io
+import itertools
+import json
+import os
+import re
+import time
+import unicodedata
+
+from osm_io import get_element
+from rules_config import RULES
+
+INDEX_PATH = "street_index.json"
+THRESHOLD = RULES['street_names']['threshold']
+DOMINANCE = RULES['street_names']['dominance']
+WORD = re.compile(r'[^\W_]+')
+# Shorter words are not matched one edit away
+EDIT_LENGTH = 4
+# Words held by more keys than this share of the index (or COMMON_COUNT),
+# such as the street types, do not bring candidates
+COMMON_SHARE = 0.01
+COMMON_COUNT = 100
+
+
+def plain(text):
+    """Lower case text without accents"""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed
+                   if not unicodedata.combining(c)).lower()
+
+
+def _phrases(mapping):
+    #{folded words of the abbreviation: folded words it stands for}
+    return dict((tuple(WORD.findall(plain(short))),
+                 WORD.findall(plain(full)))
+                for short, full in mapping.items())
+
+
+def deletions(word):
+    """The words made by deleting one letter of word"""
+    return tuple(word[:i] + word[i + 1:] for i in range(len(word)))
+
+
+def trigrams(key):
+    """Set of the trigrams of a key, padded with spaces"""
+    padded = ' %s ' % key
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class Folder(object):
+    """
+        Folds street names to their comparison key.
+        Args: rules: rules dict as loaded by rules_config.load_rules
+    """
+
+    def __init__(self, rules=RULES):
+        street_types = rules['street_types']
+        names = rules['street_names']
+        self.types = _phrases(street_types['mapping'])
+        self.abbreviations = _phrases(names['abbreviations'])
+        self.longest = max([len(words) for words in self.abbreviations] or
+                           [0])
+        self.stopwords = frozenset(plain(word) for word in names['stopwords'])
+        self.known_types = frozenset(
+            plain(street_type) for street_type in
+            street_types['expected'] + list(street_types['mapping'].values()))
+
+    def fold(self, name):
+        """
+            Returns: (key, expanded), expanded being True if the street type
+            or an abbreviation had to be spelled out
+        """
+        words = WORD.findall(plain(name))
+        folded = []
+        expanded = False
+        i = 0
+        if words and (words[0],) in self.types:
+            #The street type mapping only applies to the first word
+            folded.extend(self.types[(words[0],)])
+            expanded = folded != words[:1]
+            i = 1
+        while i < len(words):
+            for size in range(min(self.longest, len(words) - i), 0, -1):
+                full = self.abbreviations.get(tuple(words[i:i + size]))
+                if full is not None:
+                    folded.extend(full)
+                    expanded = True
+                    i += size
+                    break
+            else:
+                if words[i] not in self.stopwords:
+                    folded.append(words[i])
+                i += 1
+        return ' '.join(folded), expanded
+
+
+class StreetIndex(object):
+    """
+        Known street names by folded key, with the trigram index of the keys.
+        Args:
+            threshold: Dice coefficient of the key trigrams from which a
+                value matches another key
+            dominance: how many times more used another key must be to take
+                over a known key (an unknown key takes the best match)
+            rules: rules dict as loaded by rules_config.load_rules
+    """
+
+    def __init__(self, threshold=THRESHOLD, dominance=DOMINANCE, rules=RULES):
+        self.threshold = threshold
+        self.dominance = dominance
+        self.folder = Folder(rules)
+        self.street_keys = frozenset(
+            rules['street_types']['keys'] +
+            [key for key, alias in rules['key_aliases'].items()
+             if alias in rules['street_types']['keys']])
+        self.keys = []
+        self.ids = {}
+        self.spellings = []
+        self.counts = []
+        self.canonicals = []
+        self.grams = []
+        self.words = {}
+        self.deletes = collections.defaultdict(list)
+        self.expanded = set()
+        self.files = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, name, count=1):
+        """Adds count uses of a spelling of a street name"""
+        key, expanded = self.folder.fold(name)
+        if not key:
+            return
+        i = self.ids.get(key)
+        if i is None:
+            i = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+            self.spellings.append({})
+            self.counts.append(0)
+            self.canonicals.append(name)
+            self.grams.append(trigrams(key))
+            for word in set(key.split()):
+                self._add_word(word, i)
+        if expanded:
+            self.expanded.add(name)
+        spellings = self.spellings[i]
+        spellings[name] = spellings.get(name, 0) + count
+        self.counts[i] += count
+        #Counts only grow, so only the spelling just added can take over
+        if self._rank(i, name) > self._rank(i, self.canonicals[i]):
+            self.canonicals[i] = name
+
+    def _add_word(self, word, i):
+        ids = self.words.get(word)
+        if ids is None:
+            ids = self.words[word] = []
+            if len(word) >= EDIT_LENGTH:
+                for form in (word,) + deletions(word):
+                    self.deletes[form].append(word)
+        ids.append(i)
+
+    def _word_ids(self, word):
+        #Id lists of the keys holding word or, if it is not known, a known
+        #word one edit (insertion, deletion, substitution) away
+        ids = self.words.get(word)
+        if ids is not None:
+            return [ids]
+        if len(word) < EDIT_LENGTH:
+            return []
+        known = set(known for form in (word,) + deletions(word)
+                    for known in self.deletes.get(form, ()))
+        return [self.words[word] for word in known]
+
+    def _rank(self, i, name):
+        return (name not in self.expanded, self.spellings[i].get(name, 0),
+                name)
+
+    def add_file(self, osm_file):
+        """
+            Adds the street name values of an OSM file. A file already added,
+            with the same size and modification time, is skipped.
+            Returns: the number of values added, None if it was skipped
+        """
+        stat = os.stat(osm_file)
+        path = os.path.abspath(osm_file)
+        signature = [stat.st_size, int(stat.st_mtime)]
+        if self.files.get(path) == signature:
+            return None
+        count = 0
+        for element in get_element(osm_file):
+            for tag in element.iter('tag'):
+                if tag.get('k') in self.street_keys:
+                    self.add(tag.get('v'))
+                    count += 1
+        self.files[path] = signature
+        return count
+
+    def similar(self, key):
+        """Yields the (id, score) of the known keys similar to key"""
+        grams = trigrams(key)
+        size = len(grams)
+        threshold = self.threshold
+        #Sizes of the trigram sets that can reach the threshold
+        least = threshold * size / (2 - threshold)
+        most = size * (2 - threshold) / threshold
+        #A key close enough holds all our words but one or two: it holds one
+        #of the two rarest (words no key holds do not count, nor the common
+        #ones, which would make us score a good part of the index)
+        common = max(COMMON_COUNT, COMMON_SHARE * len(self.keys))
+        postings = [(count, lists) for count, lists in
+                    ((sum(map(len, lists)), lists) for lists in
+                     map(self._word_ids, set(key.split())))
+                    if 0 < count <= common]
+        postings.sort(key=lambda item: item[0])
+        seen = set()
+        for _, lists in postings[:2]:
+            for i in itertools.chain.from_iterable(lists):
+                if i in seen:
+                    continue
+                seen.add(i)
+                other = self.grams[i]
+                if least <= len(other) <= most:
+                    score = 2.0 * len(grams & other) / (size + len(other))
+                    if score >= threshold:
+                        yield i, score
+
+    def _compatible(self, key, other):
+        #Different street types or numbers are different streets
+        words = key.split()
+        other_words = other.split()
+        types = self.folder.known_types
+        if (words[0] != other_words[0] and words[0] in types and
+                other_words[0] in types):
+            return False
+        return ([word for word in words if not word.isalpha()] ==
+                [word for word in other_words if not word.isalpha()])
+
+    def match(self, name):
+        """Returns the id of the key name maps to, or None"""
+        key, _ = self.folder.fold(name)
+        if not key:
+            return None
+        own = self.ids.get(key)
+        floor = self.counts[own] * self.dominance if own is not None else 0
+        best = own
+        best_rank = None
+        for i, score in self.similar(key):
+            if (i != own and self.counts[i] > floor and
+                    self._compatible(key, self.keys[i])):
+                rank = (self.counts[i], score)
+                if best_rank is None or rank > best_rank:
+                    best, best_rank = i, rank
+        return best
+
+    def canonical(self, name):
+        """Returns the canonical spelling of a street name (name if unknown)"""
+        i = self.match(name)
+        return name if i is None else self.canonicals[i]
+
+    def variants(self):
+        """
+            Yields (canonical name, [spellings]) for every canonical name
+            with more than one spelling, counting the keys merged into it.
+        """
+        groups = collections.defaultdict(list)
+        for i in range(len(self.keys)):
+            groups[self.match(self.canonicals[i])].extend(self.spellings[i])
+        for i, spellings in sorted(groups.items(),
+                                   key=lambda item: self.canonicals[item[0]]):
+            if len(spellings) > 1:
+                yield self.canonicals[i], sorted(spellings)
+
+    def save(self, path=INDEX_PATH):
+        """Writes the spellings, counts and files to path (atomically)"""
+        names = {}
+        for spellings in self.spellings:
+            names.update(spellings)
+        temp = path + '.tmp'
+        with io.open(temp, 'w', encoding='utf-8') as f:
+            json.dump({'files': self.files, 'names': names}, f, indent=1,
+                      sort_keys=True, ensure_ascii=False)
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path=INDEX_PATH, threshold=THRESHOLD, dominance=DOMINANCE,
+             rules=RULES):
+        """Returns the index saved at path, folded with the current rules"""
+        index = cls(threshold, dominance, rules)
+        with io.open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        for name, count in data['names'].items():
+            index.add(name, count)
+        index.files = data['files']
+        return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Build or query the index of known street names.")
+    parser.add_argument('command', choices=('build', 'lookup', 'variants'))
+    parser.add_argument('args', nargs='*',
+                        help="OSM files to add (build) or names (lookup)")
+    parser.add_argument('--index', default=INDEX_PATH)
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--dominance', type=float, default=DOMINANCE)
+    args = parser.parse_args()
+
+    if os.path.exists(args.index):
+        index = StreetIndex.load(args.index, args.threshold, args.dominance)
+    elif args.command == 'build':
+        index = StreetIndex(args.threshold, args.dominance)
+    else:
+        parser.error("no index at %s: run build first" % args.index)
+    if args.command == 'build':
+        for osm_file in args.args:
+            added = index.add_file(osm_file)
+            if added is None:
+                print("%s: already in the index" % osm_file)
+            else:
+                print("%s: %d values" % (osm_file, added))
+        index.save(args.index)
+        print("%d streets, %d spellings in %s" %
+              (len(index), sum(map(len, index.spellings)), args.index))
+    elif args.command == 'lookup':
+        for name in args.args:
+            start = time.perf_counter()
+            canonical = index.canonical(name)
+            elapsed = time.perf_counter() - start
+            print("%s -> %s (%.3f ms)" % (name, canonical, elapsed * 1e3))
+    else:
+        for canonical, spellings in index.variants():
+            print("%s: %s" % (canonical, ' | '.join(spellings)))
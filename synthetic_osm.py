@@ -0,0 +1,259 @@
+"""
+Seeded generator of synthetic OpenStreetMap files for benchmarks.
+
+The files look like the Rio de Janeiro extract: nodes inside its bbox,
+then ways over runs of nearby nodes, then a few relations. The share of
+tagged elements, the way length and the mix of phone, postcode and street
+tags (with the same kinds of dirty values as the real data) can be
+changed. The same seed and options always give the same file, from the
+size of the sample to several GB, written as a stream.
+
+Usage:
+    python synthetic_osm.py out.osm [--size 100MB] [--seed 0]
+        [--tag-density 0.1] [--way-length 8] [--mix phone=1,postcode=1,...]
+"""
+import argparse
+import io
+import random
+import re
+from xml.sax.saxutils import quoteattr
+
+from rules_config import RULES
+
+SIZE = 2800000
+BBOX = (-23.1157, -43.7997, -22.7129, -43.0959)
+# Share of tagged nodes; ways and relations always have tags
+TAG_DENSITY = 0.1
+TAGS_PER_ELEMENT = 2.5
+WAY_LENGTH = 8
+WAYS_PER_NODE = 0.11
+RELATIONS_PER_WAY = 0.02
+# Relative weights of the kinds of tags
+MIX = {'phone': 1.0, 'postcode': 2.0, 'street': 3.0, 'other': 10.0}
+
+STREET_TYPES = ['Rua', 'R.', 'Avenida', 'Av', 'Av.', 'Praça', 'Pça',
+                'Estrada', 'Estr.', 'Travessa', 'Trav.', 'Rue', 'Ruo',
+                'Largo', 'Rodovia', 'Ladeira']
+STREET_NAMES = ['Visconde de Pirajá', 'Nossa Senhora de Copacabana',
+                'Presidente Vargas', 'das Américas', 'Atlântica',
+                'Barata Ribeiro', 'Voluntários da Pátria', 'São Clemente',
+                'Marquês de São Vicente', 'Conde de Bonfim', 'Brasil',
+                'Rio Branco', 'Dias da Cruz', 'Ataulfo de Paiva']
+OTHER_TAGS = [('amenity', ['restaurant', 'bank', 'school', 'pharmacy',
+                           'fuel', 'cafe']),
+              ('highway', ['residential', 'primary', 'service',
+                           'bus_stop', 'traffic_signals']),
+              ('name', ['Padaria Central', 'Bar do Zé', 'Escola Municipal',
+                        'Posto Ipiranga', 'Farmácia Pacheco']),
+              ('building', ['yes', 'house', 'apartments']),
+              ('source', ['Bing', 'survey', 'Yahoo imaery']),
+              ('addr:housenumber', ['10', '250', '1024', '33A']),
+              ('addr:city', ['Rio de Janeiro', 'Niterói', 'Nova Iguaçu'])]
+USERS = ['Nighto', 'smaprs_import', 'Geaquinto', 'petropouli', 'Import Rio',
+         'ThiagoPv', 'Alexandrecw', 'AndreaVillaverde', 'Caio Nogueira']
+
+
+def _digits(rng, count):
+    return ''.join(rng.choice('0123456789') for _ in range(count))
+
+
+def phone_value(rng):
+    """A phone number in one of the formats found in the extract"""
+    local = _digits(rng, 4) + '-' + _digits(rng, 4)
+    cell = '9' + _digits(rng, 4) + '-' + _digits(rng, 4)
+    return rng.choice([
+        '+55 21 ' + local, '+55-21-' + local, '(21) ' + local, local,
+        '21 ' + cell, '+55 21 ' + cell, '021 ' + local.replace('-', ''),
+        '0800 ' + _digits(rng, 3) + ' ' + _digits(rng, 4),
+        '+55 21 ' + local + ' / +55 21 ' + _digits(rng, 4) + '-' +
+        _digits(rng, 4),
+        local + ' ou ' + _digits(rng, 4) + '-' + _digits(rng, 4),
+    ])
+
+
+def postcode_value(rng):
+    code = '2' + _digits(rng, 7)
+    return rng.choice([code, code[:5] + '-' + code[5:], code[:5]])
+
+
+def street_value(rng):
+    return rng.choice(STREET_TYPES) + ' ' + rng.choice(STREET_NAMES)
+
+
+class SyntheticOsm(object):
+    """
+        Options of a synthetic file.
+        Args:
+            seed: seed of every random choice
+            tag_density: share of nodes with tags
+            way_length: mean number of nodes per way
+            mix: relative weights of 'phone', 'postcode', 'street' and
+                'other' tags
+    """
+
+    def __init__(self, seed=0, tag_density=TAG_DENSITY, way_length=WAY_LENGTH,
+                 mix=None):
+        self.seed = seed
+        self.tag_density = tag_density
+        self.way_length = way_length
+        self.mix = dict(MIX, **(mix or {}))
+        self._kinds = sorted(self.mix)
+        self._weights = [self.mix[kind] for kind in self._kinds]
+
+    def options(self):
+        return {'seed': self.seed, 'tag_density': self.tag_density,
+                'way_length': self.way_length, 'mix': self.mix}
+
+    def _tags(self, rng):
+        tags = []
+        for _ in range(max(1, int(rng.expovariate(1.0 / TAGS_PER_ELEMENT)))):
+            kind = rng.choices(self._kinds, self._weights)[0]
+            if kind == 'phone':
+                tags.append((rng.choice(RULES['phone_keys']),
+                             phone_value(rng)))
+            elif kind == 'postcode':
+                tags.append((rng.choice(RULES['postal_keys']),
+                             postcode_value(rng)))
+            elif kind == 'street':
+                tags.append(('addr:street', street_value(rng)))
+            else:
+                key, values = rng.choice(OTHER_TAGS)
+                tags.append((key, rng.choice(values)))
+        return tags
+
+    def _attributes(self, rng, osm_id):
+        user = rng.choice(USERS)
+        return ('id="%d" version="%d" changeset="%d" uid="%d" user=%s '
+                'timestamp="20%02d-%02d-%02dT%02d:%02d:%02dZ"' % (
+                    osm_id, rng.randint(1, 9), rng.randint(1, 60000000),
+                    USERS.index(user) * 1000 + 17, quoteattr(user),
+                    rng.randint(8, 17), rng.randint(1, 12), rng.randint(1, 28),
+                    rng.randint(0, 23), rng.randint(0, 59),
+                    rng.randint(0, 59)))
+
+    def _write_tags(self, out, tags):
+        for key, value in tags:
+            out.write('    <tag k=%s v=%s />\n' % (quoteattr(key),
+                                                    quoteattr(value)))
+
+    def node(self, rng, osm_id):
+        minlat, minlon, maxlat, maxlon = BBOX
+        out = io.StringIO()
+        head = '  <node %s lat="%.7f" lon="%.7f"' % (
+            self._attributes(rng, osm_id), rng.uniform(minlat, maxlat),
+            rng.uniform(minlon, maxlon))
+        if rng.random() < self.tag_density:
+            out.write(head + '>\n')
+            self._write_tags(out, self._tags(rng))
+            out.write('  </node>\n')
+        else:
+            out.write(head + ' />\n')
+        return out.getvalue()
+
+    def way(self, rng, osm_id, node_count):
+        #A run of nearby node ids, like the nodes of a real way
+        length = max(2, int(rng.expovariate(1.0 / self.way_length)) + 1)
+        first = rng.randint(1, max(1, node_count - length))
+        out = io.StringIO()
+        out.write('  <way %s>\n' % self._attributes(rng, osm_id))
+        for ref in range(first, min(first + length, node_count + 1)):
+            out.write('    <nd ref="%d" />\n' % ref)
+        self._write_tags(out, self._tags(rng))
+        out.write('  </way>\n')
+        return out.getvalue()
+
+    def relation(self, rng, osm_id, node_count, way_count):
+        out = io.StringIO()
+        out.write('  <relation %s>\n' % self._attributes(rng, osm_id))
+        for _ in range(rng.randint(1, 6)):
+            if rng.random() < 0.7:
+                out.write('    <member type="way" ref="%d" role="%s" />\n' % (
+                    rng.randint(1, way_count), rng.choice(['outer', 'inner',
+                                                           ''])))
+            else:
+                out.write('    <member type="node" ref="%d" role="stop" />\n'
+                          % rng.randint(1, node_count))
+        out.write('    <tag k="type" v="%s" />\n' %
+                  rng.choice(['multipolygon', 'route', 'restriction']))
+        self._write_tags(out, self._tags(rng))
+        out.write('  </relation>\n')
+        return out.getvalue()
+
+    def counts(self, size):
+        """Number of nodes, ways and relations of a file of about size bytes"""
+        #Measure the mean size of each element on a separate stream
+        rng = random.Random(self.seed ^ 0x5eed)
+        sample = 2000
+        node_bytes = sum(len(self.node(rng, 10 ** 9)) for _ in range(sample))
+        way_bytes = sum(len(self.way(rng, 10 ** 9, 10 ** 6))
+                        for _ in range(sample))
+        relation_bytes = sum(len(self.relation(rng, 10 ** 9, 10 ** 6, 10 ** 5))
+                             for _ in range(sample))
+        per_node = (node_bytes + WAYS_PER_NODE * (
+            way_bytes + RELATIONS_PER_WAY * relation_bytes)) / sample
+        nodes = max(1, int(size / per_node))
+        ways = max(1, int(nodes * WAYS_PER_NODE))
+        return nodes, ways, max(1, int(ways * RELATIONS_PER_WAY))
+
+    def write(self, out_file, size=SIZE):
+        """
+            Writes a file of about size bytes.
+            Returns: the number of nodes, ways and relations written
+        """
+        nodes, ways, relations = self.counts(size)
+        rng = random.Random(self.seed)
+        with io.open(out_file, 'w', encoding='utf-8',
+                     buffering=1024 * 1024) as out:
+            out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            out.write('<osm version="0.6" generator="synthetic_osm.py">\n')
+            out.write('  <bounds minlat="%r" minlon="%r" maxlat="%r" '
+                      'maxlon="%r"/>\n' % BBOX)
+            for osm_id in range(1, nodes + 1):
+                out.write(self.node(rng, osm_id))
+            for osm_id in range(1, ways + 1):
+                out.write(self.way(rng, osm_id, nodes))
+            for osm_id in range(1, relations + 1):
+                out.write(self.relation(rng, osm_id, nodes, ways))
+            out.write('</osm>\n')
+        return {'node': nodes, 'way': ways, 'relation': relations}
+
+
+def parse_size(text):
+    """Bytes of a size like 2800000, '2.8MB' or '1GB'"""
+    m = re.match(r'^\s*([\d.]+)\s*([kmg]?)b?\s*$', str(text).lower())
+    if not m:
+        raise ValueError("not a size: %r" % (text,))
+    factor = {'': 1, 'k': 10 ** 3, 'm': 10 ** 6, 'g': 10 ** 9}[m.group(2)]
+    return int(float(m.group(1)) * factor)
+
+
+def parse_mix(text):
+    """{'phone': 1.0, ...} from 'phone=1,postcode=2'"""
+    mix = {}
+    for item in text.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in MIX:
+            raise ValueError("unknown tag kind: %r" % (kind,))
+        mix[kind] = float(weight)
+    return mix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic OpenStreetMap file")
+    parser.add_argument('out_file')
+    parser.add_argument('--size', type=parse_size, default=SIZE,
+                        help="approximate file size, e.g. 2.8MB or 2GB")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tag-density', type=float, default=TAG_DENSITY,
+                        help="share of nodes with tags")
+    parser.add_argument('--way-length', type=float, default=WAY_LENGTH,
+                        help="mean number of nodes per way")
+    parser.add_argument('--mix', type=parse_mix, default=None,
+                        help="tag kind weights, e.g. phone=1,postcode=2,"
+                             "street=3,other=10")
+    args = parser.parse_args()
+
+    generator = SyntheticOsm(args.seed, args.tag_density, args.way_length,
+                             args.mix)
+    print(generator.write(args.out_file, args.size))